@@ -1,6 +1,7 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
 import io
-from typing import List
+from typing import Callable, List
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi import File, Form, UploadFile
@@ -8,9 +9,26 @@ from PIL import Image
 
 from pydantic import BaseModel
 from embeddings.documents import KnowledgeDocument
+from knowledge.registry import selected_knowledge_pack_id
 from knowledge_manager import KnowledgeManager
-from llms.chats import ChatManager, ChatOptions, StreamingChat
+from llms.card_state import CardState
+from llms.chats import (
+    ChatManager,
+    ChatOptions,
+    HaivenBaseChat,
+    StreamingChat,
+    error_chunk,
+)
+from llms.clients import HaivenHumanMessage
+from llms.first_step import FirstStep
+from llms.streams import END_OF_STREAM, next_chunk
 from llms.model_config import ModelConfig
+from llms.rate_limiter import (
+    ModelRateLimiters,
+    RateLimitExceeded,
+    Reservation,
+    estimate_tokens,
+)
 from llms.image_description_service import ImageDescriptionService
 from prompts.prompts import PromptList
 from prompts.inspirations import InspirationsManager
@@ -33,7 +51,9 @@ class PromptRequestBody(BaseModel):
 
 
 class IterateRequest(PromptRequestBody):
-    scenarios: str
+    scenarios: str = None
+    # Only exchange changes: the server keeps the cards of the session and streams patches to them
+    delta: bool = False
 
 
 def streaming_media_type() -> str:
@@ -52,6 +72,91 @@ def streaming_headers(chat_session_key_value=None):
     return headers
 
 
+async def cancel_on_disconnect(request: Request, stream, poll_seconds: float = 0.5):
+    """
+    Stops pulling from the stream as soon as the client disconnects, also while waiting for the model's
+    next token. The chat and the model's stream are cancelled, so that the provider stops generating.
+    """
+    pending_chunk = None
+    try:
+        while True:
+            pending_chunk = asyncio.ensure_future(next_chunk(stream))
+            while not pending_chunk.done():
+                await asyncio.wait({pending_chunk}, timeout=poll_seconds)
+                if not pending_chunk.done() and await request.is_disconnected():
+                    HaivenLogger.get().info(
+                        "Client disconnected, cancelling the model's response"
+                    )
+                    return
+            chunk = pending_chunk.result()
+            if chunk is END_OF_STREAM:
+                return
+            yield chunk
+    finally:
+        if pending_chunk is not None and not pending_chunk.done():
+            pending_chunk.cancel()
+            await asyncio.wait({pending_chunk})
+        await stream.aclose()
+
+
+def wants_object_events(request: Request) -> bool:
+    # Clients that render cards can ask for each complete object instead of the chunks of a JSON answer
+    return request is not None and request.query_params.get("events") == "objects"
+
+
+async def multiplex(streams: dict):
+    """
+    Merges several streams into one, as (key, chunk) pairs in the order in which the chunks arrive.
+    All streams are pulled from concurrently, and closed when the merged stream is closed.
+    """
+    pending = {
+        asyncio.ensure_future(next_chunk(stream)): key
+        for key, stream in streams.items()
+    }
+    try:
+        while pending:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for pending_chunk in done:
+                key = pending.pop(pending_chunk)
+                chunk = pending_chunk.result()
+                if chunk is END_OF_STREAM:
+                    continue
+                pending[asyncio.ensure_future(next_chunk(streams[key]))] = key
+                yield key, chunk
+    finally:
+        for pending_chunk in pending:
+            pending_chunk.cancel()
+        if pending:
+            await asyncio.wait(pending)
+        for stream in streams.values():
+            await stream.aclose()
+
+
+class ReservedStreamingResponse(StreamingResponse):
+    """
+    Streams the answer to a request that holds a reservation of the model, and releases the reservation
+    when the response is done: streamed completely, failed, disconnected before the body was iterated,
+    or dropped without ever being sent.
+    """
+
+    def __init__(self, content, reservation: Reservation, **kwargs):
+        super().__init__(content, **kwargs)
+        self.reservation = reservation
+
+    def release(self):
+        if self.reservation is not None:
+            self.reservation.release()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.release()
+
+    def __del__(self):
+        self.release()
+
+
 class HaivenBaseApi:
     def __init__(
         self,
@@ -59,10 +164,167 @@ class HaivenBaseApi:
         chat_manager: ChatManager,
         model_config: ModelConfig,
         prompt_list: PromptList,
+        rate_limiters: ModelRateLimiters = None,
     ):
         self.chat_manager = chat_manager
         self.model_config = model_config
         self.prompt_list = prompt_list
+        self.rate_limiters = rate_limiters
+
+    async def run_with_sessions(self, fn, *args, **kwargs):
+        """
+        Calls a function that gets, creates or stores chat sessions. Shared session stores are files or
+        services, so the function runs in a thread then, instead of blocking the event loop.
+        """
+        session_memory = getattr(self.chat_manager, "chat_session_memory", None)
+        if session_memory is not None and session_memory.store.shared:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+        return fn(*args, **kwargs)
+
+    async def reserve_model(
+        self, prompt: str, chat_session: HaivenBaseChat = None
+    ) -> Reservation:
+        """
+        Waits for the request's turn with the model, or fails with 429/503 if that would take too long.
+        The tokens are estimated for the whole request: the conversation of the chat session that is
+        sent to the model, and the new prompt.
+        """
+        limiter = (
+            self.rate_limiters.get(self.model_config) if self.rate_limiters else None
+        )
+        if limiter is None:
+            return None
+
+        request = list(chat_session.messages_for_model()) if chat_session else []
+        request.append(HaivenHumanMessage(content=prompt))
+        try:
+            return await limiter.acquire(estimated_tokens=estimate_tokens(request))
+        except RateLimitExceeded as error:
+            HaivenLogger.get().error(
+                str(error),
+                extra={
+                    "model": self.model_config.id,
+                    "queue_depth": limiter.queue_depth(),
+                },
+            )
+            raise HTTPException(
+                status_code=error.status_code,
+                detail=str(error),
+                headers={"Retry-After": str(error.retry_after_seconds)},
+            )
+
+    def usage_recorder(
+        self,
+        reservation: Reservation,
+        session: str,
+        user_identifier=None,
+        prompt_id=None,
+    ) -> Callable[[dict], dict]:
+        """
+        Returns the callback for the usage of an answer: it records the usage, and corrects the estimated
+        tokens of the request's reservation with it.
+        """
+
+        def on_usage(usage: dict) -> dict:
+            if reservation is not None:
+                # A routed request that another model answered used none of this model's tokens
+                reservation.settle(
+                    usage if usage.get("model") == self.model_config.lite_id else None
+                )
+            return self.chat_manager.record_usage(
+                usage, session=session, user=user_identifier, prompt_id=prompt_id
+            )
+
+        return on_usage
+
+    async def complete_in_branch(
+        self,
+        prompt,
+        chat_session_key_value,
+        prompt_id=None,
+        user_identifier=None,
+        use_cache=False,
+    ) -> str:
+        """
+        Generates a whole answer in a branch of the session, for requests that are fanned out
+        into several model requests. Each of them waits for its own turn with the model.
+        """
+        chat_session = await self.run_with_sessions(
+            self.chat_manager.json_chat_branch,
+            model_config=self.model_config,
+            session_id=chat_session_key_value,
+        )
+        reservation = await self.reserve_model(prompt, chat_session)
+        try:
+            return await chat_session.acomplete(
+                prompt,
+                on_usage=self.usage_recorder(
+                    reservation, chat_session_key_value, user_identifier, prompt_id
+                ),
+                use_cache=use_cache,
+            )
+        finally:
+            if reservation is not None:
+                reservation.release()
+
+    def _until_disconnected(self, request: Request, stream):
+        if request is None:
+            return stream
+        return cancel_on_disconnect(request, stream)
+
+    async def iterate_on_card_state(self, request: Request, prompt_data):
+        """
+        Iterates on the cards that the server keeps for the chat session: the model is only asked for
+        the properties it changes, which are merged into the cards and streamed as patch events.
+        Scenarios sent with the request replace the cards of the session.
+        """
+        chat_session = await self.run_with_sessions(
+            self.chat_manager.get_session, prompt_data.chatSessionId
+        )
+        if prompt_data.scenarios:
+            try:
+                chat_session.card_state = CardState(json.loads(prompt_data.scenarios))
+            except (ValueError, TypeError, AttributeError):
+                raise HTTPException(
+                    status_code=400, detail="scenarios must be a JSON array of objects"
+                )
+        if chat_session.card_state is None:
+            raise HTTPException(
+                status_code=400,
+                detail="scenarios are required to start iterating on the cards",
+            )
+
+        rendered_prompt = (
+            f"""
+
+            My new request:
+            {prompt_data.userinput}
+            """
+            + """
+            ### Output format: JSON with only the changed properties and the "id" property
+            Here is my current working state of the data, iterate on those objects based on that request.
+            Only return a JSON array with the properties you changed or added for each object, nothing else.
+            Do not repeat properties that you did not change, and leave out objects that you did not change.
+            Definitely include the "id" property of each object, so I can apply your changes to my data.
+            For example, if I give you
+            [ { "title": "Paris", "id": 1 }, { "title": "London", "id": 2 } ]
+            and ask you to add information about what you know about each of these cities, then return to me
+            [ { "summary": "capital of France", "id": 1 }, { "summary": "Capital of the UK", "id": 2 } ]
+"""
+            + f"""
+            ### Current JSON data
+            {chat_session.card_state.to_json()}
+            Please iterate on this data based on my request.
+        """
+        )
+
+        return await self.stream_json_chat(
+            prompt=rendered_prompt,
+            chat_category="boba-chat",
+            chat_session_key_value=prompt_data.chatSessionId,
+            request=request,
+            on_object=chat_session.card_state.apply_patch,
+        )
 
     def get_hashed_user_id(self, request):
         if request.session and request.session.get("user"):
@@ -72,7 +334,7 @@ class HaivenBaseApi:
         else:
             return None
 
-    def stream_json_chat(
+    async def stream_json_chat(
         self,
         prompt,
         chat_category,
@@ -82,13 +344,38 @@ class HaivenBaseApi:
         user_identifier=None,
         context=None,
         origin_url=None,
+        use_cache=False,
+        semantic_cache_scope=None,
+        semantic_cache_query=None,
+        request: Request = None,
+        branch=False,
+        on_object=None,
+        first_step: FirstStep = None,
     ):
+        reservation = None
         try:
-            chat_session_key_value, chat_session = self.chat_manager.json_chat(
-                model_config=self.model_config,
-                session_id=chat_session_key_value,
-                options=ChatOptions(category=chat_category),
+            options = ChatOptions(
+                category=chat_category,
+                semantic_cache_scope=semantic_cache_scope,
+                semantic_cache_query=semantic_cache_query,
             )
+            if branch:
+                chat_session = await self.run_with_sessions(
+                    self.chat_manager.json_chat_branch,
+                    model_config=self.model_config,
+                    session_id=chat_session_key_value,
+                    options=options,
+                )
+            else:
+                chat_session_key_value, chat_session = await self.run_with_sessions(
+                    self.chat_manager.json_chat,
+                    model_config=self.model_config,
+                    session_id=chat_session_key_value,
+                    options=options,
+                )
+            reservation = await self.reserve_model(prompt, chat_session)
+            if first_step is not None:
+                chat_session.first_step = first_step
 
             chat_session.log_run(
                 {
@@ -100,70 +387,160 @@ class HaivenBaseApi:
                 }
             )
 
-            return StreamingResponse(
-                chat_session.run(prompt),
+            on_usage = self.usage_recorder(
+                reservation, chat_session_key_value, user_identifier, prompt_id
+            )
+            return ReservedStreamingResponse(
+                self._until_disconnected(
+                    request,
+                    chat_session.arun(
+                        prompt,
+                        on_usage=on_usage,
+                        object_events=wants_object_events(request),
+                        on_object=on_object,
+                        use_cache=use_cache,
+                    ),
+                ),
+                reservation,
                 media_type=streaming_media_type(),
                 headers=streaming_headers(chat_session_key_value),
             )
 
+        except HTTPException:
+            # The model's rate limit is reached
+            raise
         except Exception as error:
+            if reservation is not None:
+                reservation.release()
             raise Exception(error)
 
-    def stream_text_chat(
+    def text_chat_session(
         self,
-        prompt,
         chat_category,
         chat_session_key_value=None,
-        document_key=None,
         prompt_id=None,
         user_identifier=None,
         context=None,
         origin_url=None,
+        semantic_cache_scope=None,
+        semantic_cache_query=None,
+        first_step: FirstStep = None,
+        parent_session_id=None,
     ):
-        try:
-
-            def stream(chat_session: StreamingChat, prompt):
-                try:
-                    if document_key:
-                        sources = ""
-                        for chunk, sources in chat_session.run_with_document(
-                            document_key, prompt
-                        ):
-                            sources = sources
-                            yield chunk
-                        yield "\n\n" + sources if sources else ""
-                    else:
-                        for chunk in chat_session.run(prompt):
-                            yield chunk
-                except Exception as error:
-                    if not str(error).strip():
-                        error = "Error while the model was processing the input"
-                    print(f"[ERROR]: {str(error)}")
-                    yield f"[ERROR]: {str(error)}"
-
+        """
+        Gets or creates the streaming chat session, and returns its key and the session.
+        A new session with a parent session forks off the parent's conversation.
+        """
+        options = ChatOptions(
+            in_chunks=True,
+            category=chat_category,
+            semantic_cache_scope=semantic_cache_scope,
+            semantic_cache_query=semantic_cache_query,
+        )
+        if parent_session_id and not chat_session_key_value:
+            chat_session_key_value, chat_session = (
+                self.chat_manager.streaming_chat_fork(
+                    model_config=self.model_config,
+                    parent_session_id=parent_session_id,
+                    options=options,
+                )
+            )
+        else:
             chat_session_key_value, chat_session = self.chat_manager.streaming_chat(
                 model_config=self.model_config,
                 session_id=chat_session_key_value,
-                options=ChatOptions(in_chunks=True, category=chat_category),
+                options=options,
             )
+        if first_step is not None:
+            chat_session.first_step = first_step
+
+        chat_session.log_run(
+            {
+                "url": origin_url,
+                "user_id": user_identifier,
+                "session": chat_session_key_value,
+                "prompt_id": prompt_id,
+                "context": context,
+            }
+        )
+        return chat_session_key_value, chat_session
+
+    async def text_chat_answer(
+        self,
+        chat_session: StreamingChat,
+        prompt,
+        document_key=None,
+        on_usage: Callable[[dict], dict] = None,
+    ):
+        """
+        Streams the answer of the chat session to the prompt, with the sources of a document's knowledge.
+        """
+        try:
+            if document_key:
+                sources = ""
+                async for chunk, sources in chat_session.arun_with_document(
+                    document_key, prompt, on_usage
+                ):
+                    sources = sources
+                    yield chunk
+                yield "\n\n" + sources if sources else ""
+            else:
+                async for chunk in chat_session.arun(prompt, on_usage=on_usage):
+                    yield chunk
+        except Exception as error:
+            yield error_chunk(error)
 
-            chat_session.log_run(
-                {
-                    "url": origin_url,
-                    "user_id": user_identifier,
-                    "session": chat_session_key_value,
-                    "prompt_id": prompt_id,
-                    "context": context,
-                }
+    async def stream_text_chat(
+        self,
+        prompt,
+        chat_category,
+        chat_session_key_value=None,
+        document_key=None,
+        prompt_id=None,
+        user_identifier=None,
+        context=None,
+        origin_url=None,
+        semantic_cache_scope=None,
+        semantic_cache_query=None,
+        request: Request = None,
+        first_step: FirstStep = None,
+        parent_session_id=None,
+    ):
+        reservation = None
+        try:
+            chat_session_key_value, chat_session = await self.run_with_sessions(
+                self.text_chat_session,
+                chat_category,
+                chat_session_key_value=chat_session_key_value,
+                prompt_id=prompt_id,
+                user_identifier=user_identifier,
+                context=context,
+                origin_url=origin_url,
+                semantic_cache_scope=semantic_cache_scope,
+                semantic_cache_query=semantic_cache_query,
+                first_step=first_step,
+                parent_session_id=parent_session_id,
             )
-
-            return StreamingResponse(
-                stream(chat_session, prompt),
+            reservation = await self.reserve_model(prompt, chat_session)
+            on_usage = self.usage_recorder(
+                reservation, chat_session_key_value, user_identifier, prompt_id
+            )
+            return ReservedStreamingResponse(
+                self._until_disconnected(
+                    request,
+                    self.text_chat_answer(chat_session, prompt, document_key, on_usage),
+                ),
+                reservation,
                 media_type=streaming_media_type(),
                 headers=streaming_headers(chat_session_key_value),
             )
 
+        except HTTPException:
+            # The model's rate limit is reached
+            raise
         except Exception as error:
+            if reservation is not None:
+                reservation.release()
             raise Exception(error)
 
 
@@ -180,8 +557,9 @@ class ApiBasics(HaivenBaseApi):
         config_service: ConfigService,
         disclaimer_and_guidelines: DisclaimerAndGuidelinesService,
         inspirations_manager: InspirationsManager,
+        rate_limiters: ModelRateLimiters = None,
     ):
-        super().__init__(app, chat_manager, model_config, prompts_guided)
+        super().__init__(app, chat_manager, model_config, prompts_guided, rate_limiters)
         self.inspirations_manager = inspirations_manager
 
         @app.get("/api/models")
@@ -214,6 +592,20 @@ class ApiBasics(HaivenBaseApi):
                     status_code=500, detail=f"Server error: {str(error)}"
                 )
 
+        @app.get("/api/usage")
+        @logger.catch(reraise=True)
+        def get_usage(request: Request):
+            return JSONResponse(
+                {"prompts": self.chat_manager.usage_accounting.all_totals("prompt")}
+            )
+
+        @app.get("/api/models/limits")
+        @logger.catch(reraise=True)
+        def get_model_limits(request: Request):
+            return JSONResponse(
+                self.rate_limiters.status() if self.rate_limiters else {}
+            )
+
         @app.get("/api/prompts")
         @logger.catch(reraise=True)
         def get_prompts(request: Request):
@@ -308,10 +700,12 @@ class ApiBasics(HaivenBaseApi):
 
         @app.post("/api/prompt")
         @logger.catch(reraise=True)
-        def chat(request: Request, prompt_data: PromptRequestBody):
+        async def chat(request: Request, prompt_data: PromptRequestBody):
             origin_url = request.headers.get("referer")
             try:
                 stream_fn = self.stream_text_chat
+                semantic_cache_scope, semantic_cache_query = None, None
+                first_step = None
                 if prompt_data.promptid:
                     prompts = (
                         prompts_guided
@@ -327,13 +721,34 @@ class ApiBasics(HaivenBaseApi):
                     )
                     if prompts.produces_json_output(prompt_data.promptid):
                         stream_fn = self.stream_json_chat
+                    # Only new conversations without a document depend on nothing but the prompt
+                    if (
+                        prompts.uses_semantic_cache(prompt_data.promptid)
+                        and not prompt_data.chatSessionId
+                        and not prompt_data.document
+                    ):
+                        # Knowledge packs of different teams must not share responses
+                        semantic_cache_scope = (
+                            selected_knowledge_pack_id(),
+                            prompt_data.promptid,
+                            prompt_data.context,
+                        )
+                        # The prompt's template would make any two inputs look similar
+                        semantic_cache_query = prompt_data.userinput
+                    # Follow-up and explore requests can refer to this step by its chat session id
+                    if not prompt_data.chatSessionId:
+                        first_step = FirstStep(
+                            prompt_data.promptid,
+                            prompt_data.userinput,
+                            prompt_data.context,
+                        )
                 else:
                     rendered_prompt = prompt_data.userinput
 
                 if prompt_data.json is True:
                     stream_fn = self.stream_json_chat
 
-                return stream_fn(
+                return await stream_fn(
                     prompt=rendered_prompt,
                     chat_category="boba-chat",
                     chat_session_key_value=prompt_data.chatSessionId,
@@ -342,8 +757,14 @@ class ApiBasics(HaivenBaseApi):
                     user_identifier=self.get_hashed_user_id(request),
                     context=prompt_data.context,
                     origin_url=origin_url,
+                    semantic_cache_scope=semantic_cache_scope,
+                    semantic_cache_query=semantic_cache_query,
+                    request=request,
+                    first_step=first_step,
                 )
 
+            except HTTPException:
+                raise
             except Exception as error:
                 HaivenLogger.get().error(str(error))
                 raise HTTPException(
@@ -351,12 +772,18 @@ class ApiBasics(HaivenBaseApi):
                 )
 
         @app.post("/api/prompt/iterate")
-        def iterate(prompt_data: IterateRequest):
+        async def iterate(request: Request, prompt_data: IterateRequest):
             try:
                 if prompt_data.chatSessionId is None or prompt_data.chatSessionId == "":
                     raise HTTPException(
                         status_code=400, detail="chatSessionId is required"
                     )
+                if prompt_data.delta:
+                    return await self.iterate_on_card_state(request, prompt_data)
+                if prompt_data.scenarios is None:
+                    raise HTTPException(
+                        status_code=400, detail="scenarios are required"
+                    )
                 stream_fn = self.stream_json_chat
 
                 rendered_prompt = (
@@ -383,15 +810,34 @@ class ApiBasics(HaivenBaseApi):
                 """
                 )
 
-                return stream_fn(
+                return await stream_fn(
                     prompt=rendered_prompt,
                     chat_category="boba-chat",
                     chat_session_key_value=prompt_data.chatSessionId,
+                    request=request,
                 )
 
+            except HTTPException:
+                raise
             except Exception as e:
                 raise HTTPException(status_code=500, detail=f"Server error: {str(e)}")
 
+        @app.get("/api/prompt/iterate/state")
+        async def iteration_state(request: Request):
+            chat_session_id = request.query_params.get("chatSessionId")
+            try:
+                chat_session = await self.run_with_sessions(
+                    self.chat_manager.get_session, chat_session_id
+                )
+            except ValueError as error:
+                raise HTTPException(status_code=404, detail=str(error))
+            card_state = getattr(chat_session, "card_state", None)
+            if card_state is None:
+                raise HTTPException(
+                    status_code=404, detail="No cards in this chat session"
+                )
+            return JSONResponse(card_state.to_dict())
+
         @app.post("/api/prompt/render")
         @logger.catch(reraise=True)
         def render_prompt(prompt_data: PromptRequestBody):
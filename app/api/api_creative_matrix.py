@@ -1,11 +1,39 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
-from fastapi import Request
-from api.api_basics import HaivenBaseApi
+import json
+
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+from api.api_basics import (
+    HaivenBaseApi,
+    multiplex,
+    streaming_headers,
+    streaming_media_type,
+)
+from llms.chats import ChatOptions
+from logger import HaivenLogger
+
+FAN_OUT_OPTIONS = ["row", "cell"]
+
+
+def split_list(comma_separated: str) -> list[str]:
+    return [item.strip() for item in (comma_separated or "").split(",") if item.strip()]
+
+
+def parse_json_answer(answer: str):
+    # Models sometimes wrap the JSON in a markdown code block despite being asked not to
+    answer = answer.strip()
+    if answer.startswith("```"):
+        answer = answer.split("\n", 1)[-1].rsplit("```", 1)[0]
+    return json.loads(answer)
 
 
 class ApiCreativeMatrix(HaivenBaseApi):
-    def __init__(self, app, chat_session_memory, model_key, prompt_list):
-        super().__init__(app, chat_session_memory, model_key, prompt_list)
+    def __init__(
+        self, app, chat_session_memory, model_key, prompt_list, rate_limiters=None
+    ):
+        super().__init__(
+            app, chat_session_memory, model_key, prompt_list, rate_limiters
+        )
 
         @app.get("/api/creative-matrix")
         async def creative_matrix(request: Request):
@@ -19,6 +47,21 @@ class ApiCreativeMatrix(HaivenBaseApi):
                 "num_ideas": request.query_params.get("num_ideas", "3"),
             }
 
+            fan_out = request.query_params.get("fan_out")
+            if fan_out:
+                if fan_out not in FAN_OUT_OPTIONS:
+                    raise HTTPException(
+                        status_code=400,
+                        detail=f"fan_out must be one of {', '.join(FAN_OUT_OPTIONS)}",
+                    )
+                return await self.stream_fanned_out_matrix(
+                    variables,
+                    fan_out,
+                    user_identifier=self.get_hashed_user_id(request),
+                    origin_url=origin_url,
+                    request=request,
+                )
+
             prompt, _ = prompt_list.render_prompt(
                 active_knowledge_context=None,
                 prompt_choice="guided-creative-matrix",
@@ -27,9 +70,97 @@ class ApiCreativeMatrix(HaivenBaseApi):
                 warnings=[],
             )
 
-            return self.stream_json_chat(
+            return await self.stream_json_chat(
                 prompt,
                 "creative-matrix",
                 origin_url=origin_url,
                 prompt_id="creative-matrix",
+                use_cache=True,
+                request=request,
+            )
+
+    def _sub_matrices(self, variables: dict, fan_out: str) -> list[tuple[str, str]]:
+        rows = split_list(variables["rows"])
+        if fan_out == "row":
+            return [(row, None) for row in rows]
+        return [
+            (row, column) for row in rows for column in split_list(variables["columns"])
+        ]
+
+    async def _generate_sub_matrix(
+        self, chat_session_key_value, variables, row, column, user_identifier
+    ):
+        prompt, _ = self.prompt_list.render_prompt(
+            active_knowledge_context=None,
+            prompt_choice="guided-creative-matrix",
+            user_input="",
+            additional_vars={
+                **variables,
+                "rows": row,
+                "columns": column or variables["columns"],
+            },
+            warnings=[],
+        )
+        event = {"row": row, "column": column}
+        try:
+            answer = await self.complete_in_branch(
+                prompt,
+                chat_session_key_value,
+                prompt_id="creative-matrix",
+                user_identifier=user_identifier,
+                use_cache=True,
             )
+            event["data"] = parse_json_answer(answer)
+        except HTTPException as error:
+            event["error"] = error.detail
+        except Exception as error:
+            HaivenLogger.get().error(f"Could not generate creative matrix: {error}")
+            event["error"] = str(error) or "Error while the model was processing"
+        yield f"{json.dumps(event)}\n\n"
+
+    async def stream_fanned_out_matrix(
+        self,
+        variables: dict,
+        fan_out: str,
+        user_identifier=None,
+        origin_url=None,
+        request: Request = None,
+    ):
+        """
+        Generates each row or each cell of the matrix in a request of its own. The requests run
+        concurrently within the model's rate limits, and each part is sent as soon as it is complete,
+        as an event with its row (and column) and the same JSON structure as the whole matrix.
+        """
+        chat_session_key_value, chat_session = await self.run_with_sessions(
+            self.chat_manager.json_chat,
+            model_config=self.model_config,
+            options=ChatOptions(category="creative-matrix"),
+        )
+        sub_matrices = self._sub_matrices(variables, fan_out)
+        chat_session.log_run(
+            {
+                "url": origin_url,
+                "user_id": user_identifier,
+                "session": chat_session_key_value,
+                "prompt_id": "creative-matrix",
+                "fan_out": fan_out,
+                "sub_requests": len(sub_matrices),
+            }
+        )
+
+        async def events():
+            async for _, event in multiplex(
+                {
+                    (row, column): self._generate_sub_matrix(
+                        chat_session_key_value, variables, row, column, user_identifier
+                    )
+                    for row, column in sub_matrices
+                }
+            ):
+                yield event
+
+        return StreamingResponse(
+            self._until_disconnected(request, events()),
+            media_type=streaming_media_type(),
+            headers=streaming_headers(chat_session_key_value),
+        )
@@ -1,8 +1,18 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+from contextlib import aclosing
 from typing import List
 from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from api.api_basics import HaivenBaseApi, PromptRequestBody
+from api.api_basics import (
+    HaivenBaseApi,
+    PromptRequestBody,
+    multiplex,
+    streaming_headers,
+    streaming_media_type,
+)
+from llms.chats import StreamingChat
 from logger import HaivenLogger
 
 
@@ -19,6 +29,12 @@ class FollowUpPromptInput(BaseModel):
 class FollowUpRequest(PromptRequestBody):
     previous_promptid: str = None
     scenarios: List[TitleContent] = []
+    # The chat session id of the first step, instead of sending what it was based on again
+    first_step_id: str = None
+
+
+class FollowUpBatchRequest(FollowUpRequest):
+    promptids: List[str] = []
 
 
 class ExploreRequest(PromptRequestBody):
@@ -26,6 +42,8 @@ class ExploreRequest(PromptRequestBody):
     previous_framing: str = None
     item: str = None
     first_step_input: str = None
+    # The chat session id of the first step, instead of sending what it was based on again
+    first_step_id: str = None
 
 
 class ApiMultiStep(HaivenBaseApi):
@@ -35,8 +53,162 @@ class ApiMultiStep(HaivenBaseApi):
             for pair in promptinput.scenarios
         ]
 
-    def __init__(self, app, chat_session_memory, model_key, prompt_list):
-        super().__init__(app, chat_session_memory, model_key, prompt_list)
+    async def _with_first_step(self, prompt_data):
+        """
+        Fills in what a request that refers to the first step by its id does not send again.
+        Returns the request, the first step and its answer, or no step for requests that send everything.
+        """
+        if not prompt_data.first_step_id:
+            return prompt_data, None, None
+        try:
+            chat_session = await self.run_with_sessions(
+                self.chat_manager.get_session, prompt_data.first_step_id
+            )
+        except ValueError as error:
+            raise HTTPException(status_code=404, detail=str(error))
+        first_step = getattr(chat_session, "first_step", None)
+        if first_step is None:
+            raise HTTPException(
+                status_code=404,
+                detail=f"{prompt_data.first_step_id} is not the first step of a multi-step flow",
+            )
+
+        stored = {
+            "previous_promptid": first_step.prompt_id,
+            "context": first_step.context,
+        }
+        # Explore requests send their own question, follow-ups are about the first step's input
+        if "first_step_input" in type(prompt_data).model_fields:
+            stored["first_step_input"] = first_step.user_input
+        else:
+            stored["userinput"] = first_step.user_input
+        missing = {
+            field: value
+            for field, value in stored.items()
+            if not getattr(prompt_data, field)
+        }
+        return (
+            prompt_data.model_copy(update=missing),
+            first_step,
+            first_step.output(chat_session),
+        )
+
+    def _follow_up_input(self, prompt_data: FollowUpRequest, first_step_answer=None):
+        user_input = prompt_data.userinput
+        if prompt_data.previous_promptid is not None:
+            output_framing = self.prompt_list.get(
+                prompt_data.previous_promptid
+            ).metadata["output_framing"]
+            # Without cards revised by the user, the first step's answer is what they have so far
+            cards = (
+                first_step_answer
+                if first_step_answer is not None and not prompt_data.scenarios
+                else self._concat_scenarios(prompt_data)
+            )
+
+            user_input = f"""
+                        {prompt_data.userinput}
+                        
+                        {output_framing}
+                        {cards}
+                    """
+        return user_input
+
+    async def _follow_up_events(
+        self,
+        prompt_id: str,
+        prompt: str,
+        chat_session_key_value: str,
+        chat_session: StreamingChat,
+        document_key=None,
+        user_identifier=None,
+    ):
+        def event(**fields):
+            return json.dumps({"promptid": prompt_id, **fields}) + "\n\n"
+
+        reservation = None
+        try:
+            reservation = await self.reserve_model(prompt, chat_session)
+            stream = self.text_chat_answer(
+                chat_session,
+                prompt,
+                document_key,
+                self.usage_recorder(
+                    reservation, chat_session_key_value, user_identifier, prompt_id
+                ),
+            )
+            async with aclosing(stream) as chunks:
+                async for chunk in chunks:
+                    yield event(data=chunk)
+        except HTTPException as error:
+            yield event(error=error.detail)
+        finally:
+            if reservation is not None:
+                reservation.release()
+        yield event(done=True)
+
+    async def stream_follow_up_batch(
+        self,
+        prompt_data: FollowUpBatchRequest,
+        user_identifier=None,
+        origin_url=None,
+        request: Request = None,
+    ):
+        """
+        Runs several follow-up prompts on the same cards concurrently, each in a chat session of its own.
+        All answers are streamed on one connection, as events tagged with the follow-up's prompt id:
+        first one with the chat session id of each follow-up, then the chunks of the answers as they arrive,
+        and one marking the end of each answer.
+        """
+        # The cards are the same for all follow-ups, so they are only put together once
+        prompt_data, _, first_step_answer = await self._with_first_step(prompt_data)
+        user_input = self._follow_up_input(prompt_data, first_step_answer)
+        session_keys, streams = {}, {}
+        for prompt_id in dict.fromkeys(prompt_data.promptids):
+            rendered_prompt, _ = self.prompt_list.render_prompt(
+                active_knowledge_context=prompt_data.context,
+                prompt_choice=prompt_id,
+                user_input=user_input,
+                additional_vars={},
+                warnings=[],
+            )
+            session_keys[prompt_id], chat_session = await self.run_with_sessions(
+                self.text_chat_session,
+                chat_category="follow-up",
+                prompt_id=prompt_id,
+                user_identifier=user_identifier,
+                origin_url=origin_url,
+            )
+            streams[prompt_id] = self._follow_up_events(
+                prompt_id,
+                rendered_prompt,
+                session_keys[prompt_id],
+                chat_session,
+                prompt_data.document,
+                user_identifier,
+            )
+
+        async def events():
+            for prompt_id, session_key in session_keys.items():
+                yield (
+                    json.dumps({"promptid": prompt_id, "chatSessionId": session_key})
+                    + "\n\n"
+                )
+            async for _, event in multiplex(streams):
+                yield event
+
+        return StreamingResponse(
+            self._until_disconnected(request, events()),
+            media_type=streaming_media_type(),
+            headers=streaming_headers(),
+        )
+
+    def __init__(
+        self, app, chat_session_memory, model_key, prompt_list, rate_limiters=None
+    ):
+        super().__init__(
+            app, chat_session_memory, model_key, prompt_list, rate_limiters
+        )
 
         # - Input for frontend: a list of promptIds - first step, multiple prompt options for next step?
         # - First step always returns cards, which are then editable in the UI
@@ -45,43 +217,60 @@ class ApiMultiStep(HaivenBaseApi):
         # 1. call POST api/prompt with the first prompt id to
 
         @app.post("/api/prompt/follow-up")
-        def generate_follow_up(request: Request, prompt_data: FollowUpRequest):
+        async def generate_follow_up(request: Request, prompt_data: FollowUpRequest):
             origin_url = request.headers.get("referer")
 
             try:
                 stream_fn = self.stream_text_chat
                 prompts = self.prompt_list
-
-                user_input = prompt_data.userinput
-                if prompt_data.previous_promptid is not None:
-                    output_framing = prompts.get(
-                        prompt_data.previous_promptid
-                    ).metadata["output_framing"]
-
-                    user_input = f"""
-                        {prompt_data.userinput}
-                        
-                        {output_framing}
-                        {self._concat_scenarios(prompt_data)}
-                    """
+                prompt_data, _, first_step_answer = await self._with_first_step(
+                    prompt_data
+                )
 
                 rendered_prompt, _ = prompts.render_prompt(
                     active_knowledge_context=prompt_data.context,
                     prompt_choice=prompt_data.promptid,
-                    user_input=user_input,
+                    user_input=self._follow_up_input(prompt_data, first_step_answer),
                     additional_vars={},
                     warnings=[],
                 )
 
-                return stream_fn(
+                return await stream_fn(
                     prompt=rendered_prompt,
                     chat_category="follow-up",
                     chat_session_key_value=prompt_data.chatSessionId,
                     document_key=prompt_data.document,
                     user_identifier=self.get_hashed_user_id(request),
                     origin_url=origin_url,
+                    request=request,
+                )
+
+            except HTTPException:
+                raise
+            except Exception as error:
+                HaivenLogger.get().error(str(error))
+                raise HTTPException(
+                    status_code=500, detail=f"Server error: {str(error)}"
+                )
+
+        @app.post("/api/prompt/follow-ups")
+        async def generate_follow_ups(
+            request: Request, prompt_data: FollowUpBatchRequest
+        ):
+            try:
+                if not prompt_data.promptids:
+                    raise HTTPException(
+                        status_code=400, detail="promptids must not be empty"
+                    )
+                return await self.stream_follow_up_batch(
+                    prompt_data,
+                    user_identifier=self.get_hashed_user_id(request),
+                    origin_url=request.headers.get("referer"),
+                    request=request,
                 )
 
+            except HTTPException:
+                raise
             except Exception as error:
                 HaivenLogger.get().error(str(error))
                 raise HTTPException(
@@ -89,18 +278,37 @@ class ApiMultiStep(HaivenBaseApi):
                 )
 
         @app.post("/api/prompt/explore")
-        def kick_off_explore(request: Request, prompt_data: ExploreRequest):
+        async def kick_off_explore(request: Request, prompt_data: ExploreRequest):
             origin_url = request.headers.get("referer")
 
             try:
                 stream_fn = self.stream_text_chat
                 prompts = self.prompt_list
+                prompt_data, first_step, _ = await self._with_first_step(prompt_data)
 
                 user_input = prompt_data.userinput
-                if prompt_data.previous_promptid:
+                parent_session_id = None
+                if first_step is not None and not prompt_data.chatSessionId:
+                    # The first step's conversation already has the context, the input and the answer,
+                    # so the new chat shares it instead of repeating it for every item
+                    parent_session_id = prompt_data.first_step_id
+                    user_input = f"""
+I want to focus on this item from your answer:
+
+{prompt_data.item}
+
+## My follow-up question
+
+{prompt_data.userinput}
+                    """
+                elif prompt_data.previous_promptid:
                     if prompt_data.context:
-                        context = prompts.get_rendered_context(
-                            prompt_data.context, prompt_data.previous_promptid
+                        context = (
+                            first_step.rendered_context(prompts)
+                            if first_step is not None
+                            else prompts.get_rendered_context(
+                                prompt_data.context, prompt_data.previous_promptid
+                            )
                         )
                         context = f"""
                         ## General context
@@ -149,15 +357,19 @@ I want to focus on this item:
 {prompt_data.userinput}
                     """
 
-                return stream_fn(
+                return await stream_fn(
                     prompt=user_input,
                     chat_category="explore",
                     chat_session_key_value=prompt_data.chatSessionId,
                     document_key=prompt_data.document,
                     user_identifier=self.get_hashed_user_id(request),
                     origin_url=origin_url,
+                    request=request,
+                    parent_session_id=parent_session_id,
                 )
 
+            except HTTPException:
+                raise
             except Exception as error:
                 HaivenLogger.get().error(str(error))
                 raise HTTPException(
@@ -1,14 +1,29 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
-from fastapi import Request
+from fastapi import HTTPException, Request
 from api.api_basics import HaivenBaseApi
+from logger import HaivenLogger
+
+
+def scenario_prompt_choice(detail: str) -> str:
+    # "titles" is the first phase of generating scenarios in two phases,
+    # the details of each scenario are then requested from /api/make-scenario/details
+    if detail == "true":
+        return "guided-scenarios-detailed"
+    if detail == "titles":
+        return "guided-scenarios-titles"
+    return "guided-scenarios"
 
 
 class ApiScenarios(HaivenBaseApi):
-    def __init__(self, app, chat_session_memory, model_key, prompt_list):
-        super().__init__(app, chat_session_memory, model_key, prompt_list)
+    def __init__(
+        self, app, chat_session_memory, model_key, prompt_list, rate_limiters=None
+    ):
+        super().__init__(
+            app, chat_session_memory, model_key, prompt_list, rate_limiters
+        )
 
         @app.get("/api/make-scenario")
-        def make_scenario(request: Request):
+        async def make_scenario(request: Request):
             origin_url = request.headers.get("referer")
             chat_category = "scenarios"
             variables = {
@@ -20,22 +35,66 @@ class ApiScenarios(HaivenBaseApi):
                 "optimism": request.query_params.get("optimism", "optimistic"),
                 "realism": request.query_params.get("realism", "futuristic sci-fi"),
             }
-            detailed = request.query_params.get("detail") == "true"
-
             prompt, _ = prompt_list.render_prompt(
                 active_knowledge_context=None,
-                prompt_choice="guided-scenarios-detailed"
-                if detailed
-                else "guided-scenarios",
+                prompt_choice=scenario_prompt_choice(
+                    request.query_params.get("detail")
+                ),
                 user_input="",
                 additional_vars=variables,
                 warnings=[],
             )
 
-            return self.stream_json_chat(
+            return await self.stream_json_chat(
                 prompt,
                 chat_category=chat_category,
                 prompt_id="scenarios",
                 user_identifier=self.get_hashed_user_id(request),
                 origin_url=origin_url,
+                use_cache=True,
+                request=request,
             )
+
+        @app.get("/api/make-scenario/details")
+        async def make_scenario_details(request: Request):
+            """
+            Generates the details of one scenario of a session that generated titles only.
+            Requests for several scenarios of the same session can run in parallel.
+            """
+            origin_url = request.headers.get("referer")
+            chat_session_id = request.query_params.get("chatSessionId")
+            title = request.query_params.get("title")
+            try:
+                if not chat_session_id or not title:
+                    raise HTTPException(
+                        status_code=400,
+                        detail="chatSessionId and title are required",
+                    )
+
+                prompt, _ = prompt_list.render_prompt(
+                    active_knowledge_context=None,
+                    prompt_choice="guided-scenario-details",
+                    user_input="",
+                    additional_vars={"title": title},
+                    warnings=[],
+                )
+
+                return await self.stream_json_chat(
+                    prompt,
+                    chat_category="scenarios",
+                    chat_session_key_value=chat_session_id,
+                    prompt_id="scenario-details",
+                    user_identifier=self.get_hashed_user_id(request),
+                    origin_url=origin_url,
+                    use_cache=True,
+                    request=request,
+                    branch=True,
+                )
+
+            except HTTPException:
+                raise
+            except Exception as error:
+                HaivenLogger.get().error(str(error))
+                raise HTTPException(
+                    status_code=500, detail=f"Server error: {str(error)}"
+                )
@@ -7,41 +7,37 @@ from api.api_creative_matrix import ApiCreativeMatrix
 from llms.chats import (
     ChatManager,
 )
-from knowledge_manager import KnowledgeManager
+from knowledge.registry import LoadedKnowledgePack
 from llms.image_description_service import ImageDescriptionService
-from prompts.prompts_factory import PromptsFactory
+from llms.rate_limiter import ModelRateLimiters
 from config_service import ConfigService
-from disclaimer_and_guidelines import DisclaimerAndGuidelinesService
 from prompts.inspirations import InspirationsManager
 
 
 class BobaApi:
     def __init__(
         self,
-        prompts_factory: PromptsFactory,
-        knowledge_manager: KnowledgeManager,
+        knowledge_pack: LoadedKnowledgePack,
         chat_manager: ChatManager,
         config_service: ConfigService,
         image_service: ImageDescriptionService,
-        disclaimer_and_guidelines: DisclaimerAndGuidelinesService,
+        rate_limiters: ModelRateLimiters = None,
     ):
-        self.knowledge_manager = knowledge_manager
+        self.knowledge_manager = knowledge_pack.knowledge_manager
         self.chat_manager = chat_manager
         self.config_service = config_service
         self.inspirations_manager = InspirationsManager()
 
-        self.prompts_chat = prompts_factory.create_chat_prompt_list(
-            self.knowledge_manager.knowledge_base_markdown
-        )
-        prompts_factory_guided = PromptsFactory("./resources/prompts_guided")
-        self.prompts_guided = prompts_factory_guided.create_guided_prompt_list(
-            self.knowledge_manager.knowledge_base_markdown
-        )
+        self.prompts_chat = knowledge_pack.prompts_chat
+        self.prompts_guided = knowledge_pack.prompts_guided
 
         self.model_config = self.config_service.get_chat_model()
 
         self.image_service = image_service
-        self.disclaimer_and_guidelines = disclaimer_and_guidelines
+        self.disclaimer_and_guidelines = knowledge_pack.disclaimer_and_guidelines
+        self.rate_limiters = (
+            rate_limiters if rate_limiters is not None else ModelRateLimiters()
+        )
 
         print(f"Model used for guided mode: {self.model_config.id}")
 
@@ -57,12 +53,14 @@ class BobaApi:
             self.config_service,
             self.disclaimer_and_guidelines,
             self.inspirations_manager,
+            self.rate_limiters,
         )
         ApiMultiStep(
             app,
             self.chat_manager,
             self.model_config,
             self.prompts_chat,
+            self.rate_limiters,
         )
 
         ApiScenarios(
@@ -70,10 +68,12 @@ class BobaApi:
             self.chat_manager,
             self.model_config,
             self.prompts_guided,
+            self.rate_limiters,
         )
         ApiCreativeMatrix(
             app,
             self.chat_manager,
             self.model_config,
             self.prompts_guided,
+            self.rate_limiters,
         )
@@ -1,17 +1,30 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from functools import partial
+
 from api.boba_api import BobaApi
 from knowledge_manager import KnowledgeManager
+from knowledge.bundle import BundlePackFileReader, KnowledgePackBundle
+from knowledge.pack import KnowledgePackSource
+from knowledge.pack_files import PackFileReader
+from knowledge.registry import (
+    DEFAULT_KNOWLEDGE_PACK_ID,
+    KnowledgePackRegistry,
+    LoadedKnowledgePack,
+)
+from knowledge.watcher import KnowledgePackReloader, KnowledgePackWatcher
 from llms.chats import ChatManager, ServerChatSessionMemory
+from llms.session_store import create_session_store
 from llms.image_description_service import ImageDescriptionService
 from llms.clients import ChatClientFactory
+from llms.rate_limiter import ModelRateLimiters
+from llms.http_clients import HttpClients, provider_endpoints
 from llms.model_config import ModelConfig
 from prompts.prompts_factory import PromptsFactory
-from prompts.prompts_testing_ui import PromptsTestingUI
 from server import Server
 from config_service import ConfigService
 from disclaimer_and_guidelines import DisclaimerAndGuidelinesService
-
-import gradio as gr
+from logger import HaivenLogger
+from startup_profiler import StartupProfiler
 
 
 class App:
@@ -20,43 +33,179 @@ class App:
 
         return ImageDescriptionService(model)
 
-    def __init__(self, config_path: str):
-        config_service = ConfigService(config_path)
+    def __init__(self, config_path: str, startup_profiler: StartupProfiler = None):
+        profiler = startup_profiler or StartupProfiler()
 
-        knowledge_pack_path = config_service.load_knowledge_pack_path()
-        knowledge_manager = KnowledgeManager(config_service=config_service)
+        with profiler.phase("config"):
+            config_service = ConfigService(config_path)
+            self.config_service = config_service
 
-        prompts_factory = PromptsFactory(knowledge_pack_path)
-        disclaimer_and_guidelines = DisclaimerAndGuidelinesService(knowledge_pack_path)
-        chat_session_memory = ServerChatSessionMemory()
-        llm_chat_factory = ChatClientFactory(config_service)
-        chat_manager = ChatManager(
-            config_service, chat_session_memory, llm_chat_factory, knowledge_manager
-        )
+        with profiler.phase("http clients"):
+            http_clients = HttpClients.configure(
+                **config_service.load_http_pool_options()
+            )
 
-        image_service = self.create_image_service(config_service)
+        with profiler.phase("knowledge pack"):
+            default_knowledge_pack = self.load_knowledge_pack(
+                config_service,
+                KnowledgePackSource(
+                    id=DEFAULT_KNOWLEDGE_PACK_ID,
+                    path=config_service.load_knowledge_pack_path(),
+                    bundle_path=config_service.load_knowledge_pack_bundle_path(),
+                ),
+            )
+            knowledge_packs = self.create_knowledge_pack_registry(
+                config_service, default_knowledge_pack
+            )
+            knowledge_pack = (
+                knowledge_packs.current_knowledge_pack()
+                if knowledge_packs
+                else default_knowledge_pack
+            )
 
-        self.prompts_testing_ui = PromptsTestingUI(chat_manager)
+        with profiler.phase("chat services"):
+            chat_session_memory = ServerChatSessionMemory(
+                create_session_store(
+                    config_service.load_chat_session_store(),
+                    config_service.load_chat_session_store_token(),
+                )
+            )
+            chat_session_memory.start()
+            # Shared by the API, by routed requests, which go to several models, and by conversation summaries
+            rate_limiters = ModelRateLimiters()
+            llm_chat_factory = ChatClientFactory(config_service, rate_limiters)
+            self.chat_manager = ChatManager(
+                config_service,
+                chat_session_memory,
+                llm_chat_factory,
+                knowledge_pack.knowledge_manager,
+                rate_limiters,
+            )
 
-        self.server = Server(
-            chat_manager,
-            config_service,
-            BobaApi(
-                prompts_factory,
-                knowledge_manager,
-                chat_manager,
+            image_service = self.create_image_service(config_service)
+
+        with profiler.phase("api"):
+            boba_api = BobaApi(
+                knowledge_pack,
+                self.chat_manager,
                 config_service,
                 image_service,
-                disclaimer_and_guidelines,
+                rate_limiters,
+            )
+            self.server = Server(
+                self.chat_manager, config_service, boba_api, knowledge_packs
+            ).create()
+
+        if config_service.load_http_warm_up_enabled():
+            self.warm_up_http_clients(config_service, http_clients)
+
+        with profiler.phase("knowledge pack watcher"):
+            self.knowledge_pack_watcher = self.create_knowledge_pack_watcher(
+                config_service, default_knowledge_pack
+            )
+
+    def load_knowledge_pack(
+        self, config_service, source: KnowledgePackSource
+    ) -> LoadedKnowledgePack:
+        pack_file_reader = self.create_pack_file_reader(
+            config_service, source.path, source.bundle_path
+        )
+        knowledge_manager = KnowledgeManager(
+            config_service=config_service,
+            pack_file_reader=pack_file_reader,
+            knowledge_pack_path=source.path,
+        )
+        knowledge_base_markdown = knowledge_manager.knowledge_base_markdown
+
+        prompts_factory = PromptsFactory(source.path, pack_file_reader)
+        prompts_factory_guided = PromptsFactory(
+            "./resources/prompts_guided", pack_file_reader
+        )
+        return LoadedKnowledgePack(
+            knowledge_manager=knowledge_manager,
+            prompts_chat=prompts_factory.create_chat_prompt_list(
+                knowledge_base_markdown
             ),
-        ).create()
+            prompts_guided=prompts_factory_guided.create_guided_prompt_list(
+                knowledge_base_markdown
+            ),
+            disclaimer_and_guidelines=DisclaimerAndGuidelinesService(source.path),
+        )
+
+    def create_knowledge_pack_registry(self, config_service, default_knowledge_pack):
+        sources = config_service.load_knowledge_packs()
+        if not sources:
+            return None
+
+        registry = KnowledgePackRegistry(
+            default_knowledge_pack,
+            sources,
+            partial(self.load_knowledge_pack, config_service),
+            idle_seconds=config_service.load_knowledge_pack_idle_seconds(),
+            max_loaded=config_service.load_max_loaded_knowledge_packs(),
+        )
+        registry.start()
+        return registry
+
+    def create_pack_file_reader(
+        self, config_service, knowledge_pack_path, bundle_path=None
+    ):
+        cache_dir = config_service.load_knowledge_pack_cache_dir()
+        if bundle_path is None:
+            return PackFileReader(cache_dir=cache_dir)
+
+        bundle = KnowledgePackBundle(bundle_path, knowledge_pack_path)
+        HaivenLogger.get().info(
+            f"Loading knowledge pack from bundle {bundle_path}, compiled at {bundle.manifest['created_at']}"
+        )
+        return BundlePackFileReader(bundle, cache_dir=cache_dir)
+
+    def create_knowledge_pack_watcher(
+        self, config_service, knowledge_pack: LoadedKnowledgePack
+    ):
+        interval = config_service.load_knowledge_pack_reload_interval()
+        if interval is None:
+            return None
+        if config_service.load_knowledge_pack_bundle_path() is not None:
+            HaivenLogger.get().info(
+                "Not watching the knowledge pack for changes, it is loaded from a bundle"
+            )
+            return None
+
+        reloader = KnowledgePackReloader(
+            knowledge_pack.knowledge_manager, [knowledge_pack.prompts_chat]
+        )
+        watcher = KnowledgePackWatcher(
+            knowledge_pack.knowledge_manager.knowledge_pack_definition.path,
+            reloader.on_change,
+            interval_seconds=interval,
+        )
+        watcher.start()
+        return watcher
+
+    def warm_up_http_clients(self, config_service, http_clients: HttpClients):
+        endpoints = provider_endpoints(
+            config_service.load_enabled_models()
+            + [config_service.load_embedding_model()]
+        )
+        http_clients.warm_up(endpoints)
+        # The async client's connections belong to the server's event loop, which only runs once the server started
+        self.server.router.on_startup.append(partial(http_clients.awarm_up, endpoints))
 
     def launch_via_fastapi_wrapper(self):
+        if self.config_service.load_prompt_testing_ui_enabled():
+            self.mount_prompt_testing_ui()
+
+        return self.server
+
+    def mount_prompt_testing_ui(self):
+        # Gradio is slow to import and only needed for the prompt testing UI, so it is only loaded when switched on
+        import gradio as gr
+        from prompts.prompts_testing_ui import PromptsTestingUI
+
         gr.mount_gradio_app(
             self.server,
-            self.prompts_testing_ui.create_gradio_ui(),
+            PromptsTestingUI(self.chat_manager).create_gradio_ui(),
             path="/prompting",
             root_path="/prompting",
         )
-
-        return self.server
@@ -5,7 +5,7 @@ from typing import List
 
 import yaml
 from dotenv import load_dotenv
-from knowledge.pack import KnowledgePackError
+from knowledge.pack import KnowledgePackError, KnowledgePackSource
 from llms.model_config import ModelConfig
 from llms.default_models import DefaultModels
 from embeddings.model import EmbeddingModel
@@ -155,6 +155,278 @@ class ConfigService:
 
         return knowledge_pack_path
 
+    def load_knowledge_pack_reload_interval(self) -> float:
+        """
+        Load the interval in which the knowledge pack is checked for changes.
+
+        Returns:
+            float: The interval in seconds, or None if hot reloading is switched off.
+        """
+        interval = self.data.get("knowledge_pack_reload_interval_seconds")
+        if interval is None or interval == "":
+            return None
+
+        return float(interval)
+
+    def load_knowledge_pack_cache_dir(self) -> str:
+        """
+        Load the directory in which parsed knowledge pack files are cached between restarts.
+
+        Returns:
+            str: The cache directory, or None if parsed files should only be cached in memory.
+        """
+        cache_dir = self.data.get("knowledge_pack_cache_dir")
+        return cache_dir or None
+
+    def load_knowledge_pack_bundle_path(self) -> str:
+        """
+        Load the path of the compiled knowledge pack bundle.
+
+        Returns:
+            str: The bundle path, or None if the knowledge pack should be read from its folder.
+        """
+        bundle_path = self.data.get("knowledge_pack_bundle_path")
+        return bundle_path or None
+
+    def load_knowledge_packs(self) -> List[KnowledgePackSource]:
+        """
+        Load the additional knowledge packs that are served next to the default one.
+
+        Returns:
+            List[KnowledgePackSource]: The additional knowledge packs, empty if only the default knowledge pack is served.
+        """
+        knowledge_packs = self.data.get("knowledge_packs") or []
+        sources = [KnowledgePackSource.from_dict(data) for data in knowledge_packs]
+        for source in sources:
+            if not source.id or not source.path:
+                raise KnowledgePackError(
+                    "Every entry in `knowledge_packs` needs an `id` and a `path`. Please check your config file."
+                )
+        return sources
+
+    def load_knowledge_pack_idle_seconds(self) -> float:
+        """
+        Load after how many seconds without requests an additional knowledge pack is unloaded again.
+
+        Returns:
+            float: The idle time in seconds, or None if loaded knowledge packs are kept.
+        """
+        idle_seconds = self.data.get("knowledge_pack_idle_seconds")
+        if idle_seconds is None or idle_seconds == "":
+            return None
+
+        return float(idle_seconds)
+
+    def load_max_loaded_knowledge_packs(self) -> int:
+        """
+        Load how many additional knowledge packs can be loaded at the same time.
+
+        Returns:
+            int: The maximum number of loaded additional knowledge packs, or None for no limit.
+        """
+        max_loaded = self.data.get("max_loaded_knowledge_packs")
+        if max_loaded is None or max_loaded == "":
+            return None
+
+        return int(max_loaded)
+
+    def load_prompt_testing_ui_enabled(self) -> bool:
+        """
+        Load whether the Gradio prompt testing UI should be served under /prompting.
+
+        Returns:
+            bool: True if the prompt testing UI is switched on, False by default.
+        """
+        enabled = self.data.get("prompt_testing_ui_enabled")
+        return str(enabled).lower() == "true"
+
+    def load_response_cache_ttl_seconds(self) -> float:
+        """
+        Load for how many seconds responses of deterministic guided generations are cached.
+
+        Returns:
+            float: The time to live of cached responses in seconds, or None if responses are not cached.
+        """
+        ttl_seconds = self.data.get("response_cache_ttl_seconds")
+        if ttl_seconds is None or ttl_seconds == "":
+            return None
+
+        return float(ttl_seconds)
+
+    def load_response_cache_max_entries(self) -> int:
+        """
+        Load how many responses are cached at most.
+
+        Returns:
+            int: The maximum number of cached responses, 1000 by default.
+        """
+        max_entries = self.data.get("response_cache_max_entries")
+        if max_entries is None or max_entries == "":
+            return 1000
+
+        return int(max_entries)
+
+    def load_response_cache_path(self) -> str:
+        """
+        Load the path of the SQLite file to keep cached responses in.
+
+        Returns:
+            str: The path of the SQLite file, or None if responses are only cached in memory.
+        """
+        cache_path = self.data.get("response_cache_path")
+        return cache_path or None
+
+    def load_semantic_cache_threshold(self) -> float:
+        """
+        Load how similar a first chat message has to be to a previous one to be answered with its cached response.
+
+        Returns:
+            float: The minimum cosine similarity (e.g. 0.95), or None if the semantic cache is switched off.
+        """
+        threshold = self.data.get("semantic_cache_threshold")
+        if threshold is None or threshold == "":
+            return None
+
+        return float(threshold)
+
+    def load_semantic_cache_max_entries(self) -> int:
+        """
+        Load how many responses the semantic cache keeps per prompt, model and context.
+
+        Returns:
+            int: The maximum number of cached responses per prompt, 100 by default.
+        """
+        max_entries = self.data.get("semantic_cache_max_entries")
+        if max_entries is None or max_entries == "":
+            return 100
+
+        return int(max_entries)
+
+    def load_semantic_cache_ttl_seconds(self) -> float:
+        """
+        Load how long the semantic cache serves a response before the model is asked again.
+
+        Returns:
+            float: The time to live of cached responses in seconds, one day by default.
+        """
+        ttl_seconds = self.data.get("semantic_cache_ttl_seconds")
+        if ttl_seconds is None or ttl_seconds == "":
+            return 24 * 60 * 60
+
+        return float(ttl_seconds)
+
+    def load_model_routing_enabled(self) -> bool:
+        """
+        Load whether chat requests fail over to equivalent models (with the same tier) when their model fails.
+
+        Returns:
+            bool: True if requests are routed between the models of a tier, False by default.
+        """
+        enabled = self.data.get("model_routing_enabled")
+        return str(enabled).lower() == "true"
+
+    def load_model_hedging_percentile(self) -> float:
+        """
+        Load after which percentile of a model's recent times to first token a request is also sent to
+        another model of its tier.
+
+        Returns:
+            float: The percentile (e.g. 95), or None if requests are not hedged.
+        """
+        percentile = self.data.get("model_hedging_percentile")
+        if percentile is None or percentile == "":
+            return None
+
+        return float(percentile)
+
+    def load_http_pool_options(self) -> dict:
+        """
+        Load the sizes of the connection pools shared by all model and embedding providers.
+
+        Returns:
+            dict: The configured max_connections, max_keepalive_connections and keepalive_expiry_seconds,
+            without the ones that are not set.
+        """
+        options = {
+            "max_connections": (self.data.get("http_max_connections"), int),
+            "max_keepalive_connections": (
+                self.data.get("http_max_keepalive_connections"),
+                int,
+            ),
+            "keepalive_expiry_seconds": (
+                self.data.get("http_keepalive_expiry_seconds"),
+                float,
+            ),
+        }
+        return {
+            option: parse(value)
+            for option, (value, parse) in options.items()
+            if value is not None and value != ""
+        }
+
+    def load_http_warm_up_enabled(self) -> bool:
+        """
+        Load whether connections to the providers of the enabled models are opened at startup.
+
+        Returns:
+            bool: True if connections are warmed up, False by default.
+        """
+        enabled = self.data.get("http_warm_up_enabled")
+        return str(enabled).lower() == "true"
+
+    def load_conversation_token_budget(self) -> int:
+        """
+        Load how many tokens of a conversation are sent to models that have no `prompt_token_budget` of their own.
+
+        Returns:
+            int: The token budget, or None if conversations are always sent in full.
+        """
+        budget = self.data.get("conversation_token_budget")
+        if budget is None or budget == "":
+            return None
+
+        return int(budget)
+
+    def load_stream_coalescing_options(self) -> dict:
+        """
+        Load how the chunks of streamed answers are combined before they are sent to the client.
+
+        Returns:
+            dict: The window_ms after which combined chunks are sent, and their max_chars (1024 by default),
+            or None if every chunk is sent as it arrives.
+        """
+        window_ms = self.data.get("stream_coalescing_window_ms")
+        if window_ms is None or window_ms == "":
+            return None
+
+        max_chars = self.data.get("stream_coalescing_max_chars")
+        return {
+            "window_ms": float(window_ms),
+            "max_chars": 1024
+            if max_chars is None or max_chars == ""
+            else int(max_chars),
+        }
+
+    def load_chat_session_store(self) -> str:
+        """
+        Load where chat sessions are kept.
+
+        Returns:
+            str: sqlite:<path> or the URL of a session store service, or None if sessions are kept in memory.
+        """
+        store = self.data.get("chat_session_store")
+        return store or None
+
+    def load_chat_session_store_token(self) -> str:
+        """
+        Load the token to authenticate with the chat session store service.
+
+        Returns:
+            str: The shared secret token, or None if it is not configured.
+        """
+        token = self.data.get("chat_session_store_token")
+        return token or None
+
     def load_enabled_providers(self) -> List[str]:
         """
         Load the enabled providers from the specified YAML configuration file.
@@ -288,7 +560,7 @@ def _resolve_config_list_values(config, key, value):
 
 
 def _replace_by_env_var(value):
-    if value is not None and value.startswith("${") and value.endswith("}"):
+    if isinstance(value, str) and value.startswith("${") and value.endswith("}"):
         env_variable = value[2:-1]
         return os.environ.get(env_variable, "")
     else:
@@ -1,12 +1,16 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import os
+import pickle
 
+import numpy as np
 import tiktoken
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import BedrockEmbeddings, OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.faiss import dependable_faiss_import
 from langchain_openai import AzureOpenAIEmbeddings, OpenAIEmbeddings
 from embeddings.model import EmbeddingModel
+from llms.http_clients import HttpClients
 
 
 class EmbeddingsClient:
@@ -67,6 +71,7 @@ class EmbeddingsClient:
         return OpenAIEmbeddings(
             model=self.embedding_model.config.get("model"),
             api_key=self.embedding_model.config.get("api_key"),
+            http_client=HttpClients.get().client(),
         )
 
     def _is_valid_azure_config(self) -> bool:
@@ -86,6 +91,7 @@ class EmbeddingsClient:
             azure_endpoint=self.embedding_model.config.get("azure_endpoint"),
             api_version=self.embedding_model.config.get("api_version"),
             azure_deployment=self.embedding_model.config.get("azure_deployment"),
+            http_client=HttpClients.get().client(),
         )
 
     def _validate_config_key(self, key: str):
@@ -97,6 +103,9 @@ class EmbeddingsClient:
         tokens = tokenizer.encode(text, disallowed_special=())
         return len(tokens)
 
+    def embed_query(self, text: str) -> list[float]:
+        return self.__embeddings_provider.embed_query(text)
+
     def generate_from_documents(self, text, metadata):
         chunks = self.__text_splitter.create_documents(text, metadatas=metadata)
         return FAISS.from_documents(chunks, self.__embeddings_provider)
@@ -107,3 +116,18 @@ class EmbeddingsClient:
             embeddings=self.__embeddings_provider,
             allow_dangerous_deserialization=True,
         )
+
+    def generate_from_bytes(self, vectors, chunks):
+        """
+        Same as generate_from_filesystem, for the content of index.faiss (vectors)
+        and index.pkl (chunks) that was already read into memory, e.g. from a knowledge pack bundle.
+        """
+        faiss = dependable_faiss_import()
+        index = faiss.deserialize_index(np.frombuffer(vectors, dtype=np.uint8))
+        docstore, index_to_docstore_id = pickle.loads(chunks)
+        return FAISS(
+            embedding_function=self.__embeddings_provider,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+        )
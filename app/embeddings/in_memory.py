@@ -11,6 +11,9 @@ class InMemoryEmbeddingsDB:
     def add_embedding(self, key: str, embedding: KnowledgeDocument):
         self._embeddings[key] = embedding
 
+    def remove_embedding(self, key: str):
+        self._embeddings.pop(key, None)
+
     def get_document(self, key: str) -> KnowledgeDocument:
         return self._embeddings.get(key, None)
 
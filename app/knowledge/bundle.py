@@ -0,0 +1,209 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import hashlib
+import json
+import mmap
+import os
+import struct
+from typing import List
+
+import frontmatter
+
+from knowledge.pack import KnowledgePackError
+from knowledge.pack_files import PackFileReader
+
+BUNDLE_MAGIC = b"HAIVENKP"
+BUNDLE_FORMAT_VERSION = 1
+# magic, format version, manifest length, sha256 of the manifest
+BUNDLE_HEADER = struct.Struct("<8sIQ32s")
+
+
+class KnowledgePackBundle:
+    """
+    A knowledge pack compiled into a single file with `haiven-cli compile-pack`.
+
+    The file is mapped into memory once. The manifest holds the parsed frontmatter and content of
+    all markdown files, the embeddings indexes are read from the vector and chunk segments
+    that follow it. Paths are resolved relative to the knowledge pack folder the bundle was compiled from.
+    """
+
+    def __init__(self, bundle_path: str, knowledge_pack_path: str):
+        self.bundle_path = bundle_path
+        self.knowledge_pack_path = os.path.abspath(knowledge_pack_path)
+
+        with open(bundle_path, "rb") as file:
+            self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._data) < BUNDLE_HEADER.size:
+            raise KnowledgePackError(f"Not a knowledge pack bundle: {bundle_path}")
+        magic, version, manifest_length, manifest_checksum = BUNDLE_HEADER.unpack_from(
+            self._data
+        )
+        if magic != BUNDLE_MAGIC:
+            raise KnowledgePackError(f"Not a knowledge pack bundle: {bundle_path}")
+        if version != BUNDLE_FORMAT_VERSION:
+            raise KnowledgePackError(
+                f"Unsupported knowledge pack bundle version {version} in {bundle_path}, please compile it again"
+            )
+
+        manifest_bytes = self._data[
+            BUNDLE_HEADER.size : BUNDLE_HEADER.size + manifest_length
+        ]
+        if hashlib.sha256(manifest_bytes).digest() != manifest_checksum:
+            raise KnowledgePackError(
+                f"Knowledge pack bundle {bundle_path} is corrupted (manifest checksum mismatch)"
+            )
+
+        self.manifest = json.loads(manifest_bytes)
+        self._segments_offset = BUNDLE_HEADER.size + manifest_length
+        self._directories = set(self.manifest["directories"])
+
+    def relative_path(self, path: str) -> str:
+        """
+        Returns the path inside the bundle for a file system path, or None if it is outside of the knowledge pack.
+        """
+        relative_path = os.path.relpath(os.path.abspath(path), self.knowledge_pack_path)
+        if relative_path.startswith(".."):
+            return None
+        return "" if relative_path == "." else relative_path.replace(os.sep, "/")
+
+    def is_directory(self, relative_path: str) -> bool:
+        return relative_path == "" or relative_path in self._directories
+
+    def contains(self, relative_path: str) -> bool:
+        return (
+            self.is_directory(relative_path)
+            or relative_path in self.manifest["files"]
+            or relative_path in self.manifest["texts"]
+            or relative_path in self.manifest["indexes"]
+        )
+
+    def list_directories(self, relative_path: str) -> List[str]:
+        return sorted(
+            directory.rsplit("/", 1)[-1]
+            for directory in self._directories
+            if _parent(directory) == relative_path
+        )
+
+    def list_markdown_files(self, relative_path: str) -> List[str]:
+        return sorted(
+            file_path.rsplit("/", 1)[-1]
+            for file_path in self.manifest["files"]
+            if _parent(file_path) == relative_path
+        )
+
+    def get_markdown(self, relative_path: str) -> dict:
+        return self.manifest["files"].get(relative_path)
+
+    def get_text(self, relative_path: str) -> str:
+        return self.manifest["texts"].get(relative_path)
+
+    def read_index(self, relative_path: str) -> tuple[memoryview, memoryview]:
+        """
+        Returns the vectors (index.faiss) and chunks (index.pkl) of an embeddings index, without copying them.
+        """
+        index = self.manifest["indexes"][relative_path]
+        return self._read_segment(index["vectors"]), self._read_segment(index["chunks"])
+
+    def _read_segment(self, segment: dict) -> memoryview:
+        start = self._segments_offset + segment["offset"]
+        content = memoryview(self._data)[start : start + segment["length"]]
+        if hashlib.sha256(content).hexdigest() != segment["sha256"]:
+            raise KnowledgePackError(
+                f"Knowledge pack bundle {self.bundle_path} is corrupted (segment checksum mismatch)"
+            )
+        return content
+
+
+class BundlePackFileReader(PackFileReader):
+    """
+    Serves knowledge pack files from a compiled bundle instead of the file system.
+    Files outside of the bundled knowledge pack (e.g. the built-in guided prompts) are still read from disk.
+    """
+
+    def __init__(self, bundle: KnowledgePackBundle, **kwargs):
+        super().__init__(**kwargs)
+        self.bundle = bundle
+
+    def list_markdown_files(self, directory: str) -> List[str]:
+        relative_path = self.bundle.relative_path(directory)
+        if relative_path is None:
+            return super().list_markdown_files(directory)
+        return [
+            os.path.join(directory, file_name)
+            for file_name in self.bundle.list_markdown_files(relative_path)
+        ]
+
+    def list_directories(self, directory: str) -> List[str]:
+        relative_path = self.bundle.relative_path(directory)
+        if relative_path is None:
+            return super().list_directories(directory)
+        return self.bundle.list_directories(relative_path)
+
+    def exists(self, path: str) -> bool:
+        relative_path = self.bundle.relative_path(path)
+        if relative_path is None:
+            return super().exists(path)
+        return self.bundle.contains(relative_path)
+
+    def read_text(self, path: str) -> str:
+        relative_path = self.bundle.relative_path(path)
+        if relative_path is None:
+            return super().read_text(path)
+
+        text = self.bundle.get_text(relative_path)
+        if text is None:
+            raise FileNotFoundError(f"{path} is not part of the knowledge pack bundle")
+        return text
+
+    def _index_key(self, kb_path: str) -> str:
+        # Bundles have the checksums of their indexes in the manifest, so the same index is shared across bundles
+        relative_path = self.bundle.relative_path(kb_path)
+        if relative_path is None:
+            return super()._index_key(kb_path)
+
+        index = self.bundle.manifest["indexes"].get(relative_path)
+        if index is None:
+            raise FileNotFoundError(
+                f"{kb_path} is not part of the knowledge pack bundle"
+            )
+        return hashlib.sha256(
+            (index["vectors"]["sha256"] + index["chunks"]["sha256"]).encode("utf-8")
+        ).hexdigest()
+
+    def _read_index(self, kb_path: str, embeddings_client):
+        relative_path = self.bundle.relative_path(kb_path)
+        if relative_path is None:
+            return super()._read_index(kb_path, embeddings_client)
+
+        vectors, chunks = self.bundle.read_index(relative_path)
+        return embeddings_client.generate_from_bytes(vectors, chunks)
+
+    def load_all(self, paths: List[str]) -> List[frontmatter.Post]:
+        posts = [None] * len(paths)
+        paths_on_disk = []
+        for index, path in enumerate(paths):
+            relative_path = self.bundle.relative_path(path)
+            if relative_path is None:
+                paths_on_disk.append(index)
+                continue
+
+            markdown = self.bundle.get_markdown(relative_path)
+            if markdown is None:
+                raise FileNotFoundError(
+                    f"{path} is not part of the knowledge pack bundle"
+                )
+            # Manifest entries are shared, so every caller gets its own copy, like from the file cache
+            posts[index] = self._copy(
+                self._create_post(markdown["content"], markdown["metadata"])
+            )
+
+        if paths_on_disk:
+            loaded = super().load_all([paths[index] for index in paths_on_disk])
+            for index, post in zip(paths_on_disk, loaded):
+                posts[index] = post
+
+        return posts
+
+
+def _parent(relative_path: str) -> str:
+    return relative_path.rsplit("/", 1)[0] if "/" in relative_path else ""
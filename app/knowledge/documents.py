@@ -3,13 +3,13 @@ import os
 from pathlib import Path
 from typing import List, Tuple
 
-import frontmatter
 from langchain.docstore.document import Document
 from langchain_community.vectorstores import FAISS
 from embeddings.client import EmbeddingsClient
 from embeddings.documents import KnowledgeDocument
 from config_service import ConfigService
 from embeddings.in_memory import InMemoryEmbeddingsDB
+from knowledge.pack_files import PackFileReader
 
 
 class KnowledgeBaseDocuments:
@@ -23,12 +23,11 @@ class KnowledgeBaseDocuments:
         _embeddings_provider (Embeddings): The provider used for generating embeddings.
     """
 
-    _document_stores: dict[str, InMemoryEmbeddingsDB] = None
-
     def __init__(
         self,
         config_service: ConfigService,
         embeddings_provider: EmbeddingsClient = None,
+        pack_file_reader: PackFileReader = None,
     ):
         if embeddings_provider is None:
             embedding_model = config_service.load_embedding_model()
@@ -36,9 +35,15 @@ class KnowledgeBaseDocuments:
         else:
             self._embeddings_provider = embeddings_provider
 
-        if self._document_stores is None:
-            self._document_stores = {}
-            self._document_stores["base"] = InMemoryEmbeddingsDB()
+        self._pack_file_reader = pack_file_reader or PackFileReader.default()
+
+        # Stores belong to this instance, so knowledge packs loaded side by side stay isolated
+        self._document_stores: dict[str, InMemoryEmbeddingsDB] = {
+            "base": InMemoryEmbeddingsDB()
+        }
+
+        # markdown file path => (context, document key, embeddings index path)
+        self._loaded_document_paths: dict[str, Tuple[str, str, str]] = {}
 
     def load_documents_for_base(self, knowledge_pack_path: str) -> None:
         """
@@ -59,6 +64,49 @@ class KnowledgeBaseDocuments:
         """
         self._load_documents(path=context_path, name=context_name)
 
+    def reload_document(self, document_path: str, context: str) -> None:
+        """
+        (Re-)loads a single document and its embeddings index, replacing the previously loaded version in one step.
+        Used when a knowledge pack changes while the application is running.
+
+        Parameters:
+            document_path (str): The file system path to the markdown file describing the document.
+            context (str): The name of the context the document belongs to ("base" for the base embeddings).
+        """
+        previous = self._loaded_document_paths.pop(os.path.abspath(document_path), None)
+        self._load_document_into_store(document_path=document_path, context=context)
+
+        current = self._loaded_document_paths.get(os.path.abspath(document_path))
+        if previous is not None and (current is None or previous[:2] != current[:2]):
+            self._remove_from_store(previous[0], previous[1])
+
+    def remove_document(self, document_path: str) -> None:
+        """
+        Removes a previously loaded document, e.g. after its markdown file was deleted from the knowledge pack.
+
+        Parameters:
+            document_path (str): The file system path to the markdown file describing the document.
+        """
+        loaded = self._loaded_document_paths.pop(os.path.abspath(document_path), None)
+        if loaded is not None:
+            self._remove_from_store(loaded[0], loaded[1])
+
+    def get_document_paths_for_index(self, kb_path: str) -> List[str]:
+        """
+        Returns the markdown files of all loaded documents that are backed by the given embeddings index folder.
+        """
+        kb_path = os.path.abspath(kb_path)
+        return [
+            document_path
+            for document_path, (_, _, index_path) in self._loaded_document_paths.items()
+            if index_path == kb_path
+        ]
+
+    def _remove_from_store(self, context: str, key: str) -> None:
+        store = self._document_stores.get(context)
+        if store is not None:
+            store.remove_embedding(key)
+
     def get_document(self, document_key: str) -> KnowledgeDocument:
         """
         Retrieves a specific document embedding by its key. This method is useful for accessing the embedding of a previously loaded or generated document.
@@ -110,32 +158,34 @@ class KnowledgeBaseDocuments:
         return self._document_stores[context]
 
     def _get_retriever_from_file(self, kb_path: str) -> FAISS:
-        path = Path(kb_path)
-
-        faiss = self._embeddings_provider.generate_from_filesystem(path)
-
-        return faiss
+        return self._pack_file_reader.load_index(kb_path, self._embeddings_provider)
 
     def _load_documents(self, path: str, name: str) -> None:
-        if not os.path.exists(path):
+        if not self._pack_file_reader.exists(path):
             raise FileNotFoundError(
                 f"The specified path does not exist, no embeddings will be loaded: {path}"
             )
 
-        knowledge_document_files = sorted(
-            [f for f in os.listdir(path) if f.endswith(".md") and f != "README.md"]
+        knowledge_document_paths = self._pack_file_reader.list_markdown_files(path)
+        knowledge_document_files = self._pack_file_reader.load_all(
+            knowledge_document_paths
         )
 
         if knowledge_document_files is not None:
             self._document_stores[name] = InMemoryEmbeddingsDB()
 
-        for knowledge_document_file in knowledge_document_files:
+        for document_path, document in zip(
+            knowledge_document_paths, knowledge_document_files
+        ):
             self._load_document_into_store(
-                document_path=os.path.join(path, knowledge_document_file), context=name
+                document_path=document_path, context=name, document=document
             )
 
-    def _load_document_into_store(self, document_path: str, context: str) -> None:
-        document = frontmatter.load(document_path)
+    def _load_document_into_store(
+        self, document_path: str, context: str, document=None
+    ) -> None:
+        if document is None:
+            document = self._pack_file_reader.load(document_path)
         if (
             document.metadata.get("provider").lower()
             == self._embeddings_provider.embedding_model.provider.lower()
@@ -157,6 +207,11 @@ class KnowledgeBaseDocuments:
             store_for_context = self._get_or_create_embeddings_db_for_context(context)
 
             store_for_context.add_embedding(knowledge_document.key, knowledge_document)
+            self._loaded_document_paths[os.path.abspath(document_path)] = (
+                context,
+                knowledge_document.key,
+                os.path.abspath(kb_full_path),
+            )
 
     def similarity_search_with_scores(
         self, query: str, context: str, k: int = 5, score_threshold: float = None
@@ -1,7 +1,5 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
-import os
-
-import frontmatter
+from knowledge.pack_files import PackFileReader
 
 
 class KnowledgeMarkdown:
@@ -13,17 +11,14 @@ class KnowledgeMarkdown:
 class KnowledgeBaseMarkdown:
     _knowledge: dict[str, list[KnowledgeMarkdown]]
 
-    def __init__(self):
+    def __init__(self, pack_file_reader: PackFileReader = None):
         self._knowledge = {}
+        self._pack_file_reader = pack_file_reader or PackFileReader.default()
 
     def _load_context(self, path: str) -> list[KnowledgeMarkdown]:
-        knowledge_files = sorted(
-            [f for f in os.listdir(path) if f.endswith(".md") and f != "README.md"]
+        file_contents = self._pack_file_reader.load_all(
+            self._pack_file_reader.list_markdown_files(path)
         )
-        file_contents = [
-            frontmatter.load(os.path.join(path, filename))
-            for filename in knowledge_files
-        ]
 
         context_content = []
 
@@ -36,7 +31,7 @@ class KnowledgeBaseMarkdown:
         return context_content
 
     def load_for_base(self, path: str):
-        if not os.path.exists(path):
+        if not self._pack_file_reader.exists(path):
             raise FileNotFoundError(
                 f"The specified path does not exist, no knowledge will be loaded: {path}"
             )
@@ -45,7 +40,7 @@ class KnowledgeBaseMarkdown:
         self._knowledge["base"] = base_content
 
     def load_for_context(self, context: str, path: str):
-        if not os.path.exists(path):
+        if not self._pack_file_reader.exists(path):
             raise FileNotFoundError(
                 f"The specified path does not exist, no knowledge will be loaded: {path}"
             )
@@ -53,6 +48,9 @@ class KnowledgeBaseMarkdown:
         context_content = self._load_context(path)
         self._knowledge[context] = context_content
 
+    def remove_context(self, context: str):
+        self._knowledge.pop(context, None)
+
     def get_knowledge_document(
         self, context: str, knowledge_key: str
     ) -> KnowledgeMarkdown:
@@ -2,6 +2,8 @@
 import os
 from typing import List
 
+from knowledge.pack_files import PackFileReader
+
 
 class KnowledgePackError(Exception):
     def __init__(self, message):
@@ -24,10 +26,44 @@ class KnowledgeContext:
         )
 
 
+class KnowledgePackSource:
+    """
+    Where to load one of several knowledge packs served by the same instance from,
+    and which user groups it is selected for.
+    """
+
+    def __init__(
+        self,
+        id: str,
+        path: str,
+        bundle_path: str = None,
+        groups: List[str] = None,
+    ):
+        self.id = id
+        self.path = path
+        self.bundle_path = bundle_path
+        self.groups = groups or []
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            id=data.get("id"),
+            path=data.get("path"),
+            bundle_path=data.get("bundle_path") or None,
+            groups=data.get("groups"),
+        )
+
+
 class KnowledgePack:
-    def __init__(self, path: str, contexts: List[KnowledgeContext] = []):
+    def __init__(
+        self,
+        path: str,
+        contexts: List[KnowledgeContext] = [],
+        pack_file_reader: PackFileReader = None,
+    ):
         self.path = path
         self.contexts: List[KnowledgeContext] = contexts
+        self._pack_file_reader = pack_file_reader or PackFileReader.default()
 
         if len(self.contexts) == 0:
             self._auto_discovery_contexts()
@@ -35,12 +71,8 @@ class KnowledgePack:
     def _auto_discovery_contexts(self):
         context_path = os.path.join(self.path, "contexts")
 
-        if os.path.exists(context_path):
-            context_folders = [
-                folder
-                for folder in os.listdir(context_path)
-                if os.path.isdir(os.path.join(context_path, folder))
-            ]
+        if self._pack_file_reader.exists(context_path):
+            context_folders = self._pack_file_reader.list_directories(context_path)
             self.contexts = [
                 KnowledgeContext(
                     name=folder,
@@ -0,0 +1,210 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import copy
+import hashlib
+import json
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List
+
+import frontmatter
+
+
+class PackFileReader:
+    """
+    Reads the markdown files of a knowledge pack (prompts, context snippets, document descriptions)
+    and parses their frontmatter.
+
+    Parsed files are cached by path, modification time and size, so reloading a folder
+    only re-parses the files that actually changed. If a cache directory is given, parsed results
+    are also persisted there and reused across restarts.
+    Callers always get their own copy of a parsed file, so they can safely modify its metadata.
+    """
+
+    __default_instance = None
+
+    # Loaded embeddings indexes by embeddings model and content, shared by all readers.
+    # An index is dropped once no loaded knowledge pack uses it anymore.
+    _shared_indexes = weakref.WeakValueDictionary()
+    _shared_indexes_lock = threading.Lock()
+
+    def __init__(self, cache_dir: str = None, max_workers: int = 8):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self._cache: dict[str, tuple[tuple[int, int], frontmatter.Post]] = {}
+        self._lock = threading.Lock()
+
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def default() -> "PackFileReader":
+        if PackFileReader.__default_instance is None:
+            PackFileReader.__default_instance = PackFileReader()
+        return PackFileReader.__default_instance
+
+    def list_markdown_files(self, directory: str) -> List[str]:
+        """
+        Returns the paths of all markdown files in a directory, sorted by file name, excluding READMEs.
+        """
+        return [
+            os.path.join(directory, filename)
+            for filename in sorted(os.listdir(directory))
+            if filename.endswith(".md") and filename != "README.md"
+        ]
+
+    def list_directories(self, directory: str) -> List[str]:
+        """
+        Returns the names of all sub-folders of a directory, sorted by name.
+        """
+        return [
+            name
+            for name in sorted(os.listdir(directory))
+            if os.path.isdir(os.path.join(directory, name))
+        ]
+
+    def exists(self, path: str) -> bool:
+        return os.path.exists(path)
+
+    def read_text(self, path: str) -> str:
+        with open(path, "r") as file:
+            return file.read()
+
+    def load_index(self, kb_path: str, embeddings_client):
+        """
+        Loads the embeddings index (index.faiss and index.pkl) in the given .kb folder.
+        An index is only loaded once while its files are unchanged, even if several knowledge packs use it.
+        """
+        key = (embeddings_client.embedding_model.id, self._index_key(kb_path))
+        with PackFileReader._shared_indexes_lock:
+            index = PackFileReader._shared_indexes.get(key)
+
+        if index is None:
+            index = self._read_index(kb_path, embeddings_client)
+            try:
+                with PackFileReader._shared_indexes_lock:
+                    PackFileReader._shared_indexes[key] = index
+            except TypeError:
+                # Objects that cannot be referenced weakly are simply not shared
+                pass
+        return index
+
+    def _index_key(self, kb_path: str) -> tuple:
+        # The files are not read just to find out whether they are already loaded
+        return tuple(
+            (os.path.realpath(path), *self._file_key(path))
+            for path in [
+                os.path.join(kb_path, file_name)
+                for file_name in ["index.faiss", "index.pkl"]
+            ]
+        )
+
+    def _read_index(self, kb_path: str, embeddings_client):
+        return embeddings_client.generate_from_filesystem(Path(kb_path))
+
+    def load(self, path: str) -> frontmatter.Post:
+        return self.load_all([path])[0]
+
+    def load_all(self, paths: List[str]) -> List[frontmatter.Post]:
+        """
+        Parses the given files, in parallel for those that are not cached yet, and returns them in the same order.
+        """
+        file_keys = [self._file_key(path) for path in paths]
+        posts = [self._get_cached(path, key) for path, key in zip(paths, file_keys)]
+
+        missing = [index for index, post in enumerate(posts) if post is None]
+        if len(missing) > 1 and self.max_workers > 1:
+            with ThreadPoolExecutor(
+                max_workers=min(self.max_workers, len(missing))
+            ) as executor:
+                parsed = list(executor.map(lambda i: self._parse(paths[i]), missing))
+        else:
+            parsed = [self._parse(paths[index]) for index in missing]
+
+        for index, post in zip(missing, parsed):
+            self._put_cached(paths[index], file_keys[index], post)
+            posts[index] = post
+
+        return [self._copy(post) for post in posts]
+
+    def _file_key(self, path: str) -> tuple[int, int]:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _parse(self, path: str) -> frontmatter.Post:
+        return frontmatter.load(path)
+
+    def _copy(self, post: frontmatter.Post) -> frontmatter.Post:
+        return self._create_post(post.content, copy.deepcopy(post.metadata))
+
+    def _create_post(self, content: str, metadata: dict) -> frontmatter.Post:
+        post = frontmatter.Post(content)
+        post.metadata = metadata
+        return post
+
+    def _get_cached(self, path: str, file_key: tuple[int, int]) -> frontmatter.Post:
+        cache_key = os.path.abspath(path)
+        with self._lock:
+            cached = self._cache.get(cache_key)
+        if cached is not None and cached[0] == file_key:
+            return cached[1]
+
+        post = self._read_from_disk_cache(cache_key, file_key)
+        if post is not None:
+            with self._lock:
+                self._cache[cache_key] = (file_key, post)
+        return post
+
+    def _put_cached(
+        self, path: str, file_key: tuple[int, int], post: frontmatter.Post
+    ) -> None:
+        cache_key = os.path.abspath(path)
+        with self._lock:
+            self._cache[cache_key] = (file_key, post)
+        self._write_to_disk_cache(cache_key, file_key, post)
+
+    def _disk_cache_path(self, cache_key: str) -> str:
+        file_name = hashlib.sha256(cache_key.encode("utf-8")).hexdigest() + ".json"
+        return os.path.join(self.cache_dir, file_name)
+
+    def _read_from_disk_cache(
+        self, cache_key: str, file_key: tuple[int, int]
+    ) -> frontmatter.Post:
+        if not self.cache_dir:
+            return None
+
+        try:
+            with open(self._disk_cache_path(cache_key), "r") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+
+        if entry.get("path") != cache_key or tuple(entry.get("key", [])) != file_key:
+            return None
+        return self._create_post(entry["content"], entry["metadata"])
+
+    def _write_to_disk_cache(
+        self, cache_key: str, file_key: tuple[int, int], post: frontmatter.Post
+    ) -> None:
+        if not self.cache_dir:
+            return
+
+        entry = {
+            "path": cache_key,
+            "key": list(file_key),
+            "metadata": post.metadata,
+            "content": post.content,
+        }
+        cache_path = self._disk_cache_path(cache_key)
+        try:
+            # Write to a temporary file first, so that parallel workers never read half-written entries
+            temporary_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "w") as file:
+                json.dump(entry, file)
+            os.replace(temporary_path, cache_path)
+        except (OSError, TypeError, ValueError):
+            # Metadata that cannot be stored as JSON is only cached in memory
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
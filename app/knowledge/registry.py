@@ -0,0 +1,250 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, List
+
+from disclaimer_and_guidelines import DisclaimerAndGuidelinesService
+from knowledge.pack import KnowledgePackError, KnowledgePackSource
+from knowledge_manager import KnowledgeManager
+from logger import HaivenLogger
+from prompts.prompts import PromptList
+
+DEFAULT_KNOWLEDGE_PACK_ID = "default"
+
+_selected_knowledge_pack: ContextVar[str] = ContextVar(
+    "selected_knowledge_pack", default=DEFAULT_KNOWLEDGE_PACK_ID
+)
+
+
+def selected_knowledge_pack_id() -> str:
+    """
+    The id of the knowledge pack selected for the current request, see `KnowledgePackRegistry.selected`.
+    """
+    return _selected_knowledge_pack.get()
+
+
+class LoadedKnowledgePack:
+    """
+    Everything that is loaded from one knowledge pack: its knowledge, its prompts and its disclaimer.
+    """
+
+    def __init__(
+        self,
+        knowledge_manager: KnowledgeManager,
+        prompts_chat: PromptList,
+        prompts_guided: PromptList,
+        disclaimer_and_guidelines: DisclaimerAndGuidelinesService,
+    ):
+        self.knowledge_manager = knowledge_manager
+        self.prompts_chat = prompts_chat
+        self.prompts_guided = prompts_guided
+        self.disclaimer_and_guidelines = disclaimer_and_guidelines
+
+
+class CurrentKnowledgePackPart:
+    """
+    Stands in for one part of a knowledge pack (e.g. its KnowledgeManager) in services that are only
+    set up once, and forwards every access to the knowledge pack selected for the current request.
+    """
+
+    def __init__(self, registry: "KnowledgePackRegistry", part: str):
+        self._registry = registry
+        self._part = part
+
+    def __getattr__(self, name):
+        return getattr(getattr(self._registry.current(), self._part), name)
+
+
+class KnowledgePackRegistry:
+    """
+    Serves several knowledge packs from one process. Each request works with the knowledge pack
+    selected for it, and every knowledge pack has its own knowledge, prompts and document stores.
+
+    The default knowledge pack is loaded on startup and always stays loaded. The additional knowledge packs
+    are loaded on first use, and unloaded again when they were not used for `idle_seconds`,
+    or when more than `max_loaded` of them are loaded. Idle knowledge packs are looked for whenever
+    a knowledge pack is used, and by a background thread once `start` is called, for quiet times.
+    """
+
+    HEADER = "X-Knowledge-Pack"
+
+    def __init__(
+        self,
+        default_knowledge_pack: LoadedKnowledgePack,
+        sources: List[KnowledgePackSource],
+        load_knowledge_pack: Callable[[KnowledgePackSource], LoadedKnowledgePack],
+        idle_seconds: float = None,
+        max_loaded: int = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._sources = {source.id: source for source in sources}
+        if DEFAULT_KNOWLEDGE_PACK_ID in self._sources:
+            raise KnowledgePackError(
+                f"`{DEFAULT_KNOWLEDGE_PACK_ID}` is reserved for the default knowledge pack, please use another id"
+            )
+
+        self._default_knowledge_pack = default_knowledge_pack
+        self._load_knowledge_pack = load_knowledge_pack
+        self.idle_seconds = idle_seconds
+        self.max_loaded = max_loaded
+        self._clock = clock
+
+        # knowledge pack id => (loaded knowledge pack, last used)
+        self._loaded: dict[str, tuple[LoadedKnowledgePack, float]] = {}
+        self._lock = threading.Lock()
+        self._loading_locks: dict[str, threading.Lock] = {
+            source_id: threading.Lock() for source_id in self._sources
+        }
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def knowledge_pack_ids(self) -> List[str]:
+        return [DEFAULT_KNOWLEDGE_PACK_ID] + list(self._sources)
+
+    def loaded_knowledge_pack_ids(self) -> List[str]:
+        with self._lock:
+            return [DEFAULT_KNOWLEDGE_PACK_ID] + list(self._loaded)
+
+    def get(self, knowledge_pack_id: str = DEFAULT_KNOWLEDGE_PACK_ID):
+        if knowledge_pack_id == DEFAULT_KNOWLEDGE_PACK_ID:
+            self.unload_unused()
+            return self._default_knowledge_pack
+
+        source = self._sources.get(knowledge_pack_id)
+        if source is None:
+            raise KnowledgePackError(f"Unknown knowledge pack `{knowledge_pack_id}`")
+
+        with self._lock:
+            loaded = self._loaded.get(knowledge_pack_id)
+            if loaded is not None:
+                self._loaded[knowledge_pack_id] = (loaded[0], self._clock())
+        if loaded is not None:
+            self.unload_unused(keep=knowledge_pack_id)
+            return loaded[0]
+
+        # Only one request loads a knowledge pack, the others wait for it
+        with self._loading_locks[knowledge_pack_id]:
+            with self._lock:
+                loaded = self._loaded.get(knowledge_pack_id)
+            if loaded is not None:
+                return loaded[0]
+
+            knowledge_pack = self._load_knowledge_pack(source)
+            HaivenLogger.get().info(f"Loaded knowledge pack {knowledge_pack_id}")
+            with self._lock:
+                self._loaded[knowledge_pack_id] = (knowledge_pack, self._clock())
+            self.unload_unused(keep=knowledge_pack_id)
+            return knowledge_pack
+
+    def unload_unused(self, keep: str = None) -> List[str]:
+        """
+        Unloads the knowledge packs that were idle for too long, and the least recently used ones
+        if too many are loaded. Requests in flight keep the knowledge pack they already work with.
+        """
+        now = self._clock()
+        with self._lock:
+            by_last_use = sorted(self._loaded.items(), key=lambda item: item[1][1])
+            unload = [
+                knowledge_pack_id
+                for knowledge_pack_id, (_, last_used) in by_last_use
+                if self.idle_seconds is not None
+                and now - last_used > self.idle_seconds
+                and knowledge_pack_id != keep
+            ]
+            if self.max_loaded is not None:
+                remaining = [
+                    knowledge_pack_id
+                    for knowledge_pack_id, _ in by_last_use
+                    if knowledge_pack_id not in unload and knowledge_pack_id != keep
+                ]
+                over_limit = len(self._loaded) - len(unload) - self.max_loaded
+                unload.extend(remaining[: max(over_limit, 0)])
+
+            for knowledge_pack_id in unload:
+                del self._loaded[knowledge_pack_id]
+
+        for knowledge_pack_id in unload:
+            HaivenLogger.get().info(
+                f"Unloaded unused knowledge pack {knowledge_pack_id}"
+            )
+        return unload
+
+    def _run(self, interval_seconds: float):
+        while not self._stop_event.wait(interval_seconds):
+            try:
+                self.unload_unused()
+            except Exception as error:
+                HaivenLogger.get().error(
+                    str(error), extra={"ERROR": "KnowledgePackUnloadFailed"}
+                )
+
+    def start(self, interval_seconds: float = None):
+        """
+        Unloads idle knowledge packs in the background, every `interval_seconds` (half of `idle_seconds` by default).
+        """
+        if self.idle_seconds is None or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval_seconds or self.idle_seconds / 2,),
+            name="knowledge-pack-unloader",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def select(self, requested_id: str = None, user_groups: List[str] = None) -> str:
+        """
+        Returns the id of the knowledge pack to use for a request: the requested one if the user may use it,
+        otherwise the first knowledge pack for one of the user's groups, otherwise the default knowledge pack.
+        """
+        user_groups = user_groups or []
+        if requested_id:
+            if requested_id == DEFAULT_KNOWLEDGE_PACK_ID:
+                return requested_id
+
+            source = self._sources.get(requested_id)
+            if source is None:
+                raise KnowledgePackError(f"Unknown knowledge pack `{requested_id}`")
+            if source.groups and not set(source.groups) & set(user_groups):
+                raise PermissionError(
+                    f"Knowledge pack `{requested_id}` is not available for this user"
+                )
+            return requested_id
+
+        for source in self._sources.values():
+            if set(source.groups) & set(user_groups):
+                return source.id
+
+        return DEFAULT_KNOWLEDGE_PACK_ID
+
+    @contextmanager
+    def selected(self, knowledge_pack_id: str):
+        token = _selected_knowledge_pack.set(knowledge_pack_id)
+        try:
+            yield
+        finally:
+            _selected_knowledge_pack.reset(token)
+
+    def current(self) -> LoadedKnowledgePack:
+        return self.get(_selected_knowledge_pack.get())
+
+    def current_knowledge_pack(self) -> LoadedKnowledgePack:
+        """
+        Returns a knowledge pack whose parts always forward to the knowledge pack selected for the current request.
+        """
+        return LoadedKnowledgePack(
+            knowledge_manager=CurrentKnowledgePackPart(self, "knowledge_manager"),
+            prompts_chat=CurrentKnowledgePackPart(self, "prompts_chat"),
+            prompts_guided=CurrentKnowledgePackPart(self, "prompts_guided"),
+            disclaimer_and_guidelines=CurrentKnowledgePackPart(
+                self, "disclaimer_and_guidelines"
+            ),
+        )
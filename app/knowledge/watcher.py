@@ -0,0 +1,208 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+import threading
+from functools import partial
+from typing import Callable, List
+
+from knowledge_manager import KnowledgeManager
+from logger import HaivenLogger
+from prompts.prompts import PromptList
+
+
+class KnowledgePackWatcher:
+    """
+    Polls a knowledge pack folder for added, changed and removed files.
+
+    A change is only reported once two consecutive polls see the same state, so that
+    files which are still being copied (e.g. a large index.faiss) are not picked up halfway.
+    The callback is executed on the watcher's background thread.
+    """
+
+    IGNORED_FOLDERS = ["static", "__pycache__"]
+
+    def __init__(
+        self,
+        knowledge_pack_path: str,
+        on_change: Callable[[List[str]], None],
+        interval_seconds: float = 10,
+    ):
+        self.knowledge_pack_path = knowledge_pack_path
+        self.on_change = on_change
+        self.interval_seconds = interval_seconds
+
+        self._applied_snapshot = self._take_snapshot()
+        self._pending_snapshot = self._applied_snapshot
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _take_snapshot(self) -> dict[str, tuple[int, int]]:
+        snapshot = {}
+        for root, folders, files in os.walk(self.knowledge_pack_path):
+            folders[:] = [
+                folder
+                for folder in folders
+                if not folder.startswith(".") and folder not in self.IGNORED_FOLDERS
+            ]
+            for file in files:
+                if file.startswith("."):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def check_for_changes(self) -> List[str]:
+        """
+        Takes a new snapshot of the knowledge pack and returns the paths that changed since
+        the last reported change, or an empty list if nothing changed or files are still in flux.
+        """
+        snapshot = self._take_snapshot()
+        if snapshot != self._pending_snapshot:
+            self._pending_snapshot = snapshot
+            return []
+
+        if snapshot == self._applied_snapshot:
+            return []
+
+        changed_paths = sorted(
+            path
+            for path in set(snapshot) | set(self._applied_snapshot)
+            if snapshot.get(path) != self._applied_snapshot.get(path)
+        )
+        self._applied_snapshot = snapshot
+        return changed_paths
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            try:
+                changed_paths = self.check_for_changes()
+                if changed_paths:
+                    self.on_change(changed_paths)
+            except Exception as error:
+                HaivenLogger.get().error(
+                    str(error), extra={"ERROR": "KnowledgePackReloadFailed"}
+                )
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="knowledge-pack-watcher", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class KnowledgePackReloader:
+    """
+    Maps changed knowledge pack files to the pieces of knowledge they belong to,
+    and reloads only those. Each piece is swapped in as a whole once it is fully loaded,
+    so requests in flight keep seeing either the old or the new version.
+    """
+
+    def __init__(
+        self,
+        knowledge_manager: KnowledgeManager,
+        prompt_lists: List[PromptList],
+    ):
+        self.knowledge_manager = knowledge_manager
+        self.prompt_lists = prompt_lists
+
+    def on_change(self, changed_paths: List[str]):
+        pack_path = os.path.abspath(
+            self.knowledge_manager.knowledge_pack_definition.path
+        )
+
+        reload_base_markdown = False
+        contexts_to_reload = set()
+        documents_to_reload = set()
+        prompt_lists_to_reload = []
+
+        for path in changed_paths:
+            path = os.path.abspath(path)
+            for prompt_list in self.prompt_lists:
+                if prompt_list.is_loaded_from(path) and (
+                    prompt_list not in prompt_lists_to_reload
+                ):
+                    prompt_lists_to_reload.append(prompt_list)
+
+            parts = os.path.relpath(path, pack_path).split(os.sep)
+            if parts[0] == "embeddings":
+                documents_to_reload.update(
+                    self._affected_documents(pack_path, parts, "base")
+                )
+            elif parts[0] == "contexts" and len(parts) > 2:
+                context_name = self._context_name(parts[1])
+                if parts[2] == "embeddings":
+                    documents_to_reload.update(
+                        self._affected_documents(
+                            os.path.join(pack_path, "contexts", parts[1]),
+                            parts[2:],
+                            context_name,
+                        )
+                    )
+                elif len(parts) == 3 and parts[2].endswith(".md"):
+                    contexts_to_reload.add(parts[1])
+            elif len(parts) == 1 and parts[0].endswith(".md"):
+                reload_base_markdown = True
+
+        if reload_base_markdown:
+            self._reload(
+                "base knowledge", self.knowledge_manager.reload_base_markdown_knowledge
+            )
+        for context_path in sorted(contexts_to_reload):
+            self._reload(
+                f"context {context_path}",
+                partial(
+                    self.knowledge_manager.reload_context_markdown_knowledge,
+                    context_path,
+                ),
+            )
+        for document_path, context_name in sorted(documents_to_reload):
+            self._reload(
+                f"document {document_path}",
+                partial(
+                    self.knowledge_manager.reload_document, document_path, context_name
+                ),
+            )
+        for prompt_list in prompt_lists_to_reload:
+            self._reload(f"prompts in {prompt_list.directory}", prompt_list.reload)
+
+    def _context_name(self, context_path: str) -> str:
+        for context in self.knowledge_manager.knowledge_pack_definition.contexts:
+            if context.path == context_path:
+                return context.name
+        return context_path
+
+    def _affected_documents(self, parent_path: str, parts: List[str], context: str):
+        # parts are relative to parent_path and start with "embeddings"
+        if len(parts) == 2 and parts[1].endswith(".md") and parts[1] != "README.md":
+            return {(os.path.join(parent_path, *parts), context)}
+
+        if len(parts) > 2 and parts[1].endswith(".kb"):
+            kb_path = os.path.join(parent_path, parts[0], parts[1])
+            return {
+                (document_path, context)
+                for document_path in self.knowledge_manager.knowledge_base_documents.get_document_paths_for_index(
+                    kb_path
+                )
+            }
+
+        return set()
+
+    def _reload(self, description: str, reload_fn: Callable[[], None]):
+        try:
+            reload_fn()
+            HaivenLogger.get().info(f"Reloaded {description} from knowledge pack")
+        except Exception as error:
+            HaivenLogger.get().error(
+                f"Could not reload {description}, keeping the previous version: {error}",
+                extra={"ERROR": "KnowledgePackReloadFailed"},
+            )
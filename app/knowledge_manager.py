@@ -1,4 +1,6 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+
 from config_service import ConfigService
 from logger import HaivenLogger
 
@@ -9,14 +11,22 @@ from knowledge.pack import (
     KnowledgePack,
 )
 from knowledge.documents import KnowledgeBaseDocuments
+from knowledge.pack_files import PackFileReader
 
 
 class KnowledgeManager:
-    def __init__(self, config_service: ConfigService):
+    def __init__(
+        self,
+        config_service: ConfigService,
+        pack_file_reader: PackFileReader = None,
+        knowledge_pack_path: str = None,
+    ):
         self._config_service = config_service
+        self._pack_file_reader = pack_file_reader or PackFileReader.default()
 
         self.knowledge_pack_definition = KnowledgePack(
-            config_service.load_knowledge_pack_path()
+            knowledge_pack_path or config_service.load_knowledge_pack_path(),
+            pack_file_reader=self._pack_file_reader,
         )
         self.active_knowledge_context = None
 
@@ -27,7 +37,7 @@ class KnowledgeManager:
         self._load_context_documents_knowledge()
 
     def _load_base_markdown_knowledge(self):
-        knowledge_base_markdown = KnowledgeBaseMarkdown()
+        knowledge_base_markdown = KnowledgeBaseMarkdown(self._pack_file_reader)
         try:
             knowledge_base_markdown.load_for_base(self.knowledge_pack_definition.path)
         except FileNotFoundError as error:
@@ -42,7 +52,9 @@ class KnowledgeManager:
         base_embeddings_path = self.knowledge_pack_definition.path + "/embeddings"
 
         knowledge_base_documents = KnowledgeBaseDocuments(
-            self._config_service, EmbeddingsClient(embedding_model)
+            self._config_service,
+            EmbeddingsClient(embedding_model),
+            pack_file_reader=self._pack_file_reader,
         )
 
         try:
@@ -105,6 +117,34 @@ class KnowledgeManager:
                 },
             )
 
+    def reload_base_markdown_knowledge(self):
+        self.knowledge_base_markdown.load_for_base(self.knowledge_pack_definition.path)
+
+    def reload_context_markdown_knowledge(self, context_path: str):
+        context = next(
+            (
+                context
+                for context in self.knowledge_pack_definition.contexts
+                if context.path == context_path
+            ),
+            None,
+        )
+        if context is None:
+            context = KnowledgeContext(name=context_path, path=context_path)
+            self.knowledge_pack_definition.contexts.append(context)
+
+        full_path = self.knowledge_pack_definition.path + "/contexts/" + context.path
+        if os.path.isdir(full_path):
+            self.knowledge_base_markdown.load_for_context(context.name, path=full_path)
+        else:
+            self.knowledge_base_markdown.remove_context(context.name)
+
+    def reload_document(self, document_path: str, context_name: str = "base"):
+        if os.path.exists(document_path):
+            self.knowledge_base_documents.reload_document(document_path, context_name)
+        else:
+            self.knowledge_base_documents.remove_document(document_path)
+
     def on_context_selected(self, context_name: str) -> str:
         self.active_knowledge_context = context_name
 
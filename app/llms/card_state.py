@@ -0,0 +1,79 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+
+from logger import HaivenLogger
+
+
+class CardState:
+    """
+    The current state of the cards a chat session iterates on, by card id. Every change to a card
+    increases its version and the version of the whole state, so that clients can tell which of
+    their cards are out of date.
+    """
+
+    def __init__(self, cards: list[dict]):
+        self.version = 0
+        self.cards: dict[str, dict] = {}
+        self.versions: dict[str, int] = {}
+        for card in cards:
+            if card.get("id") is None:
+                continue
+            card_id = str(card["id"])
+            self.cards[card_id] = dict(card)
+            self.versions[card_id] = 0
+
+    def to_state(self) -> dict:
+        return {
+            "version": self.version,
+            "cards": list(self.cards.values()),
+            "versions": self.versions,
+        }
+
+    @staticmethod
+    def from_state(state: dict) -> "CardState":
+        card_state = CardState(state["cards"])
+        card_state.version = state["version"]
+        card_state.versions.update(state["versions"])
+        return card_state
+
+    def to_json(self) -> str:
+        return json.dumps(list(self.cards.values()))
+
+    def to_dict(self) -> dict:
+        return {
+            "version": self.version,
+            "cards": [
+                {"version": self.versions[card_id], "data": card}
+                for card_id, card in self.cards.items()
+            ],
+        }
+
+    def apply_patch(self, patch: dict) -> dict:
+        """
+        Merges the changed properties of one card into the state, and returns the patch as it was applied,
+        or None if it does not belong to a known card or changes nothing.
+        """
+        if not isinstance(patch, dict) or patch.get("id") is None:
+            return None
+        card_id = str(patch["id"])
+        card = self.cards.get(card_id)
+        if card is None:
+            HaivenLogger.get().info(f"Ignoring changes to unknown card {card_id}")
+            return None
+
+        changes = {
+            key: value
+            for key, value in patch.items()
+            if key != "id" and card.get(key) != value
+        }
+        if not changes:
+            return None
+        card.update(changes)
+        self.version += 1
+        self.versions[card_id] += 1
+        return {
+            "type": "patch",
+            "id": card["id"],
+            "version": self.versions[card_id],
+            "data": changes,
+        }
@@ -0,0 +1,98 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from collections.abc import MutableSequence
+from itertools import chain
+
+from llms.clients import HaivenMessage
+
+
+class ChatMemory(MutableSequence):
+    """
+    The messages of a chat, as a list that can be forked: a fork shares all messages so far with the chat
+    it was forked from, without copying them, and keeps its own messages from then on. Shared messages are
+    kept in immutable segments, and new ones in a list of their own, so neither side sees the other's changes
+    to the list. The shared message objects themselves must not be changed, only messages of the own tail.
+    """
+
+    def __init__(self, messages: list[HaivenMessage] = None):
+        self._segments: tuple[tuple[HaivenMessage, ...], ...] = ()
+        self._prefix_length = 0
+        self._tail: list[HaivenMessage] = list(messages or [])
+
+    def fork(self) -> "ChatMemory":
+        # The own messages become a segment that this memory and the fork share from now on
+        if self._tail:
+            self._segments += (tuple(self._tail),)
+            self._prefix_length += len(self._tail)
+            self._tail = []
+        fork = ChatMemory()
+        fork._segments = self._segments
+        fork._prefix_length = self._prefix_length
+        return fork
+
+    def segments(self) -> list:
+        """
+        The shared segments and the own tail, e.g. to count shared messages only once across forks.
+        """
+        return [*self._segments, self._tail]
+
+    def _unshare_last(self):
+        # Removing a shared message takes the rest of its segment into the own tail, the others still share it
+        last_segment = self._segments[-1]
+        self._segments = self._segments[:-1]
+        self._prefix_length -= len(last_segment)
+        self._tail = list(last_segment) + self._tail
+
+    def __len__(self) -> int:
+        return self._prefix_length + len(self._tail)
+
+    def __iter__(self):
+        return chain(*self._segments, self._tail)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chat memory index out of range")
+        if index >= self._prefix_length:
+            return self._tail[index - self._prefix_length]
+        for segment in self._segments:
+            if index < len(segment):
+                return segment[index]
+            index -= len(segment)
+
+    def __setitem__(self, index, message):
+        if isinstance(index, slice):
+            raise TypeError("chat memory does not support slice assignment")
+        if index < 0:
+            index += len(self)
+        while index < self._prefix_length:
+            self._unshare_last()
+        self._tail[index - self._prefix_length] = message
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            raise TypeError("chat memory does not support slice deletion")
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chat memory index out of range")
+        while index < self._prefix_length:
+            self._unshare_last()
+        del self._tail[index - self._prefix_length]
+
+    def insert(self, index: int, message: HaivenMessage):
+        if index < 0:
+            index = max(index + len(self), 0)
+        while index < self._prefix_length:
+            self._unshare_last()
+        self._tail.insert(index - self._prefix_length, message)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (ChatMemory, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"ChatMemory({list(self)!r})"
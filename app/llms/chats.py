@@ -1,7 +1,12 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
 import json
+import threading
 import time
 import uuid
+from contextlib import aclosing
+from functools import partial
+from typing import Callable, Optional
 
 from pydantic import BaseModel
 from config_service import ConfigService
@@ -15,20 +20,63 @@ from llms.clients import (
     HaivenSystemMessage,
     ModelConfig,
 )
+from llms.card_state import CardState
+from llms.chat_memory import ChatMemory
+from llms.first_step import FirstStep
+from llms.session_store import (
+    InMemorySessionStore,
+    SessionStore,
+    decode_chat_state,
+    encode_chat_state,
+)
+from llms.json_stream import JSONArrayParser
+from llms.memory_manager import MemoryManager
+from llms.rate_limiter import ModelRateLimiters
+from llms.stream_coalescing import StreamCoalescing
+from llms.usage import UsageAccounting
 from logger import HaivenLogger
 
 
+MESSAGE_TYPES = {
+    "system": HaivenSystemMessage,
+    "user": HaivenHumanMessage,
+    "assistant": HaivenAIMessage,
+}
+
+
+def error_chunk(error) -> str:
+    if not str(error).strip():
+        error = "Error while the model was processing the input"
+    print(f"[ERROR]: {str(error)}")
+    return f"[ERROR]: {str(error)}"
+
+
 class HaivenBaseChat:
     def __init__(
         self,
         chat_client: ChatClient,
         knowledge_manager: KnowledgeManager,
         system_message: str,
+        memory_manager: MemoryManager = None,
+        stream_coalescing: StreamCoalescing = None,
     ):
         self.system = system_message
-        self.memory = [HaivenSystemMessage(content=system_message)]
+        self.memory = ChatMemory([HaivenSystemMessage(content=system_message)])
         self.chat_client = chat_client
+        # Replays cached responses for the calls that ask for it, e.g. the first answer of a guided prompt
+        self.cached_chat_client: ChatClient = None
+        # The client that answered the last turn, which has its usage
+        self._turn_client = chat_client
         self.knowledge_manager = knowledge_manager
+        self.memory_manager = memory_manager
+        self.stream_coalescing = stream_coalescing
+        # Set on the chat of the first step of a multi-step flow, which later steps refer to
+        self.first_step: FirstStep = None
+        # How the ChatManager created the chat, to create it again from its state in another process
+        self.model_id: str = None
+        self.options: "ChatOptions" = None
+        # Called when a turn is finished, e.g. to store the chat where other processes can see it
+        self.on_turn_finished: Callable[[], None] = None
 
     def log_run(self, extra={}):
         class_name = self.__class__.__name__
@@ -40,13 +88,137 @@ class HaivenBaseChat:
 
         HaivenLogger.get().analytics("Sending message", extra_info)
 
+    def messages_for_model(self):
+        if self.memory_manager is None:
+            return self.memory
+        return self.memory_manager.messages_for_model(self.memory)
+
+    def _client_for_turn(self, use_cache: bool = False) -> ChatClient:
+        if use_cache and self.cached_chat_client is not None:
+            self._turn_client = self.cached_chat_client
+        else:
+            self._turn_client = self.chat_client
+        return self._turn_client
+
+    def _last_usage(self) -> dict:
+        return self._turn_client.last_usage
+
+    def _astream_answer(self, use_cache: bool = False):
+        chunks = self._client_for_turn(use_cache).astream(self.messages_for_model())
+        if self.stream_coalescing is None:
+            return chunks
+        return self.stream_coalescing.coalesce(chunks)
+
+    def _after_turn(self):
+        self.memory[-1].finalize()
+        if self.memory_manager is not None and self.memory_manager.needs_compaction(
+            self.memory
+        ):
+            self.memory_manager.compact(self.memory)
+        self._turn_finished()
+
+    async def _abefore_turn(self):
+        if self.memory_manager is not None:
+            await self.memory_manager.wait_for_compaction(self.memory)
+
+    async def _aafter_turn(self, on_usage: Callable[[dict], dict] = None):
+        self.memory[-1].finalize()
+        if self.memory_manager is not None:
+            self.memory_manager.compact_in_background(self.memory, on_usage)
+        if self.on_turn_finished is not None:
+            # Storing the chat can encode it and write it to a file or service, which must not block the event loop
+            await asyncio.to_thread(self.on_turn_finished)
+
+    def _turn_finished(self):
+        if self.on_turn_finished is not None:
+            self.on_turn_finished()
+
+    def _interrupted_turn(self):
+        """
+        Keeps the memory consistent when a turn is abandoned, e.g. because the client disconnected:
+        a partial answer is kept as the answer, a question without any answer yet is forgotten.
+        """
+        answered = isinstance(self.memory[-1], HaivenAIMessage)
+        if not answered and isinstance(self.memory[-1], HaivenHumanMessage):
+            self.memory.pop()
+        self.memory[-1].finalize()
+        HaivenLogger.get().info(
+            "Chat turn interrupted",
+            extra={
+                "chat_type": self.__class__.__name__,
+                "kept_partial_answer": answered,
+            },
+        )
+        if self.on_turn_finished is not None:
+            # Like at the end of a turn, storing the chat must not block the event loop. The abandoned
+            # request does not wait for it, the executor still runs it to the end.
+            asyncio.get_running_loop().run_in_executor(None, self.on_turn_finished)
+
     def memory_as_text(self):
         return "\n".join([str(message) for message in self.memory])
 
+    def to_state(self) -> dict:
+        """
+        What is needed to create the chat again in another process, see ChatManager.restore_chat.
+        """
+        state = {
+            "type": self.__class__.__name__,
+            "model": self.model_id,
+            "options": self.options.model_dump(exclude_none=True)
+            if self.options
+            else None,
+            "messages": [
+                [message.to_json()["role"], message.content] for message in self.memory
+            ],
+        }
+        if self.first_step is not None:
+            state["first_step"] = [
+                self.first_step.prompt_id,
+                self.first_step.user_input,
+                self.first_step.context,
+            ]
+        if self.memory_manager is not None and self.memory_manager.summary:
+            state["summary"] = [
+                self.memory_manager.summary,
+                self.memory_manager.summary_tokens,
+                self.memory_manager.summarized_count,
+            ]
+        return state
+
+    def restore_state(self, state: dict):
+        self.memory = messages_from_state(state)
+        if state.get("first_step"):
+            self.first_step = FirstStep(*state["first_step"])
+        if state.get("summary") and self.memory_manager is not None:
+            (
+                self.memory_manager.summary,
+                self.memory_manager.summary_tokens,
+                self.memory_manager.summarized_count,
+            ) = state["summary"]
+
     def _similarity_query(self, message):
         if len(self.memory) == 1:
             return message
 
+        stream = self.chat_client.stream(self._similarity_query_prompt(message))
+        query = ""
+        for chunk in stream:
+            query += chunk["content"]
+
+        return self._parse_similarity_query(query)
+
+    async def _asimilarity_query(self, message):
+        if len(self.memory) == 1:
+            return message
+
+        stream = self.chat_client.astream(self._similarity_query_prompt(message))
+        query = ""
+        async for chunk in stream:
+            query += chunk["content"]
+
+        return self._parse_similarity_query(query)
+
+    def _similarity_query_prompt(self, message):
         if len(self.memory) > 5:
             conversation = "\n".join(
                 [message.content for message in (self.memory[:2] + self.memory[-4:])]
@@ -69,12 +241,9 @@ class HaivenBaseChat:
         prompt.append(
             HaivenHumanMessage(content=f"Current user message: {message} \n Query:")
         )
+        return prompt
 
-        stream = self.chat_client.stream(prompt)
-        query = ""
-        for chunk in stream:
-            query += chunk["content"]
-
+    def _parse_similarity_query(self, query):
         if "none" in query.lower():
             return None
         elif "query:" in query.lower():
@@ -84,6 +253,18 @@ class HaivenBaseChat:
 
     def _similarity_search_based_on_history(self, message, knowledge_document_key):
         similarity_query = self._similarity_query(message)
+        return self._similarity_search(similarity_query, knowledge_document_key)
+
+    async def _asimilarity_search_based_on_history(
+        self, message, knowledge_document_key
+    ):
+        similarity_query = await self._asimilarity_query(message)
+        # Embedding the query and searching the index block, so they run in a worker thread
+        return await asyncio.to_thread(
+            self._similarity_search, similarity_query, knowledge_document_key
+        )
+
+    def _similarity_search(self, similarity_query, knowledge_document_key):
         print("Similarity Query:", similarity_query)
         if similarity_query is None:
             return None, None
@@ -127,26 +308,62 @@ class StreamingChat(HaivenBaseChat):
         knowledge_manager: KnowledgeManager,
         system_message: str = "You are a helpful assistant",
         stream_in_chunks: bool = False,
+        memory_manager: MemoryManager = None,
+        stream_coalescing: StreamCoalescing = None,
     ):
-        super().__init__(chat_client, knowledge_manager, system_message)
+        super().__init__(
+            chat_client,
+            knowledge_manager,
+            system_message,
+            memory_manager,
+            stream_coalescing,
+        )
         self.stream_in_chunks = stream_in_chunks
 
     def run(self, message: str, user_query: str = None):
         self.memory.append(HaivenHumanMessage(content=message))
         try:
-            for i, chunk in enumerate(self.chat_client.stream(self.memory)):
-                if i == 0:
-                    if user_query:
-                        self.memory[-1].content = user_query
-                    self.memory.append(HaivenAIMessage(content=""))
-                self.memory[-1].content += chunk["content"]
+            for i, chunk in enumerate(
+                self.chat_client.stream(self.messages_for_model())
+            ):
+                self._add_to_answer(chunk["content"], i == 0, user_query)
                 yield chunk["content"]
+            self._after_turn()
+
+        except Exception as error:
+            yield error_chunk(error)
+
+    async def arun(
+        self,
+        message: str,
+        user_query: str = None,
+        on_usage: Callable[[dict], dict] = None,
+    ):
+        self.memory.append(HaivenHumanMessage(content=message))
+        try:
+            await self._abefore_turn()
+            is_first_chunk = True
+            async with aclosing(self._astream_answer()) as stream:
+                async for chunk in stream:
+                    self._add_to_answer(chunk["content"], is_first_chunk, user_query)
+                    is_first_chunk = False
+                    yield chunk["content"]
+            if on_usage is not None and self._last_usage() is not None:
+                on_usage(self._last_usage())
+            await self._aafter_turn(on_usage)
 
+        except (asyncio.CancelledError, GeneratorExit):
+            self._interrupted_turn()
+            raise
         except Exception as error:
-            if not str(error).strip():
-                error = "Error while the model was processing the input"
-            print(f"[ERROR]: {str(error)}")
-            yield f"[ERROR]: {str(error)}"
+            yield error_chunk(error)
+
+    def _add_to_answer(self, content: str, is_first_chunk: bool, user_query: str):
+        if is_first_chunk:
+            if user_query:
+                self.memory[-1].content = user_query
+            self.memory.append(HaivenAIMessage(content=""))
+        self.memory[-1].append(content)
 
     def run_with_document(
         self,
@@ -159,31 +376,58 @@ class StreamingChat(HaivenBaseChat):
                     message, knowledge_document_key
                 )
             )
+            prompt, user_request = self._prompt_with_context(
+                message, context_for_prompt
+            )
 
-            user_request = (
-                message
-                or "Based on our conversation so far, what do you think is relevant to me with the CONTEXT information I gathered?"
+            for chunk in self.run(prompt, user_request):
+                yield chunk, sources_markdown
+
+        except Exception as error:
+            yield error_chunk(error), ""
+
+    async def arun_with_document(
+        self,
+        knowledge_document_key: str,
+        message: str = None,
+        on_usage: Callable[[dict], dict] = None,
+    ):
+        try:
+            (
+                context_for_prompt,
+                sources_markdown,
+            ) = await self._asimilarity_search_based_on_history(
+                message, knowledge_document_key
+            )
+            prompt, user_request = self._prompt_with_context(
+                message, context_for_prompt
             )
 
-            if context_for_prompt:
-                prompt = f"""
+            async with aclosing(self.arun(prompt, user_request, on_usage)) as stream:
+                async for chunk in stream:
+                    yield chunk, sources_markdown
+
+        except Exception as error:
+            yield error_chunk(error), ""
+
+    def _prompt_with_context(self, message: str, context_for_prompt: str):
+        user_request = (
+            message
+            or "Based on our conversation so far, what do you think is relevant to me with the CONTEXT information I gathered?"
+        )
+
+        if context_for_prompt:
+            prompt = f"""
                 {user_request}
                 ---- Here is some additional CONTEXT that might be relevant to this:
                 {context_for_prompt} 
                 -------
                 Do not provide any advice that is outside of the CONTEXT I provided.
                 """
-            else:
-                prompt = user_request
-
-            for chunk in self.run(prompt, user_request):
-                yield chunk, sources_markdown
+        else:
+            prompt = user_request
 
-        except Exception as error:
-            if not str(error).strip():
-                error = "Error while the model was processing the input"
-            print(f"[ERROR]: {str(error)}")
-            yield f"[ERROR]: {str(error)}", ""
+        return prompt, user_request
 
 
 class JSONChat(HaivenBaseChat):
@@ -192,15 +436,32 @@ class JSONChat(HaivenBaseChat):
         chat_client: ChatClient,
         system_message: str = "You are a helpful assistant",
         event_stream_standard=True,
+        memory_manager: MemoryManager = None,
+        stream_coalescing: StreamCoalescing = None,
     ):
-        super().__init__(chat_client, None, system_message)
+        super().__init__(
+            chat_client, None, system_message, memory_manager, stream_coalescing
+        )
         # Transition to new frontend SSE implementation: Add "data: " and "[DONE]" vs not doing that
         self.event_stream_standard = event_stream_standard
+        # The cards this chat iterates on, for iterations that only exchange changes
+        self.card_state: CardState = None
+
+    def to_state(self) -> dict:
+        state = super().to_state()
+        if self.card_state is not None:
+            state["card_state"] = self.card_state.to_state()
+        return state
+
+    def restore_state(self, state: dict):
+        super().restore_state(state)
+        if state.get("card_state"):
+            self.card_state = CardState.from_state(state["card_state"])
 
     def stream_from_model(self, new_message):
         try:
             self.memory.append(HaivenHumanMessage(content=new_message))
-            stream = self.chat_client.stream(self.memory)
+            stream = self.chat_client.stream(self.messages_for_model())
             for chunk in stream:
                 yield chunk["content"]
 
@@ -208,92 +469,325 @@ class JSONChat(HaivenBaseChat):
                 yield "[DONE]"
 
         except Exception as error:
-            if not str(error).strip():
-                error = "Error while the model was processing the input"
-            print(f"[ERROR]: {str(error)}")
-            yield f"[ERROR]: {str(error)}"
+            yield error_chunk(error)
+
+    async def astream_from_model(self, new_message, use_cache: bool = False):
+        try:
+            self.memory.append(HaivenHumanMessage(content=new_message))
+            await self._abefore_turn()
+            async with aclosing(self._astream_answer(use_cache)) as stream:
+                async for chunk in stream:
+                    yield chunk["content"]
+
+            if self.event_stream_standard:
+                yield "[DONE]"
+
+        except Exception as error:
+            yield error_chunk(error)
 
     def run(self, message: str):
         try:
             data = enumerate(self.stream_from_model(message))
             for i, chunk in data:
-                if i == 0:
-                    self.memory.append(HaivenAIMessage(content=""))
-
-                if chunk == "[DONE]":
-                    yield f"data: {chunk}\n\n"
-                else:
-                    self.memory[-1].content += chunk
-                    if self.event_stream_standard:
-                        message = '{ "data": ' + json.dumps(chunk) + " }"
-                        yield f"data: {message}\n\n"
+                yield self._to_event(chunk, i == 0)
+            self._after_turn()
+
+        except Exception as error:
+            yield error_chunk(error)
+
+    async def arun(
+        self,
+        message: str,
+        on_usage: Callable[[dict], dict] = None,
+        object_events: bool = False,
+        on_object: Callable[[dict], dict] = None,
+        use_cache: bool = False,
+    ):
+        """
+        Streams events with the chunks of the model's answer, or with `object_events`, typed events with
+        each object of the JSON array in the answer as soon as it is complete. `on_object` can turn
+        each object into the event to send instead, or skip it by returning None.
+        `use_cache` answers from the response cache, only for prompts that always get the same answer.
+        """
+        parser = JSONArrayParser() if object_events or on_object else None
+        try:
+            is_first_chunk = True
+            async with aclosing(self.astream_from_model(message, use_cache)) as stream:
+                async for chunk in stream:
+                    # The usage is the last event before [DONE], or the last event without it
+                    if chunk == "[DONE]":
+                        for event in self._closing_events(parser, on_usage, on_object):
+                            yield event
+                    event = self._to_event(chunk, is_first_chunk)
+                    is_first_chunk = False
+                    if parser is None or chunk == "[DONE]":
+                        yield event
+                    elif chunk.startswith("[ERROR]"):
+                        yield self._event({"type": "error", "data": chunk})
                     else:
-                        message = json.dumps({"data": chunk})
-                        yield f"{message}\n\n"
+                        for index, parsed in parser.feed(chunk):
+                            event = self._object_event(index, parsed, on_object)
+                            if event:
+                                yield event
+            if not self.event_stream_standard:
+                for event in self._closing_events(parser, on_usage, on_object):
+                    yield event
+            await self._aafter_turn(on_usage)
 
+        except (asyncio.CancelledError, GeneratorExit):
+            self._interrupted_turn()
+            raise
         except Exception as error:
-            if not str(error).strip():
-                error = "Error while the model was processing the input"
-            print(f"[ERROR]: {str(error)}")
-            yield f"[ERROR]: {str(error)}"
+            yield error_chunk(error)
+
+    def _closing_events(
+        self,
+        parser: JSONArrayParser,
+        on_usage: Callable[[dict], dict],
+        on_object: Callable[[dict], dict] = None,
+    ) -> list:
+        events = []
+        if parser is not None:
+            # Changes that are applied, e.g. to the card state, must not contain values that were cut off
+            repaired = parser.close(complete_members_only=on_object is not None)
+            if repaired is not None:
+                index, parsed = repaired
+                event = self._object_event(index, parsed, on_object, repaired=True)
+                if event:
+                    events.append(event)
+        usage_event = self._usage_event(on_usage)
+        if usage_event:
+            events.append(usage_event)
+        return events
+
+    def _object_event(
+        self,
+        index: int,
+        parsed,
+        on_object: Callable[[dict], dict] = None,
+        repaired=False,
+    ) -> str:
+        if on_object is None:
+            event = {"type": "object", "index": index, "data": parsed}
+        else:
+            event = on_object(parsed)
+            if event is None:
+                return None
+        if repaired:
+            # The answer ended in the middle of this object, e.g. because it hit the token limit
+            event["repaired"] = True
+        return self._event(event)
+
+    async def acomplete(
+        self,
+        message: str,
+        on_usage: Callable[[dict], dict] = None,
+        use_cache: bool = False,
+    ) -> str:
+        """
+        Generates the whole answer at once, for callers that combine several answers instead of
+        streaming one. Unlike arun, errors are raised instead of being sent as an event.
+        """
+        self.memory.append(HaivenHumanMessage(content=message))
+        await self._abefore_turn()
+        chat_client = self._client_for_turn(use_cache)
+        chunks = [
+            chunk["content"]
+            async for chunk in chat_client.astream(self.messages_for_model())
+        ]
+        self.memory.append(HaivenAIMessage(content="".join(chunks)))
+        if on_usage is not None and self._last_usage() is not None:
+            on_usage(self._last_usage())
+        await self._aafter_turn(on_usage)
+        return self.memory[-1].content
+
+    def _usage_event(self, on_usage: Callable[[dict], dict]) -> str:
+        usage = self._last_usage()
+        if usage is None:
+            return None
+
+        event = {"usage": dict(usage)}
+        if on_usage is not None:
+            event["usage"]["session_totals"] = on_usage(usage)
+        return self._event(event)
+
+    def _event(self, data: dict) -> str:
+        if self.event_stream_standard:
+            return f"data: {json.dumps(data)}\n\n"
+        return f"{json.dumps(data)}\n\n"
+
+    def _to_event(self, chunk: str, is_first_chunk: bool) -> str:
+        if is_first_chunk:
+            self.memory.append(HaivenAIMessage(content=""))
+
+        if chunk == "[DONE]":
+            return f"data: {chunk}\n\n"
+
+        self.memory[-1].append(chunk)
+        if self.event_stream_standard:
+            message = '{ "data": ' + json.dumps(chunk) + " }"
+            return f"data: {message}\n\n"
+        else:
+            message = json.dumps({"data": chunk})
+            return f"{message}\n\n"
+
+
+def messages_from_state(state: dict) -> ChatMemory:
+    return ChatMemory(
+        [MESSAGE_TYPES[role](content=content) for role, content in state["messages"]]
+    )
 
 
 class ServerChatSessionMemory:
-    def __init__(self):
-        self.USER_CHATS = {}
+    """
+    The chat sessions of all users, in a SessionStore. By default they are kept in memory, shared stores
+    keep the state of each chat instead, which the ChatManager restores when a session is used.
+    """
+
+    def __init__(self, store: SessionStore = None):
+        self.store = store if store is not None else InMemorySessionStore()
+        # key => (version, chat) of the chats this process created or restored last
+        self._chats: dict[str, tuple[str, HaivenBaseChat]] = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def _run(self, interval_seconds: float):
+        while not self._stop_event.wait(interval_seconds):
+            try:
+                self.clear_old_entries()
+            except Exception as error:
+                HaivenLogger.get().error(
+                    str(error), extra={"ERROR": "ChatSessionCleanupFailed"}
+                )
+
+    def start(self, interval_seconds: float = 60):
+        """
+        Removes old chat sessions in the background every `interval_seconds`, instead of while handling requests.
+        """
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval_seconds,),
+            name="chat-session-cleanup",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
 
     def clear_old_entries(self):
         allowed_age_in_minutes = 30
         allowed_age_in_seconds = 60 * allowed_age_in_minutes
         print(
-            f"CLEANUP: Removing chat sessions with age > {allowed_age_in_minutes} mins from memory. Currently {len(self.USER_CHATS)} entries in memory"
+            f"CLEANUP: Removing chat sessions with age > {allowed_age_in_minutes} mins from memory. Currently {len(self.store)} entries in memory"
         )
 
-        entries_to_remove = list(
-            filter(
-                lambda key: self.USER_CHATS[key]["last_access"]
-                < time.time() - allowed_age_in_seconds,
-                self.USER_CHATS,
+        removed = self.store.remove_older_than(time.time() - allowed_age_in_seconds)
+        for key in removed:
+            print("CLEANUP: Removing entry", key)
+            self._chats.pop(key, None)
+        if removed:
+            # Goes through all messages, so only when it changed
+            usage = self.memory_usage()
+            print(
+                f"CLEANUP: {usage['messages']} messages of {usage['characters']} characters left in memory"
             )
-        )
 
-        for key in entries_to_remove:
-            print("CLEANUP: Removing entry", key)
-            del self.USER_CHATS[key]
+    def memory_usage(self) -> dict:
+        """
+        The number of messages and characters that the chat sessions in this process hold.
+        Messages that forked sessions share with each other are only counted once.
+        """
+        segments = {}
+        for _, chat in list(self._chats.values()):
+            memory = getattr(chat, "memory", None)
+            if isinstance(memory, ChatMemory):
+                for segment in memory.segments():
+                    segments[id(segment)] = segment
+        return {
+            "messages": sum(len(segment) for segment in segments.values()),
+            "characters": sum(
+                message.content_length()
+                for segment in segments.values()
+                for message in segment
+            ),
+        }
 
     def add_new_entry(self, category: str, user_identifier: str):
-        # Currently the crude rhythm of checking for old entries: whenever a new one gets created
-        self.clear_old_entries()
-
         session_key = category + "-" + str(uuid.uuid4())
 
         HaivenLogger.get().analytics(
             f"Creating a new chat session for category {category} with key {session_key} for user {user_identifier}"
         )
-        self.USER_CHATS[session_key] = {
-            "created_at": time.time(),
-            "last_access": time.time(),
-            "user": user_identifier,
-            "chat": None,
-        }
+        self.store.create(
+            session_key,
+            {
+                "created_at": time.time(),
+                "last_access": time.time(),
+                "user": user_identifier,
+                "version": None,
+                "chat": None,
+            },
+        )
         return session_key
 
     def store_chat(self, session_key: str, chat_session: HaivenBaseChat):
-        self.USER_CHATS[session_key]["chat"] = chat_session
+        if not self.store.shared:
+            self.store.update(session_key, chat=chat_session)
+            self._chats[session_key] = (None, chat_session)
+            return
+
+        version = uuid.uuid4().hex
+        self.store.update(
+            session_key,
+            chat=encode_chat_state(chat_session.to_state()),
+            version=version,
+            last_access=time.time(),
+        )
+        self._chats[session_key] = (version, chat_session)
+        chat_session.on_turn_finished = partial(
+            self.store_chat, session_key, chat_session
+        )
 
-    def get_chat(self, session_key: str):
-        self.clear_old_entries()
-        if session_key not in self.USER_CHATS:
+    def get_chat(
+        self,
+        session_key: str,
+        restore_chat: Callable[[dict], HaivenBaseChat] = None,
+    ):
+        entry = self.store.access(session_key, time.time())
+        if entry is None:
             raise ValueError(
                 f"Invalid identifier {session_key}, your chat session might have expired"
             )
-        self.USER_CHATS[session_key]["last_access"] = time.time()
-        return self.USER_CHATS[session_key]["chat"]
+        if not self.store.shared:
+            return entry["chat"]
+
+        # Another process may have changed the chat since this one used it last
+        version, chat_session = self._chats.get(session_key, (None, None))
+        if chat_session is None or version != entry["version"]:
+            if entry["chat"] is None:
+                return None
+            if restore_chat is None:
+                raise ValueError(
+                    f"Chat session {session_key} can only be restored by a ChatManager"
+                )
+            chat_session = restore_chat(decode_chat_state(entry["chat"]))
+            self._chats[session_key] = (entry["version"], chat_session)
+            chat_session.on_turn_finished = partial(
+                self.store_chat, session_key, chat_session
+            )
+        return chat_session
 
     def delete_entry(self, session_key):
-        if session_key in self.USER_CHATS:
+        if self.store.get(session_key) is not None:
             print("Discarding a chat session from memory", session_key)
-            del self.USER_CHATS[session_key]
+            self.store.delete(session_key)
+        self._chats.pop(session_key, None)
 
     def get_or_create_chat(
         self,
@@ -301,6 +795,7 @@ class ServerChatSessionMemory:
         chat_session_key_value: str = None,
         chat_category: str = "unknown",
         user_identifier: str = "unknown",
+        restore_chat: Callable[[dict], HaivenBaseChat] = None,
     ):
         if chat_session_key_value is None or chat_session_key_value == "":
             chat_session_key_value = self.add_new_entry(chat_category, user_identifier)
@@ -308,17 +803,20 @@ class ServerChatSessionMemory:
 
             self.store_chat(chat_session_key_value, chat_session)
         else:
-            chat_session = self.get_chat(chat_session_key_value)
+            chat_session = self.get_chat(chat_session_key_value, restore_chat)
 
         return chat_session_key_value, chat_session
 
     def dump_as_text(self, session_key: str, user_owner: str):
-        chat_session_data = self.USER_CHATS.get(session_key, None)
+        chat_session_data = self.store.get(session_key)
         if chat_session_data is None:
             return f"Chat session with ID {session_key} not found"
         if chat_session_data["user"] != user_owner:
             return f"Chat session with ID {session_key} not found for this user"
 
+        if self.store.shared:
+            state = decode_chat_state(chat_session_data["chat"])
+            return "\n".join(str(message) for message in messages_from_state(state))
         chat_session: HaivenBaseChat = chat_session_data["chat"]
         return chat_session.memory_as_text()
 
@@ -327,6 +825,10 @@ class ChatOptions(BaseModel):
     category: str = None
     in_chunks: bool = False
     user_identifier: str = None
+    # (prompt id, context) of a prompt that answers similar first messages from the semantic cache
+    semantic_cache_scope: Optional[tuple] = None
+    # The user's input that the first message was rendered from, which is compared with earlier inputs
+    semantic_cache_query: Optional[str] = None
 
 
 class ChatManager:
@@ -336,17 +838,118 @@ class ChatManager:
         chat_session_memory: ServerChatSessionMemory,
         llm_chat_factory: ChatClientFactory,
         knowledge_manager: KnowledgeManager,
+        rate_limiters: ModelRateLimiters = None,
     ):
         self.config_service = config_service
         self.chat_session_memory = chat_session_memory
         self.llm_chat_factory = llm_chat_factory
         self.knowledge_manager = knowledge_manager
+        self.rate_limiters = rate_limiters
+        self.usage_accounting = UsageAccounting()
+        self.stream_coalescing = self._create_stream_coalescing(config_service)
+
+    def record_usage(
+        self, usage: dict, session: str = None, user: str = None, prompt_id: str = None
+    ) -> dict:
+        """
+        Adds the usage of a request to the totals, and returns the totals of its session.
+        """
+        self.usage_accounting.record(
+            usage, session=session, user=user, prompt_id=prompt_id
+        )
+        HaivenLogger.get().analytics(
+            "Request usage",
+            {**usage, "session": session, "user_id": user, "prompt_id": prompt_id},
+        )
+        return self.usage_accounting.totals("session", session)
+
+    def _create_stream_coalescing(
+        self, config_service: ConfigService
+    ) -> StreamCoalescing:
+        options = config_service.load_stream_coalescing_options()
+        if options is None:
+            return None
+        return StreamCoalescing(
+            options["window_ms"] / 1000, max_chars=options["max_chars"]
+        )
+
+    def _memory_manager(
+        self, model_config: ModelConfig, chat_client: ChatClient
+    ) -> MemoryManager:
+        max_tokens = (
+            model_config.prompt_token_budget
+            or self.config_service.load_conversation_token_budget()
+        )
+        if not max_tokens:
+            return None
+        return MemoryManager(
+            chat_client,
+            max_tokens,
+            rate_limiter=(
+                self.rate_limiters.get(model_config)
+                if self.rate_limiters is not None
+                else None
+            ),
+        )
 
     def clear_session(self, session_id: str):
         self.chat_session_memory.delete_entry(session_id)
 
     def get_session(self, chat_session_key_value):
-        return self.chat_session_memory.get_chat(chat_session_key_value)
+        return self.chat_session_memory.get_chat(
+            chat_session_key_value, restore_chat=self.restore_chat
+        )
+
+    def _new_streaming_chat(
+        self, model_config: ModelConfig, options: ChatOptions
+    ) -> StreamingChat:
+        chat_client = self.llm_chat_factory.new_chat_client(
+            model_config,
+            semantic_cache_scope=options.semantic_cache_scope,
+            semantic_cache_query=options.semantic_cache_query,
+        )
+        chat_session = StreamingChat(
+            chat_client,
+            self.knowledge_manager,
+            stream_in_chunks=options.in_chunks,
+            memory_manager=self._memory_manager(model_config, chat_client),
+            stream_coalescing=self.stream_coalescing,
+        )
+        chat_session.model_id, chat_session.options = model_config.id, options
+        return chat_session
+
+    def _new_json_chat(
+        self, model_config: ModelConfig, options: ChatOptions
+    ) -> JSONChat:
+        chat_client = self.llm_chat_factory.new_chat_client(
+            model_config,
+            semantic_cache_scope=options.semantic_cache_scope,
+            semantic_cache_query=options.semantic_cache_query,
+        )
+        chat_session = JSONChat(
+            chat_client,
+            event_stream_standard=False,
+            memory_manager=self._memory_manager(model_config, chat_client),
+            stream_coalescing=self.stream_coalescing,
+        )
+        chat_session.cached_chat_client = self.llm_chat_factory.new_cached_chat_client(
+            model_config
+        )
+        chat_session.model_id, chat_session.options = model_config.id, options
+        return chat_session
+
+    def restore_chat(self, state: dict) -> HaivenBaseChat:
+        """
+        Creates a chat again from its state, e.g. one that another process stored in a shared session store.
+        """
+        model_config = self.config_service.get_model(state["model"])
+        options = ChatOptions(**(state["options"] or {}))
+        if state["type"] == JSONChat.__name__:
+            chat_session = self._new_json_chat(model_config, options)
+        else:
+            chat_session = self._new_streaming_chat(model_config, options)
+        chat_session.restore_state(state)
+        return chat_session
 
     def streaming_chat(
         self,
@@ -354,16 +957,13 @@ class ChatManager:
         session_id: str = None,
         options: ChatOptions = None,
     ):
-        chat_client = self.llm_chat_factory.new_chat_client(model_config)
+        options = options or ChatOptions()
         return self.chat_session_memory.get_or_create_chat(
-            lambda: StreamingChat(
-                chat_client,
-                self.knowledge_manager,
-                stream_in_chunks=options.in_chunks if options else None,
-            ),
+            lambda: self._new_streaming_chat(model_config, options),
             chat_session_key_value=session_id,
-            chat_category=options.category if options else None,
-            user_identifier=options.user_identifier if options else None,
+            chat_category=options.category,
+            user_identifier=options.user_identifier,
+            restore_chat=self.restore_chat,
         )
 
     def json_chat(
@@ -372,13 +972,55 @@ class ChatManager:
         session_id: str = None,
         options: ChatOptions = None,
     ):
-        chat_client = self.llm_chat_factory.new_chat_client(model_config)
+        options = options or ChatOptions()
         return self.chat_session_memory.get_or_create_chat(
-            lambda: JSONChat(
-                chat_client,
-                event_stream_standard=False,
-            ),
+            lambda: self._new_json_chat(model_config, options),
             chat_session_key_value=session_id,
-            chat_category=options.category if options else None,
-            user_identifier=options.user_identifier if options else None,
+            chat_category=options.category,
+            user_identifier=options.user_identifier,
+            restore_chat=self.restore_chat,
+        )
+
+    def streaming_chat_fork(
+        self,
+        model_config: ModelConfig,
+        parent_session_id: str,
+        options: ChatOptions = None,
+    ):
+        """
+        A new streaming chat session that continues the conversation of an existing session.
+        It shares the messages so far with the session it forked from instead of copying them,
+        and both keep their own messages from then on.
+        """
+        parent = self.get_session(parent_session_id)
+        chat_session_key_value, chat_session = self.streaming_chat(
+            model_config, options=options
+        )
+        chat_session.memory = parent.memory.fork()
+        self.chat_session_memory.store_chat(chat_session_key_value, chat_session)
+        return chat_session_key_value, chat_session
+
+    def json_chat_branch(
+        self,
+        model_config: ModelConfig,
+        session_id: str,
+        options: ChatOptions = None,
+    ) -> JSONChat:
+        """
+        A chat that continues the conversation of an existing session without adding to it,
+        so that several follow-up requests to the same conversation can run in parallel.
+        The branch is not stored, its usage is accounted to the session it branched off.
+        """
+        session = self.get_session(session_id)
+        chat_client = self.llm_chat_factory.new_chat_client(model_config)
+        branch = JSONChat(
+            chat_client,
+            system_message=session.system,
+            event_stream_standard=False,
+            stream_coalescing=self.stream_coalescing,
+        )
+        branch.cached_chat_client = self.llm_chat_factory.new_cached_chat_client(
+            model_config
         )
+        branch.memory = session.memory.fork()
+        return branch
@@ -1,20 +1,84 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
 import json
 import os
+import time
 from typing import List
 from config_service import ConfigService
 from llms.model_config import ModelConfig
 from pydantic import BaseModel
 from langchain.schema import AIMessage, HumanMessage, SystemMessage
 from langchain_core.messages.base import BaseMessage
-from llms.litellm_wrapper import llmCompletion
+from llms.litellm_wrapper import llmAcompletion, llmCompletion
+from llms.model_router import ModelRouter
+from llms.rate_limiter import (
+    TOO_MANY_STREAMS,
+    ModelRateLimiters,
+    RateLimitExceeded,
+    Reservation,
+    estimate_tokens,
+)
+from llms.response_cache import ResponseCache
+from llms.semantic_cache import SemanticResponseCache
+from llms.streams import END_OF_STREAM, next_chunk
+from llms.tokens import count_tokens
+from logger import HaivenLogger
 
 
-class HaivenMessage(BaseModel):
-    content: str
+class HaivenMessage:
+    """
+    A message of a conversation. Answers that are streamed into a message are collected with `append`,
+    and the chunks are only joined when the content is read, instead of copying the whole content for
+    every chunk.
+    """
+
+    __slots__ = ("_parts",)
+
+    def __init__(self, content: str):
+        if not isinstance(content, str):
+            raise TypeError(
+                f"content of a message must be a string, not {type(content).__name__}"
+            )
+        self._parts = [content]
+
+    @property
+    def content(self) -> str:
+        if len(self._parts) != 1:
+            self._parts = ["".join(self._parts)]
+        return self._parts[0]
+
+    @content.setter
+    def content(self, content: str):
+        self._parts = [content]
+
+    def append(self, chunk: str):
+        self._parts.append(chunk)
+
+    def content_length(self) -> int:
+        # Without joining the chunks of an answer that is still being streamed
+        return sum(len(part) for part in self._parts)
+
+    def finalize(self):
+        # Joins the chunks once the message is complete, so that they don't stay in memory
+        self.content
+
+    def __eq__(self, other) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return self.content == other.content
+
+    __hash__ = None
+
+    def __str__(self) -> str:
+        return f"content={self.content!r}"
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}(content={self.content!r})"
 
 
 class HaivenAIMessage(HaivenMessage):
+    __slots__ = ()
+
     def to_json(self) -> dict:
         # TODO: Is it really always "assistant", for all APIs? ...
         return {"content": self.content, "role": "assistant"}
@@ -24,6 +88,8 @@ class HaivenAIMessage(HaivenMessage):
 
 
 class HaivenHumanMessage(HaivenMessage):
+    __slots__ = ()
+
     def to_json(self) -> dict:
         return {"content": self.content, "role": "user"}
 
@@ -32,6 +98,8 @@ class HaivenHumanMessage(HaivenMessage):
 
 
 class HaivenSystemMessage(HaivenMessage):
+    __slots__ = ()
+
     def to_json(self) -> dict:
         return {"content": self.content, "role": "system"}
 
@@ -86,38 +154,565 @@ class MockModelClient:
         for chunk in test_data:
             yield MockResult(choices=[MockChoice(delta=MockDelta(content=chunk))])
 
+    async def acompletion(self, messages, model=None, **kwargs):
+        async def results():
+            for result in self.completion(messages, model, **kwargs):
+                yield result
+
+        return results()
+
 
 class ChatClient:
     def __init__(self, model_config: ModelConfig):
         self.model_config = model_config
+        self.last_usage: dict = None
 
     def _get_kwargs(self) -> dict:
+        kwargs = {}
         if self.model_config.provider == "ollama":
-            return {"api_base": os.environ.get("OLLAMA_HOST", "")}
-        else:
-            return {}
+            kwargs["api_base"] = os.environ.get("OLLAMA_HOST", "")
+        if self.model_config.reports_stream_usage():
+            kwargs["stream_options"] = {"include_usage": True}
+        return kwargs
 
-    def stream(self, messages: List[HaivenMessage], mock: bool = False):
+    def _to_json_messages(self, messages: List[HaivenMessage]) -> List[dict]:
+        """
+        Converts the messages for the model. For providers with prompt caching, the prefixes that stay the same
+        from turn to turn are marked as cacheable: the system message, the first user message (which usually
+        contains the rendered prompt with the knowledge snippets), and the conversation before the newest message.
+        """
         json_messages = [message.to_json() for message in messages]
+        if not self.model_config.supports_prompt_caching():
+            return json_messages
+
+        breakpoints = set()
+        if json_messages and json_messages[0]["role"] == "system":
+            breakpoints.add(0)
+        first_user_message = next(
+            (
+                position
+                for position, message in enumerate(json_messages)
+                if message["role"] == "user"
+            ),
+            None,
+        )
+        if first_user_message is not None:
+            breakpoints.add(first_user_message)
+        if len(json_messages) >= 3:
+            breakpoints.add(len(json_messages) - 2)
+        # The newest message is different every time, marking it would only write to the cache
+        breakpoints.discard(len(json_messages) - 1)
+
+        for position in breakpoints:
+            json_messages[position] = _with_cache_control(json_messages[position])
+        return json_messages
+
+    def _record_usage(
+        self,
+        usage,
+        messages: List[HaivenMessage],
+        completion: str,
+        started_at: float,
+        first_token_at: float,
+    ):
+        """
+        Keeps the usage and timing of the last call in `last_usage`. Providers that do not report usage
+        for streamed responses get estimated token counts.
+        """
+        finished_at = time.monotonic()
+        prompt_tokens_details = getattr(usage, "prompt_tokens_details", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        estimated = prompt_tokens is None or completion_tokens is None
+        if prompt_tokens is None:
+            prompt_tokens = sum(count_tokens(message.content) for message in messages)
+        if completion_tokens is None:
+            completion_tokens = count_tokens(completion)
+
+        generation_seconds = (
+            finished_at - first_token_at if first_token_at is not None else None
+        )
+        self.last_usage = {
+            "model": self.model_config.lite_id,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            # Anthropic and Bedrock report cache reads and writes, OpenAI and Azure only the cached tokens
+            "cache_read_input_tokens": getattr(usage, "cache_read_input_tokens", None)
+            or getattr(prompt_tokens_details, "cached_tokens", None)
+            or 0,
+            "cache_creation_input_tokens": getattr(
+                usage, "cache_creation_input_tokens", None
+            )
+            or 0,
+            "estimated": estimated,
+            "time_to_first_token_seconds": (
+                round(first_token_at - started_at, 3)
+                if first_token_at is not None
+                else None
+            ),
+            "duration_seconds": round(finished_at - started_at, 3),
+            "tokens_per_second": (
+                round(completion_tokens / generation_seconds, 1)
+                if generation_seconds
+                else None
+            ),
+        }
+        HaivenLogger.get().analytics("Model usage", self.last_usage)
+
+    def stream(self, messages: List[HaivenMessage], mock: bool = False):
+        self.last_usage = None
+        json_messages = self._to_json_messages(messages)
         if os.environ.get("MOCK_AI", False):
             completion_fn = MockModelClient().completion
         else:
             completion_fn = llmCompletion
 
+        started_at, first_token_at = time.monotonic(), None
+        completion = []
+        usage = None
         for result in completion_fn(
             model=self.model_config.lite_id,
             messages=json_messages,
             stream=True,
             **self._get_kwargs(),
         ):
-            if result.choices[0].delta.content is not None:
+            usage = getattr(result, "usage", None) or usage
+            # The usage is reported in a last chunk without choices
+            if result.choices and result.choices[0].delta.content is not None:
+                first_token_at = first_token_at or time.monotonic()
+                completion.append(result.choices[0].delta.content)
                 yield {"content": result.choices[0].delta.content}
+        self._record_usage(
+            usage, messages, "".join(completion), started_at, first_token_at
+        )
+
+    async def astream(self, messages: List[HaivenMessage]):
+        """
+        Same as stream, but awaits the model instead of blocking a thread while waiting for the next chunk.
+        """
+        self.last_usage = None
+        json_messages = self._to_json_messages(messages)
+        if os.environ.get("MOCK_AI", False):
+            acompletion_fn = MockModelClient().acompletion
+        else:
+            acompletion_fn = llmAcompletion
+
+        started_at, first_token_at = time.monotonic(), None
+        completion = []
+        results = await acompletion_fn(
+            model=self.model_config.lite_id,
+            messages=json_messages,
+            stream=True,
+            **self._get_kwargs(),
+        )
+        usage = None
+        try:
+            async for result in results:
+                usage = getattr(result, "usage", None) or usage
+                if result.choices and result.choices[0].delta.content is not None:
+                    first_token_at = first_token_at or time.monotonic()
+                    completion.append(result.choices[0].delta.content)
+                    yield {"content": result.choices[0].delta.content}
+        finally:
+            # Closing the provider's stream closes its connection, which stops the generation
+            # when the response is abandoned half-way, e.g. because the client disconnected
+            if hasattr(results, "aclose"):
+                await results.aclose()
+        self._record_usage(
+            usage, messages, "".join(completion), started_at, first_token_at
+        )
+
+
+def _with_cache_control(json_message: dict) -> dict:
+    return {
+        "role": json_message["role"],
+        "content": [
+            {
+                "type": "text",
+                "text": json_message["content"],
+                "cache_control": {"type": "ephemeral"},
+            }
+        ],
+    }
+
+
+class CachedChatClient(ChatClient):
+    """
+    A ChatClient that replays responses from a ResponseCache when it was asked the same before,
+    chunk by chunk like the original response, so that callers cannot tell the difference.
+    Only complete responses are cached, a stream that fails or is abandoned is not.
+    """
+
+    def __init__(self, model_config: ModelConfig, response_cache: ResponseCache):
+        super().__init__(model_config)
+        self.response_cache = response_cache
+
+    def _cache_key(self, messages: List[HaivenMessage]) -> str:
+        return ResponseCache.key(
+            self.model_config.lite_id,
+            [message.to_json() for message in messages],
+            self._get_kwargs(),
+        )
+
+    def stream(self, messages: List[HaivenMessage], mock: bool = False):
+        # Responses from a cache did not use the model
+        self.last_usage = None
+        key = self._cache_key(messages)
+        cached_chunks = self.response_cache.get(key)
+        if cached_chunks is not None:
+            for content in cached_chunks:
+                yield {"content": content}
+            return
+
+        chunks = []
+        for chunk in super().stream(messages, mock):
+            chunks.append(chunk["content"])
+            yield chunk
+        self.response_cache.put(key, chunks)
+
+    async def astream(self, messages: List[HaivenMessage]):
+        self.last_usage = None
+        key = self._cache_key(messages)
+        # The cache might have to read from disk, which should not block the event loop
+        cached_chunks = await asyncio.to_thread(self.response_cache.get, key)
+        if cached_chunks is not None:
+            for content in cached_chunks:
+                yield {"content": content}
+                await asyncio.sleep(0)
+            return
+
+        chunks = []
+        async for chunk in super().astream(messages):
+            chunks.append(chunk["content"])
+            yield chunk
+        await asyncio.to_thread(self.response_cache.put, key, chunks)
+
+
+class SemanticCachedChatClient(ChatClient):
+    """
+    A ChatClient that answers the first message of a conversation from a SemanticResponseCache
+    when a similar message was answered before for the same prompt, model and context.
+    Later messages depend on the conversation so far, and always go to the model.
+
+    The `query` is what is compared, e.g. the user's input that the first message was rendered from.
+    The text of a prompt template is the same for every request, and would make different inputs look similar.
+    """
+
+    def __init__(
+        self,
+        model_config: ModelConfig,
+        semantic_cache: SemanticResponseCache,
+        scope: tuple,
+        query: str = None,
+    ):
+        super().__init__(model_config)
+        self.semantic_cache = semantic_cache
+        self.scope = (model_config.lite_id,) + tuple(scope)
+        self.query = query
+
+    def _query(self, messages: List[HaivenMessage]) -> str:
+        return self.query or messages[-1].content
+
+    def _is_first_turn(self, messages: List[HaivenMessage]) -> bool:
+        return (
+            len(messages) == 2
+            and isinstance(messages[0], HaivenSystemMessage)
+            and isinstance(messages[1], HaivenHumanMessage)
+        )
+
+    def stream(self, messages: List[HaivenMessage], mock: bool = False):
+        # Responses from a cache did not use the model
+        self.last_usage = None
+        if not self._is_first_turn(messages):
+            yield from super().stream(messages, mock)
+            return
+
+        request_vector = self.semantic_cache.embed(self._query(messages))
+        cached_chunks = self.semantic_cache.get(self.scope, request_vector)
+        if cached_chunks is not None:
+            for content in cached_chunks:
+                yield {"content": content}
+            return
+
+        chunks = []
+        for chunk in super().stream(messages, mock):
+            chunks.append(chunk["content"])
+            yield chunk
+        self.semantic_cache.put(self.scope, request_vector, chunks)
+
+    async def astream(self, messages: List[HaivenMessage]):
+        self.last_usage = None
+        if not self._is_first_turn(messages):
+            async for chunk in super().astream(messages):
+                yield chunk
+            return
+
+        # Embedding calls the embeddings model, which should not block the event loop
+        request_vector = await asyncio.to_thread(
+            self.semantic_cache.embed, self._query(messages)
+        )
+        cached_chunks = self.semantic_cache.get(self.scope, request_vector)
+        if cached_chunks is not None:
+            for content in cached_chunks:
+                yield {"content": content}
+                await asyncio.sleep(0)
+            return
+
+        chunks = []
+        async for chunk in super().astream(messages):
+            chunks.append(chunk["content"])
+            yield chunk
+        self.semantic_cache.put(self.scope, request_vector, chunks)
+
+
+class _RoutedAttempt:
+    def __init__(
+        self,
+        model_config: ModelConfig,
+        messages: List[HaivenMessage],
+        reservation: Reservation = None,
+    ):
+        self.model_config = model_config
+        self.reservation = reservation
+        self.chat_client = ChatClient(model_config)
+        self.started_at = time.monotonic()
+        self.stream = self.chat_client.astream(messages)
+        self.first_chunk = asyncio.ensure_future(next_chunk(self.stream))
+
+    async def cancel(self):
+        self.first_chunk.cancel()
+        try:
+            await self.first_chunk
+        except BaseException:
+            pass
+        try:
+            await self.stream.aclose()
+        finally:
+            if self.reservation is not None:
+                self.reservation.settle(self.chat_client.last_usage)
+                self.reservation.release()
+
+
+class RoutedChatClient(ChatClient):
+    """
+    A ChatClient that lets a ModelRouter decide which model answers: it fails over to an equivalent model
+    when a model fails before its first token, and hedges slow requests with a second model.
+    Once the first token arrived, the response stays with that model.
+
+    The caller holds the reservation of the configured model. Every other model a request goes to
+    is reserved with its own rate limiter, and models whose limiter has no free turn are skipped.
+    """
+
+    def __init__(
+        self,
+        model_config: ModelConfig,
+        model_router: ModelRouter,
+        rate_limiters: ModelRateLimiters = None,
+    ):
+        super().__init__(model_config)
+        self.model_router = model_router
+        self.rate_limiters = rate_limiters
+        self.answered_by: ModelConfig = None
+
+    def _reserve(
+        self, candidate: ModelConfig, messages: List[HaivenMessage]
+    ) -> tuple[bool, Reservation]:
+        """
+        Returns whether the request can go to the candidate now, and the reservation it holds if so.
+        """
+        limiter = (
+            self.rate_limiters.get(candidate)
+            if self.rate_limiters is not None and candidate.id != self.model_config.id
+            else None
+        )
+        if limiter is None:
+            return True, None
+
+        reservation = limiter.try_acquire(estimated_tokens=estimate_tokens(messages))
+        if reservation is None:
+            HaivenLogger.get().info(
+                f"Not routing request to {candidate.id}, its rate limit is reached"
+            )
+            return False, None
+        return True, reservation
+
+    def _next_attempt(
+        self, pending: List[ModelConfig], messages: List[HaivenMessage]
+    ) -> _RoutedAttempt:
+        while pending:
+            candidate = pending.pop(0)
+            available, reservation = self._reserve(candidate, messages)
+            if available:
+                return _RoutedAttempt(candidate, messages, reservation)
+        return None
+
+    def stream(self, messages: List[HaivenMessage], mock: bool = False):
+        self.last_usage = None
+        last_error = RateLimitExceeded(TOO_MANY_STREAMS, 503, 1)
+        for candidate in self.model_router.candidates(self.model_config):
+            available, reservation = self._reserve(candidate, messages)
+            if not available:
+                continue
+            chat_client = ChatClient(candidate)
+            try:
+                started_at = time.monotonic()
+                chunks = chat_client.stream(messages, mock)
+                try:
+                    first_chunk = next(chunks, None)
+                except Exception as error:
+                    self.model_router.record_error(candidate.id)
+                    last_error = error
+                    continue
+
+                self._answered(candidate, started_at)
+                if first_chunk is not None:
+                    yield first_chunk
+                yield from chunks
+                self.last_usage = chat_client.last_usage
+                return
+            finally:
+                if reservation is not None:
+                    reservation.settle(chat_client.last_usage)
+                    reservation.release()
+        raise last_error
+
+    async def astream(self, messages: List[HaivenMessage]):
+        self.last_usage = None
+        pending = self.model_router.candidates(self.model_config)
+        attempts: List[_RoutedAttempt] = []
+        winner = None
+        last_error = RateLimitExceeded(TOO_MANY_STREAMS, 503, 1)
+        try:
+            while winner is None:
+                if not attempts:
+                    attempt = self._next_attempt(pending, messages)
+                    if attempt is None:
+                        raise last_error
+                    attempts.append(attempt)
+
+                hedging_timeout = (
+                    self.model_router.hedging_timeout(attempts[0].model_config)
+                    if pending and len(attempts) == 1
+                    else None
+                )
+                done, _ = await asyncio.wait(
+                    [attempt.first_chunk for attempt in attempts],
+                    timeout=hedging_timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if not done:
+                    hedge = self._next_attempt(pending, messages)
+                    if hedge is None:
+                        continue
+                    HaivenLogger.get().info(
+                        f"Hedging request to {attempts[0].model_config.id} with {hedge.model_config.id}"
+                    )
+                    attempts.append(hedge)
+                    continue
+
+                for attempt in [a for a in attempts if a.first_chunk in done]:
+                    if attempt.first_chunk.exception() is None:
+                        winner = winner or attempt
+                    else:
+                        self.model_router.record_error(attempt.model_config.id)
+                        last_error = attempt.first_chunk.exception()
+                        await attempt.cancel()
+                        attempts.remove(attempt)
+
+            for loser in [attempt for attempt in attempts if attempt is not winner]:
+                await loser.cancel()
+            attempts = [winner]
+            self._answered(winner.model_config, winner.started_at)
+
+            first_chunk = winner.first_chunk.result()
+            if first_chunk is not END_OF_STREAM:
+                yield first_chunk
+                async for chunk in winner.stream:
+                    yield chunk
+            self.last_usage = winner.chat_client.last_usage
+        finally:
+            # Also closes the winner's stream when the response is abandoned half-way
+            for attempt in attempts:
+                await attempt.cancel()
+
+    def _answered(self, model_config: ModelConfig, started_at: float):
+        self.answered_by = model_config
+        self.model_router.record_first_token(
+            model_config.id, time.monotonic() - started_at
+        )
+        if model_config.id != self.model_config.id:
+            HaivenLogger.get().info(
+                f"Request to {self.model_config.id} answered by {model_config.id}"
+            )
 
 
 class ChatClientFactory:
-    def __init__(self, config_service: ConfigService):
+    def __init__(
+        self, config_service: ConfigService, rate_limiters: ModelRateLimiters = None
+    ):
         self.config_service = config_service
+        self.rate_limiters = rate_limiters
+        self.response_cache = self._create_response_cache(config_service)
+        self.semantic_cache = self._create_semantic_cache(config_service)
+        self.model_router = self._create_model_router(config_service)
+
+    def _create_response_cache(self, config_service: ConfigService) -> ResponseCache:
+        ttl_seconds = config_service.load_response_cache_ttl_seconds()
+        if ttl_seconds is None:
+            return None
+
+        return ResponseCache(
+            ttl_seconds,
+            max_entries=config_service.load_response_cache_max_entries(),
+            sqlite_path=config_service.load_response_cache_path(),
+        )
+
+    def _create_semantic_cache(
+        self, config_service: ConfigService
+    ) -> SemanticResponseCache:
+        threshold = config_service.load_semantic_cache_threshold()
+        if threshold is None:
+            return None
+
+        from embeddings.client import EmbeddingsClient
+
+        embeddings_client = EmbeddingsClient(config_service.load_embedding_model())
+        return SemanticResponseCache(
+            embeddings_client.embed_query,
+            threshold=threshold,
+            max_entries_per_scope=config_service.load_semantic_cache_max_entries(),
+            ttl_seconds=config_service.load_semantic_cache_ttl_seconds(),
+        )
+
+    def _create_model_router(self, config_service: ConfigService) -> ModelRouter:
+        if not config_service.load_model_routing_enabled():
+            return None
+
+        return ModelRouter(
+            config_service.load_enabled_models(features=["text-generation"]),
+            hedging_percentile=config_service.load_model_hedging_percentile(),
+        )
 
     # Factory method gives us some extra control over how the ChatClients are created
-    def new_chat_client(self, model: ModelConfig) -> ChatClient:
+    def new_chat_client(
+        self,
+        model: ModelConfig,
+        semantic_cache_scope: tuple = None,
+        semantic_cache_query: str = None,
+    ) -> ChatClient:
+        if semantic_cache_scope is not None and self.semantic_cache is not None:
+            return SemanticCachedChatClient(
+                model, self.semantic_cache, semantic_cache_scope, semantic_cache_query
+            )
+        if self.model_router is not None:
+            return RoutedChatClient(model, self.model_router, self.rate_limiters)
         return ChatClient(model_config=model)
+
+    def new_cached_chat_client(self, model: ModelConfig) -> ChatClient:
+        """
+        A ChatClient that replays responses from the response cache, or None if the cache is disabled.
+        Chats only use it for the calls that ask for it.
+        """
+        if self.response_cache is None:
+            return None
+        return CachedChatClient(model, self.response_cache)
@@ -0,0 +1,40 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from llms.clients import HaivenAIMessage
+
+
+class FirstStep:
+    """
+    What the first step of a multi-step flow was based on. It is kept with the first step's chat session,
+    so that follow-up and explore requests can refer to it by the session id instead of sending it again.
+    """
+
+    def __init__(self, prompt_id: str, user_input: str, context: str = None):
+        self.prompt_id = prompt_id
+        self.user_input = user_input
+        self.context = context
+        self._rendered_context = None
+
+    def rendered_context(self, prompt_list) -> str:
+        # The knowledge context of a prompt is the same for all requests that refer to this step
+        if self._rendered_context is None:
+            self._rendered_context = (
+                prompt_list.get_rendered_context(self.context, self.prompt_id)
+                if self.context
+                else ""
+            )
+        return self._rendered_context
+
+    def output(self, chat_session) -> str:
+        """
+        The cards as they are now: the session's card state once it iterated on them, otherwise the
+        latest answer of the session, which is the first step's answer or a complete iteration on it.
+        """
+        card_state = getattr(chat_session, "card_state", None)
+        if card_state is not None:
+            return card_state.to_json()
+        answers = [
+            message
+            for message in chat_session.memory
+            if isinstance(message, HaivenAIMessage)
+        ]
+        return answers[-1].content if answers else None
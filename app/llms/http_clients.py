@@ -0,0 +1,110 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import threading
+from typing import List
+from urllib.parse import urlsplit
+
+import httpx
+
+from logger import HaivenLogger
+
+PROVIDER_ENDPOINTS = {
+    "openai": "https://api.openai.com",
+    "anthropic": "https://api.anthropic.com",
+    "google": "https://generativelanguage.googleapis.com",
+}
+
+
+def provider_endpoints(models: list) -> List[str]:
+    """
+    Returns the endpoints (scheme and host) the given model and embedding configurations talk to,
+    to open connections to them before the first request. Bedrock is called through boto3, not these pools.
+    """
+    endpoints = []
+    for model in models:
+        url = (
+            model.config.get("azure_endpoint")
+            or model.config.get("base_url")
+            or model.config.get("api_base")
+            or PROVIDER_ENDPOINTS.get(model.provider.lower())
+        )
+        if not url:
+            continue
+        parts = urlsplit(url)
+        endpoint = f"{parts.scheme}://{parts.netloc}"
+        if parts.scheme and parts.netloc and endpoint not in endpoints:
+            endpoints.append(endpoint)
+    return endpoints
+
+
+class HttpClients:
+    """
+    The HTTP clients shared by all model and embedding providers in the process. Their connection pools keep
+    connections to the providers alive, so that requests skip the TCP and TLS handshakes after the first one.
+    """
+
+    __instance = None
+
+    def __init__(
+        self,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry_seconds: float = 60,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry_seconds,
+        )
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def configure(**pool_options) -> "HttpClients":
+        HttpClients.__instance = HttpClients(**pool_options)
+        return HttpClients.__instance
+
+    @staticmethod
+    def get() -> "HttpClients":
+        if HttpClients.__instance is None:
+            HttpClients.configure()
+        return HttpClients.__instance
+
+    def client(self) -> httpx.Client:
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(limits=self.limits, timeout=600)
+            return self._client
+
+    def async_client(self) -> httpx.AsyncClient:
+        with self._lock:
+            if self._async_client is None:
+                self._async_client = httpx.AsyncClient(limits=self.limits, timeout=600)
+            return self._async_client
+
+    def warm_up(self, endpoints: List[str]):
+        """
+        Opens connections to the endpoints in the background, without delaying startup.
+        """
+        thread = threading.Thread(
+            target=self._warm_up, args=(endpoints,), name="http-warm-up", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def _warm_up(self, endpoints: List[str]):
+        for endpoint in endpoints:
+            try:
+                self.client().head(endpoint, timeout=5)
+            except httpx.HTTPError as error:
+                HaivenLogger.get().info(f"Could not warm up {endpoint}: {error}")
+
+    async def awarm_up(self, endpoints: List[str]):
+        """
+        Same as warm_up, for the pool of the async client, which has to be warmed up on the server's event loop.
+        """
+        for endpoint in endpoints:
+            try:
+                await self.async_client().head(endpoint, timeout=5)
+            except httpx.HTTPError as error:
+                HaivenLogger.get().info(f"Could not warm up {endpoint}: {error}")
@@ -0,0 +1,128 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import json
+
+from logger import HaivenLogger
+
+CLOSING = {"{": "}", "[": "]"}
+
+
+class JSONArrayParser:
+    """
+    Parses a JSON array of objects while it is streamed, and returns each object as soon as it is complete,
+    so that clients don't have to parse the whole output again for every chunk. Anything before the array
+    (e.g. the start of a markdown code block) and after it is ignored. A single object instead of an array
+    is treated like an array with one object. Objects are returned as (index, object) pairs, with their
+    position in the array, as several objects can be completed by the same chunk.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.truncated = False
+        self._element = []
+        # Open brackets of the current element, and the positions of commas between its members
+        self._stack = []
+        self._commas = []
+        self._in_string = False
+        self._escaped = False
+        self._in_array = False
+        self._finished = False
+
+    def feed(self, text: str) -> list:
+        objects = []
+        for char in text:
+            if self._finished:
+                break
+            if self._stack:
+                self._element.append(char)
+                complete = self._in_element(char)
+                if complete:
+                    objects += self._parse_element("".join(self._element))
+            else:
+                self._between_elements(char)
+        return objects
+
+    def _between_elements(self, char: str):
+        if self._in_string:
+            self._in_string = self._string_continues(char)
+        elif char == '"' and self._in_array:
+            self._in_string = True
+        elif char in CLOSING and (self._in_array or char == "{"):
+            self._element, self._stack, self._commas = [char], [char], []
+        elif char == "[":
+            self._in_array = True
+        elif char == "]" and self._in_array:
+            self._finished = True
+
+    def _in_element(self, char: str) -> bool:
+        if self._in_string:
+            self._in_string = self._string_continues(char)
+        elif char == '"':
+            self._in_string = True
+        elif char in CLOSING:
+            self._stack.append(char)
+        elif char in CLOSING.values():
+            self._stack.pop()
+            if not self._stack:
+                # An object on its own is the only element
+                self._finished = not self._in_array
+                return True
+        elif char == ",":
+            self._commas.append((len(self._element) - 1, list(self._stack)))
+        return False
+
+    def _string_continues(self, char: str) -> bool:
+        if self._escaped:
+            self._escaped = False
+            return True
+        if char == "\\":
+            self._escaped = True
+            return True
+        return char != '"'
+
+    def _parse_element(self, element: str) -> list:
+        self._element = []
+        try:
+            parsed = json.loads(element)
+        except json.JSONDecodeError as error:
+            HaivenLogger.get().error(f"Skipping invalid JSON in model output: {error}")
+            return []
+        self.count += 1
+        return [(self.count - 1, parsed)]
+
+    def close(self, complete_members_only: bool = False) -> tuple:
+        """
+        Returns the (index, object) pair of the object that was still being streamed when the output ended,
+        repaired if it is trivially truncated: open strings and brackets are closed, and incomplete members left out.
+        With `complete_members_only`, the object only has the members whose value was streamed completely,
+        e.g. to apply it as a change without a cut-off value.
+        """
+        if not self._stack:
+            return None
+        self.truncated = True
+        element = "".join(self._element)
+        if self._in_string:
+            element = (element[:-1] if self._escaped else element) + '"'
+        if complete_members_only:
+            # Members of the object itself are complete once the comma after them arrived
+            candidates = [
+                (element[:position], stack)
+                for position, stack in reversed(self._commas)
+                if len(stack) == 1
+            ][:1]
+        else:
+            candidates = [(element, self._stack)] + [
+                (element[:position], stack)
+                for position, stack in reversed(self._commas)
+            ]
+        self._stack = []
+        for candidate, stack in candidates:
+            repaired = candidate.rstrip().rstrip(",:") + "".join(
+                CLOSING[bracket] for bracket in reversed(stack)
+            )
+            try:
+                parsed = json.loads(repaired)
+            except json.JSONDecodeError:
+                continue
+            self.count += 1
+            return self.count - 1, parsed
+        return None
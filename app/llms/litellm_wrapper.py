@@ -1,13 +1,55 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
-from litellm import completion
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
-from litellm import RateLimitError
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential,
+)
+
+from llms.http_clients import HttpClients
+
+
+# LiteLLM takes seconds to import, so it is only loaded once the first model is called
+def _litellm():
+    import litellm
+
+    # Requests to all providers share the process' connection pools
+    http_clients = HttpClients.get()
+    litellm.client_session = http_clients.client()
+    litellm.aclient_session = http_clients.async_client()
+    return litellm
+
+
+def completion(**kwargs):
+    return _litellm().completion(**kwargs)
+
 
+async def acompletion(**kwargs):
+    return await _litellm().acompletion(**kwargs)
 
+
+def _is_rate_limit_error(error: BaseException) -> bool:
+    from litellm import RateLimitError
+
+    return isinstance(error, RateLimitError)
+
+
+# Requests are queued by the model's rate limiter, so a rate limit error only needs a short backoff
+# instead of tying up the request (and its worker thread) for a minute
 @retry(
-    stop=stop_after_attempt(2),
-    wait=wait_fixed(60),
-    retry=retry_if_exception_type(RateLimitError),
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=8),
+    retry=retry_if_exception(_is_rate_limit_error),
 )
 def llmCompletion(**kwargs):
     return completion(**kwargs)
+
+
+# Tenacity waits with asyncio.sleep for coroutines
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential(multiplier=1, min=2, max=8),
+    retry=retry_if_exception(_is_rate_limit_error),
+)
+async def llmAcompletion(**kwargs):
+    return await acompletion(**kwargs)
@@ -0,0 +1,236 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from typing import Callable, List
+
+from llms.clients import (
+    ChatClient,
+    HaivenAIMessage,
+    HaivenHumanMessage,
+    HaivenMessage,
+    HaivenSystemMessage,
+)
+from llms.rate_limiter import ModelRateLimiter, estimate_tokens
+from llms.tokens import count_tokens
+from logger import HaivenLogger
+
+SUMMARY_PROMPT = """Summarise the following conversation between a user and an assistant, so that the assistant
+can continue the conversation with only the summary. Keep all decisions, requirements, names and open questions,
+and for structured data (e.g. JSON), keep the ids and the gist of each item instead of the full data.
+
+{previous_summary}
+
+Conversation:
+{conversation}
+"""
+
+
+class MemoryManager:
+    """
+    Keeps the part of a conversation that is sent to the model within a token budget.
+    The system message and the first user message (which usually contains the rendered prompt)
+    are always sent, as are the most recent turns. Once the conversation grows beyond the budget,
+    the turns in between are compacted into a running summary, which is produced between turns.
+    Chats keep the full conversation in their memory regardless, e.g. to export it.
+
+    Summaries are requests to the chat's model like any other: they wait for their turn with the model's
+    `rate_limiter`, and their usage is reported to the `on_usage` callback of the turn that started them.
+    """
+
+    def __init__(
+        self,
+        chat_client: ChatClient,
+        max_tokens: int,
+        keep_recent_messages: int = 4,
+        compact_at: float = 0.75,
+        count_tokens: Callable[[str], int] = count_tokens,
+        rate_limiter: ModelRateLimiter = None,
+    ):
+        self.chat_client = chat_client
+        self.rate_limiter = rate_limiter
+        self.max_tokens = max_tokens
+        self.keep_recent_messages = keep_recent_messages
+        self.compact_at = compact_at
+        self._count_tokens = count_tokens
+        self._token_counts: dict[int, tuple[int, int]] = {}
+        self.summary: str = None
+        self.summary_tokens = 0
+        # Number of messages after the first user message that are contained in the summary
+        self.summarized_count = 0
+        self._compaction: asyncio.Task = None
+
+    def tokens(self, message: HaivenMessage) -> int:
+        # Answers grow while they are streamed, so counts are cached per message and length
+        cached = self._token_counts.get(id(message))
+        if cached is None or cached[0] != len(message.content):
+            cached = (len(message.content), self._count_tokens(message.content))
+            self._token_counts[id(message)] = cached
+        return cached[1]
+
+    def messages_for_model(self, memory: List[HaivenMessage]) -> List[HaivenMessage]:
+        pinned = memory[:2]
+        summary = (
+            [
+                HaivenSystemMessage(
+                    content=f"Summary of the conversation so far:\n{self.summary}"
+                )
+            ]
+            if self.summary
+            else []
+        )
+        recent = memory[2 + self.summarized_count :]
+
+        # Until a summary catches up, the oldest turns are left out to stay within the budget
+        budget = (
+            self.max_tokens
+            - self.summary_tokens
+            - sum(self.tokens(message) for message in pinned)
+        )
+        kept = []
+        for message in reversed(recent):
+            budget -= self.tokens(message)
+            if budget < 0 and kept:
+                break
+            kept.insert(0, message)
+        return pinned + summary + kept
+
+    def _unsummarized_tokens(self, memory: List[HaivenMessage]) -> int:
+        return self.summary_tokens + sum(
+            self.tokens(message)
+            for message in memory[:2] + memory[2 + self.summarized_count :]
+        )
+
+    def needs_compaction(self, memory: List[HaivenMessage]) -> bool:
+        return (
+            len(self._messages_to_compact(memory)) > 0
+            and self._unsummarized_tokens(memory) > self.max_tokens * self.compact_at
+        )
+
+    def _messages_to_compact(self, memory: List[HaivenMessage]) -> List[HaivenMessage]:
+        return memory[
+            2 + self.summarized_count : max(len(memory) - self.keep_recent_messages, 0)
+        ]
+
+    def _summary_request(self, messages: List[HaivenMessage]) -> List[HaivenMessage]:
+        conversation = "\n\n".join(
+            f"{_speaker(message)}: {message.content}" for message in messages
+        )
+        previous_summary = (
+            f"Summary of the conversation before:\n{self.summary}"
+            if self.summary
+            else ""
+        )
+        return [
+            HaivenHumanMessage(
+                content=SUMMARY_PROMPT.format(
+                    previous_summary=previous_summary, conversation=conversation
+                )
+            )
+        ]
+
+    def _summarizing_client(self) -> ChatClient:
+        # Summaries must not go through response caches, they are specific to one conversation
+        return ChatClient(self.chat_client.model_config)
+
+    def compact(
+        self, memory: List[HaivenMessage], on_usage: Callable[[dict], dict] = None
+    ):
+        messages = self._messages_to_compact(memory)
+        request = self._summary_request(messages)
+        reservation = None
+        if self.rate_limiter is not None:
+            # Waiting for a turn would block the thread, the next turn tries again instead
+            reservation = self.rate_limiter.try_acquire(estimate_tokens(request))
+            if reservation is None:
+                HaivenLogger.get().info(
+                    "Not summarising the conversation, the model's rate limit is reached"
+                )
+                return
+        chat_client = self._summarizing_client()
+        try:
+            summary = "".join(chunk["content"] for chunk in chat_client.stream(request))
+        except Exception as error:
+            HaivenLogger.get().error(f"Could not summarise the conversation: {error}")
+            return
+        finally:
+            if reservation is not None:
+                reservation.settle(chat_client.last_usage)
+                reservation.release()
+        self._record_usage(chat_client, on_usage)
+        self._apply_summary(summary, len(messages))
+
+    async def acompact(
+        self, memory: List[HaivenMessage], on_usage: Callable[[dict], dict] = None
+    ):
+        messages = self._messages_to_compact(memory)
+        request = self._summary_request(messages)
+        chat_client = self._summarizing_client()
+        reservation = None
+        try:
+            if self.rate_limiter is not None:
+                reservation = await self.rate_limiter.acquire(estimate_tokens(request))
+            summary = "".join(
+                [chunk["content"] async for chunk in chat_client.astream(request)]
+            )
+        except Exception as error:
+            HaivenLogger.get().error(f"Could not summarise the conversation: {error}")
+            return
+        finally:
+            if reservation is not None:
+                reservation.settle(chat_client.last_usage)
+                reservation.release()
+        self._record_usage(chat_client, on_usage)
+        self._apply_summary(summary, len(messages))
+
+    def _record_usage(
+        self, chat_client: ChatClient, on_usage: Callable[[dict], dict] = None
+    ):
+        if on_usage is not None and chat_client.last_usage is not None:
+            on_usage(chat_client.last_usage)
+
+    def _apply_summary(self, summary: str, compacted_count: int):
+        self.summary = summary
+        self.summary_tokens = self._count_tokens(summary)
+        self.summarized_count += compacted_count
+        HaivenLogger.get().info(
+            "Compacted conversation",
+            extra={
+                "compacted_messages": compacted_count,
+                "summary_tokens": self.summary_tokens,
+            },
+        )
+
+    def compact_in_background(
+        self, memory: List[HaivenMessage], on_usage: Callable[[dict], dict] = None
+    ):
+        """
+        Starts compacting the conversation after a turn, if it needs it, without delaying the response.
+        """
+        if self.compacting() or not self.needs_compaction(memory):
+            return
+        self._compaction = asyncio.get_running_loop().create_task(
+            self.acompact(memory, on_usage)
+        )
+
+    def compacting(self) -> bool:
+        return self._compaction is not None and not self._compaction.done()
+
+    async def wait_for_compaction(self, memory: List[HaivenMessage]):
+        """
+        Waits for a compaction that is still running when the next turn starts, but only if the
+        conversation does not fit into the budget without it.
+        """
+        if (
+            not self.compacting()
+            or self._unsummarized_tokens(memory) <= self.max_tokens
+        ):
+            return
+        if self._compaction.get_loop() is asyncio.get_running_loop():
+            await self._compaction
+
+
+def _speaker(message: HaivenMessage) -> str:
+    if isinstance(message, HaivenAIMessage):
+        return "Assistant"
+    if isinstance(message, HaivenSystemMessage):
+        return "System"
+    return "User"
@@ -10,6 +10,10 @@ class ModelConfig:
         name: str,
         features: List[str] = None,
         config: Dict[str, str] = None,
+        limits: Dict[str, str] = None,
+        tier: str = None,
+        prompt_token_budget: int = None,
+        stream_usage: bool = None,
     ):
         """
         Initialize a Model object.
@@ -20,12 +24,30 @@ class ModelConfig:
             name (str): The name of the model.
             features (List[str], optional): The list of features of the model. Defaults to None.
             config (Dict[str, str], optional): The configuration of the model. Defaults to None.
+            limits (Dict[str, str], optional): The rate limits of the model (max_concurrent, requests_per_minute,
+                tokens_per_minute, max_wait_seconds). Defaults to None.
+            tier (str, optional): Models with the same tier are equivalent, requests can fail over between them.
+                Defaults to None.
+            prompt_token_budget (int, optional): The maximum number of tokens of a conversation that is sent to
+                the model, older turns are summarised to stay within it. Defaults to None.
+            stream_usage (bool, optional): Whether to ask the provider for the token usage of streamed responses.
+                Defaults to None, which asks all providers but Azure, where older API versions reject the option.
         """
         self.id = id
         self.provider = provider
         self.name = name
         self.features = features if features else []
         self.config = config if config else {}
+        self.limits = limits if limits else {}
+        self.tier = tier
+        self.prompt_token_budget = (
+            int(prompt_token_budget) if prompt_token_budget else None
+        )
+        self.stream_usage = (
+            str(stream_usage).lower() == "true"
+            if stream_usage not in (None, "")
+            else None
+        )
         self.temperature = 0.5
 
         self.lite_id = provider.lower() + "/" + self.id
@@ -42,6 +64,24 @@ class ModelConfig:
         elif self.provider.lower() == "ollama":
             self.lite_id = "ollama/" + self.config["model"]
 
+    def supports_prompt_caching(self) -> bool:
+        """
+        Whether the provider caches prompt prefixes that are marked with cache control hints
+        (Anthropic, and Claude models on Bedrock).
+        """
+        if self.lite_id.startswith("anthropic/"):
+            return True
+        return self.lite_id.startswith("bedrock/") and "claude" in self.lite_id
+
+    def reports_stream_usage(self) -> bool:
+        """
+        Whether the provider reports token usage at the end of a streamed response. Otherwise the usage
+        is estimated locally.
+        """
+        if self.stream_usage is not None:
+            return self.stream_usage
+        return self.provider.lower() in ["openai", "anthropic", "aws"]
+
     @classmethod
     def from_dict(cls, data):
         """
@@ -59,4 +99,8 @@ class ModelConfig:
             name=data.get("name"),
             features=data.get("features"),
             config=data.get("config"),
+            limits=data.get("limits"),
+            tier=data.get("tier"),
+            prompt_token_budget=data.get("prompt_token_budget"),
+            stream_usage=data.get("stream_usage"),
         )
@@ -0,0 +1,117 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import threading
+from collections import deque
+from typing import List
+
+from llms.model_config import ModelConfig
+
+
+class ModelHealth:
+    """
+    The outcomes of a model's most recent requests: the time to the first token of successful ones,
+    and None for failed ones.
+    """
+
+    def __init__(self, window: int = 50):
+        self._outcomes: deque = deque(maxlen=window)
+
+    def record_first_token(self, seconds: float):
+        self._outcomes.append(seconds)
+
+    def record_error(self):
+        self._outcomes.append(None)
+
+    def sample_count(self) -> int:
+        return len(self._outcomes)
+
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0
+        return sum(1 for outcome in self._outcomes if outcome is None) / len(
+            self._outcomes
+        )
+
+    def first_token_percentile(self, percentile: float) -> float:
+        first_token_seconds = sorted(
+            outcome for outcome in self._outcomes if outcome is not None
+        )
+        if not first_token_seconds:
+            return None
+        position = int(len(first_token_seconds) * percentile / 100)
+        return first_token_seconds[min(position, len(first_token_seconds) - 1)]
+
+
+class ModelRouter:
+    """
+    Tracks how fast and reliable each model responds, and decides which models a request goes to.
+    Models with the same `tier` in the config are considered equivalent: a request goes to the configured model
+    first, and falls over to the others of its tier, fastest first, if it fails before its first token.
+    A model whose recent requests mostly failed is tried last until it recovers.
+
+    With a hedging percentile, a request that has not received its first token after that percentile of the
+    model's recent times to first token is started on the next model of the tier as well,
+    and the slower of the two is cancelled.
+    """
+
+    def __init__(
+        self,
+        models: List[ModelConfig],
+        hedging_percentile: float = None,
+        max_error_rate: float = 0.5,
+        min_samples: int = 10,
+    ):
+        self.models = models
+        self.hedging_percentile = hedging_percentile
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self._health: dict[str, ModelHealth] = {}
+        self._lock = threading.Lock()
+
+    def health(self, model_id: str) -> ModelHealth:
+        with self._lock:
+            return self._health.setdefault(model_id, ModelHealth())
+
+    def record_first_token(self, model_id: str, seconds: float):
+        self.health(model_id).record_first_token(seconds)
+
+    def record_error(self, model_id: str):
+        self.health(model_id).record_error()
+
+    def is_degraded(self, model_id: str) -> bool:
+        health = self.health(model_id)
+        return (
+            health.sample_count() >= self.min_samples
+            and health.error_rate() > self.max_error_rate
+        )
+
+    def candidates(self, model: ModelConfig) -> List[ModelConfig]:
+        """
+        Returns the models to try for a request to `model`, in order.
+        """
+        equivalents = [
+            candidate
+            for candidate in self.models
+            if model.tier and candidate.tier == model.tier and candidate.id != model.id
+        ]
+
+        def first_token_median(candidate: ModelConfig) -> float:
+            median = self.health(candidate.id).first_token_percentile(50)
+            return float("inf") if median is None else median
+
+        equivalents.sort(key=first_token_median)
+        ordered = [model] + equivalents
+        return [
+            candidate for candidate in ordered if not self.is_degraded(candidate.id)
+        ] + [candidate for candidate in ordered if self.is_degraded(candidate.id)]
+
+    def hedging_timeout(self, model: ModelConfig) -> float:
+        """
+        Returns after how many seconds without a first token the request is hedged with another model,
+        or None if it is not hedged.
+        """
+        if self.hedging_percentile is None:
+            return None
+        health = self.health(model.id)
+        if health.sample_count() < self.min_samples:
+            return None
+        return health.first_token_percentile(self.hedging_percentile)
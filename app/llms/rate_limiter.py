@@ -0,0 +1,279 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Callable, List
+
+from llms.model_config import ModelConfig
+
+
+TOO_MANY_STREAMS = "All streams to the model are busy, please try again later"
+TOO_MANY_REQUESTS = "The model's request limit is reached, please try again later"
+
+
+def estimate_tokens(messages: List) -> int:
+    """
+    Roughly 4 characters per token, good enough to stay below the provider's limit until the
+    actual usage is known.
+    """
+    return sum(len(message.content) for message in messages) // 4
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a request would have to wait longer than allowed for its turn with a model.
+    The status code is 429 when the model's request or token budget is used up,
+    and 503 when all concurrent streams are busy.
+    """
+
+    def __init__(self, message: str, status_code: int, retry_after_seconds: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after_seconds = retry_after_seconds
+
+
+class TokenBucket:
+    def __init__(self, per_minute: int, clock: Callable[[], float]):
+        self.capacity = per_minute
+        self.available = float(per_minute)
+        self._refill_per_second = per_minute / 60
+        self._clock = clock
+        self._refilled_at = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.available = min(
+            self.capacity,
+            self.available + (now - self._refilled_at) * self._refill_per_second,
+        )
+        self._refilled_at = now
+
+    def seconds_until_available(self, amount: float) -> float:
+        self._refill()
+        missing = min(amount, self.capacity) - self.available
+        return max(missing, 0) / self._refill_per_second
+
+    def take(self, amount: float) -> float:
+        taken = min(amount, self.capacity)
+        self.available -= taken
+        return taken
+
+    def correct(self, amount: float):
+        """
+        Takes what was taken too little, or gives back what was taken too much (a negative amount).
+        """
+        self._refill()
+        self.available = min(self.capacity, self.available - amount)
+
+
+class Reservation:
+    """
+    A request's turn with a model, held until its response is streamed completely.
+    """
+
+    def __init__(self, limiter: "ModelRateLimiter", taken_tokens: float = 0):
+        self._limiter = limiter
+        # The estimated tokens of the request, up to the whole token budget of a minute
+        self.taken_tokens = taken_tokens
+        self._released = False
+        self._settled = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._limiter._release()
+
+    def settle(self, usage: dict):
+        """
+        Replaces the estimated tokens with the prompt and completion tokens the response actually used,
+        once. The usage is None when the request did not use the model after all, e.g. because another
+        model answered it.
+        """
+        if self._settled:
+            return
+        self._settled = True
+        used_tokens = (
+            usage["prompt_tokens"] + usage["completion_tokens"] if usage else 0
+        )
+        self._limiter._correct(used_tokens - self.taken_tokens)
+
+
+class ModelRateLimiter:
+    """
+    Keeps the requests to one model within its limits: the number of concurrent streams, and the
+    requests and tokens per minute. The tokens of a request are estimated when it takes its turn,
+    and corrected with its actual usage when it is done. Requests that have to wait are queued and get their
+    turn in the order they arrived. A request fails with RateLimitExceeded instead of waiting longer than
+    `max_wait_seconds`, so that it does not tie up the server.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = None,
+        requests_per_minute: int = None,
+        tokens_per_minute: int = None,
+        max_wait_seconds: float = 30,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_wait_seconds = max_wait_seconds
+        self._clock = clock
+        self._requests = (
+            TokenBucket(requests_per_minute, clock) if requests_per_minute else None
+        )
+        self._tokens = (
+            TokenBucket(tokens_per_minute, clock) if tokens_per_minute else None
+        )
+        self._active = 0
+        self._queue = deque()
+        # The futures of the requests waiting for a change, with the event loop each of them waits on
+        self._waiting: dict[asyncio.Future, asyncio.AbstractEventLoop] = {}
+
+    @classmethod
+    def from_limits(cls, limits: dict) -> "ModelRateLimiter":
+        def value(key, parse):
+            configured = limits.get(key)
+            return None if configured is None or configured == "" else parse(configured)
+
+        max_wait_seconds = value("max_wait_seconds", float)
+        return cls(
+            max_concurrent=value("max_concurrent", int),
+            requests_per_minute=value("requests_per_minute", int),
+            tokens_per_minute=value("tokens_per_minute", int),
+            max_wait_seconds=30 if max_wait_seconds is None else max_wait_seconds,
+        )
+
+    def active(self) -> int:
+        return self._active
+
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    async def acquire(self, estimated_tokens: int = 0) -> Reservation:
+        deadline = self._clock() + self.max_wait_seconds
+        turn = object()
+        self._queue.append(turn)
+        try:
+            while True:
+                wait_seconds = self._seconds_until_turn(turn, estimated_tokens)
+                remaining_seconds = deadline - self._clock()
+                if wait_seconds is None:
+                    if remaining_seconds <= 0:
+                        raise RateLimitExceeded(TOO_MANY_STREAMS, 503, 1)
+                    # Short enough to check the deadline regularly, releases wake waiters up earlier
+                    await self._wait_for_change(min(remaining_seconds, 1.0))
+                elif wait_seconds == 0:
+                    self._queue.popleft()
+                    return Reservation(self, self._take(estimated_tokens))
+                elif wait_seconds > remaining_seconds:
+                    raise RateLimitExceeded(
+                        TOO_MANY_REQUESTS, 429, math.ceil(wait_seconds)
+                    )
+                else:
+                    await self._wait_for_change(wait_seconds)
+        finally:
+            if turn in self._queue:
+                self._queue.remove(turn)
+            self._notify()
+
+    def try_acquire(self, estimated_tokens: int = 0) -> Reservation:
+        """
+        Takes a turn with the model if that is possible right away, or returns None if the request would
+        have to wait, e.g. for a model that is only tried when another one is slow or failed.
+        """
+        if self._queue:
+            return None
+        turn = object()
+        self._queue.append(turn)
+        try:
+            if self._seconds_until_turn(turn, estimated_tokens) != 0:
+                return None
+            return Reservation(self, self._take(estimated_tokens))
+        finally:
+            self._queue.remove(turn)
+
+    def _seconds_until_turn(self, turn, estimated_tokens: int) -> float:
+        """
+        Returns how long the request has to wait at least for the rate limits, 0 if it is its turn,
+        or None if it waits for other requests in the queue or for a free stream, which takes an unknown time.
+        """
+        if self.max_concurrent is not None and self._active >= self.max_concurrent:
+            return None
+        if self._queue[0] is not turn:
+            return None
+
+        wait_seconds = 0
+        if self._requests is not None:
+            wait_seconds = max(wait_seconds, self._requests.seconds_until_available(1))
+        if self._tokens is not None:
+            wait_seconds = max(
+                wait_seconds, self._tokens.seconds_until_available(estimated_tokens)
+            )
+        return wait_seconds
+
+    async def _wait_for_change(self, seconds: float):
+        loop = asyncio.get_running_loop()
+        changed = loop.create_future()
+        self._waiting[changed] = loop
+        try:
+            await asyncio.wait_for(changed, timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._waiting.pop(changed, None)
+
+    def _take(self, estimated_tokens: int) -> float:
+        self._active += 1
+        if self._requests is not None:
+            self._requests.take(1)
+        if self._tokens is None:
+            return 0
+        return self._tokens.take(estimated_tokens)
+
+    def _release(self):
+        self._active -= 1
+        self._notify()
+
+    def _correct(self, tokens: int):
+        if self._tokens is not None and tokens:
+            self._tokens.correct(tokens)
+            self._notify()
+
+    def _notify(self):
+        # Reservations are also released from other threads, e.g. by summaries or by responses that are
+        # garbage collected, and futures must only be resolved on the thread of their event loop
+        for changed, loop in list(self._waiting.items()):
+            loop.call_soon_threadsafe(self._wake_up, changed)
+
+    @staticmethod
+    def _wake_up(changed: asyncio.Future):
+        if not changed.done():
+            changed.set_result(None)
+
+
+class ModelRateLimiters:
+    """
+    One ModelRateLimiter for each model with `limits` in the config.
+    """
+
+    def __init__(self):
+        self._limiters: dict[str, ModelRateLimiter] = {}
+
+    def get(self, model_config: ModelConfig) -> ModelRateLimiter:
+        if not model_config.limits:
+            return None
+        if model_config.id not in self._limiters:
+            self._limiters[model_config.id] = ModelRateLimiter.from_limits(
+                model_config.limits
+            )
+        return self._limiters[model_config.id]
+
+    def status(self) -> dict:
+        return {
+            model_id: {
+                "active": limiter.active(),
+                "queue_depth": limiter.queue_depth(),
+            }
+            for model_id, limiter in self._limiters.items()
+        }
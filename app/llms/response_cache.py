@@ -0,0 +1,111 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List
+
+from logger import HaivenLogger
+
+
+class ResponseCache:
+    """
+    Caches complete model responses by model, messages and generation parameters, so that generations
+    that only depend on their input are not sent to the model again.
+
+    Responses are kept as the list of chunks they were streamed in, so they can be replayed the same way.
+    The most recently used entries are kept in memory, and optionally also in a SQLite file that
+    survives restarts and can be shared by several processes.
+    """
+
+    def __init__(
+        self,
+        ttl_seconds: float,
+        max_entries: int = 1000,
+        sqlite_path: str = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._clock = clock
+
+        # key => (chunks, created at)
+        self._entries: OrderedDict[str, tuple[List[str], float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, chunks TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)"
+            )
+            self._db.commit()
+
+    @staticmethod
+    def key(model: str, messages: List[dict], params: dict = None) -> str:
+        return hashlib.sha256(
+            json.dumps(
+                {"model": model, "messages": messages, "params": params or {}},
+                sort_keys=True,
+            ).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, key: str) -> List[str]:
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                chunks, created_at = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    return chunks
+                del self._entries[key]
+
+            if self._db is None:
+                return None
+
+            row = self._db.execute(
+                "SELECT chunks, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                return None
+
+            chunks = json.loads(row[0])
+            self._remember(key, chunks, row[1])
+            return chunks
+
+    def put(self, key: str, chunks: List[str]):
+        created_at = self._clock()
+        with self._lock:
+            self._remember(key, chunks, created_at)
+
+            if self._db is None:
+                return
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, chunks, created_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(chunks), created_at),
+                )
+                self._db.execute(
+                    "DELETE FROM responses WHERE created_at < ?",
+                    (created_at - self.ttl_seconds,),
+                )
+                self._db.execute(
+                    "DELETE FROM responses WHERE key NOT IN (SELECT key FROM responses ORDER BY created_at DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+                self._db.commit()
+            except sqlite3.Error as error:
+                # The in-memory tier still works, so a full disk or locked file does not fail the request
+                HaivenLogger.get().error(f"Could not store cached response: {error}")
+
+    def _remember(self, key: str, chunks: List[str], created_at: float):
+        self._entries[key] = (chunks, created_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,107 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import bisect
+import threading
+import time
+from typing import Callable, List
+
+import numpy as np
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+
+
+class SemanticCacheScope:
+    """
+    The cached responses for one scope, e.g. a knowledge pack, prompt, model and context, with a FAISS index over the embedded requests.
+    """
+
+    def __init__(self):
+        self.requests: List[np.ndarray] = []
+        self.responses: List[List[str]] = []
+        self.created_at: List[float] = []
+        self.index = None
+
+    def remove_oldest(self, count: int):
+        del self.requests[:count]
+        del self.responses[:count]
+        del self.created_at[:count]
+        # Flat indexes are small and cannot remove entries by position, so they are rebuilt
+        self.index = None
+        if self.requests:
+            self.rebuild_index()
+
+    def rebuild_index(self):
+        faiss = dependable_faiss_import()
+        self.index = faiss.IndexFlatIP(len(self.requests[0]))
+        self.index.add(np.stack(self.requests))
+
+
+class SemanticResponseCache:
+    """
+    Serves a cached response for requests that are worded differently, but mean the same as one that was
+    answered before. Requests are only compared to others for the same knowledge pack, prompt, model and context (the "scope"),
+    and a cached response is only used if the cosine similarity of the embedded requests reaches the threshold.
+    Each scope keeps its `max_entries_per_scope` most recent responses, for up to `ttl_seconds`.
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[str], List[float]],
+        threshold: float = 0.95,
+        max_entries_per_scope: int = 100,
+        ttl_seconds: float = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self._embed = embed
+        self.threshold = threshold
+        self.max_entries_per_scope = max_entries_per_scope
+        self.ttl_seconds = ttl_seconds
+        self._clock = clock
+        self._scopes: dict[tuple, SemanticCacheScope] = {}
+        self._lock = threading.Lock()
+
+    def embed(self, request: str) -> np.ndarray:
+        vector = np.asarray(self._embed(request), dtype=np.float32)
+        return vector / max(np.linalg.norm(vector), 1e-12)
+
+    def _unexpired_scope(self, scope: tuple) -> SemanticCacheScope:
+        cache_scope = self._scopes.get(scope)
+        if cache_scope is None or self.ttl_seconds is None:
+            return cache_scope
+
+        # Entries are kept in the order they were added, so the expired ones come first
+        expired = bisect.bisect_left(
+            cache_scope.created_at, self._clock() - self.ttl_seconds
+        )
+        if expired == len(cache_scope.created_at):
+            del self._scopes[scope]
+            return None
+        if expired:
+            cache_scope.remove_oldest(expired)
+        return cache_scope
+
+    def get(self, scope: tuple, request_vector: np.ndarray) -> List[str]:
+        with self._lock:
+            cache_scope = self._unexpired_scope(scope)
+            if cache_scope is None or cache_scope.index is None:
+                return None
+
+            similarities, positions = cache_scope.index.search(
+                request_vector.reshape(1, -1), 1
+            )
+            if positions[0][0] < 0 or similarities[0][0] < self.threshold:
+                return None
+            return cache_scope.responses[positions[0][0]]
+
+    def put(self, scope: tuple, request_vector: np.ndarray, chunks: List[str]):
+        with self._lock:
+            cache_scope = self._unexpired_scope(scope)
+            if cache_scope is None:
+                cache_scope = self._scopes[scope] = SemanticCacheScope()
+            cache_scope.requests.append(request_vector)
+            cache_scope.responses.append(chunks)
+            cache_scope.created_at.append(self._clock())
+            if len(cache_scope.requests) > self.max_entries_per_scope:
+                cache_scope.remove_oldest(1)
+            elif cache_scope.index is None:
+                cache_scope.rebuild_index()
+            else:
+                cache_scope.index.add(request_vector.reshape(1, -1))
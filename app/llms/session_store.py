@@ -0,0 +1,360 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import base64
+import hmac
+import json
+import sqlite3
+import threading
+import zlib
+from typing import Optional
+
+import httpx
+from fastapi import Depends, FastAPI, Header, HTTPException
+from pydantic import BaseModel
+
+from llms.http_clients import HttpClients
+
+ENTRY_FIELDS = ["created_at", "last_access", "user", "version", "chat"]
+
+
+def encode_chat_state(state: dict) -> bytes:
+    return zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+
+
+def decode_chat_state(encoded: bytes) -> dict:
+    return json.loads(zlib.decompress(encoded).decode("utf-8"))
+
+
+class SessionStore:
+    """
+    Where ServerChatSessionMemory keeps chat sessions, as entries with the fields "created_at", "last_access",
+    "user", "version" and "chat". Stores that are `shared` between processes get the chat's state encoded
+    as bytes, with a new "version" whenever it changes. The in-memory store gets the chat object itself.
+    """
+
+    shared = False
+
+    def get(self, key: str) -> dict:
+        raise NotImplementedError
+
+    def access(self, key: str, last_access: float) -> dict:
+        """
+        Sets the time the session was last accessed and returns it, or None if there is no such session,
+        in one call instead of a get and an update.
+        """
+        raise NotImplementedError
+
+    def create(self, key: str, entry: dict):
+        raise NotImplementedError
+
+    def update(self, key: str, **fields):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def remove_older_than(self, last_access: float) -> list[str]:
+        """
+        Removes the sessions that were last accessed before the given time, and returns their keys.
+        """
+        raise NotImplementedError
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    Keeps the sessions in a dict of the process, so they are lost on restart and not seen by other processes.
+    """
+
+    def __init__(self):
+        self.entries: dict[str, dict] = {}
+        # Old sessions are removed in the background
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> dict:
+        return self.entries.get(key)
+
+    def access(self, key: str, last_access: float) -> dict:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry["last_access"] = last_access
+            return entry
+
+    def create(self, key: str, entry: dict):
+        with self._lock:
+            self.entries[key] = dict(entry)
+
+    def update(self, key: str, **fields):
+        with self._lock:
+            self.entries[key].update(fields)
+
+    def delete(self, key: str):
+        with self._lock:
+            self.entries.pop(key, None)
+
+    def remove_older_than(self, last_access: float) -> list[str]:
+        with self._lock:
+            removed = [
+                key
+                for key, entry in self.entries.items()
+                if entry["last_access"] < last_access
+            ]
+            for key in removed:
+                del self.entries[key]
+        return removed
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Keeps the sessions in a SQLite file, which all worker processes on a host can share and which survives
+    restarts. The file is in WAL mode, so that reading sessions does not wait for other workers' writes.
+    """
+
+    shared = True
+
+    def __init__(self, path: str, busy_timeout_seconds: float = 5):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path, timeout=busy_timeout_seconds, check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chat_sessions (key TEXT PRIMARY KEY, created_at REAL NOT NULL, last_access REAL NOT NULL, user TEXT, version TEXT, chat BLOB)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS chat_sessions_last_access ON chat_sessions (last_access)"
+        )
+        self._db.commit()
+
+    def get(self, key: str) -> dict:
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(ENTRY_FIELDS)} FROM chat_sessions WHERE key = ?",
+                (key,),
+            ).fetchone()
+        return dict(zip(ENTRY_FIELDS, row)) if row else None
+
+    def access(self, key: str, last_access: float) -> dict:
+        with self._lock:
+            row = self._db.execute(
+                f"UPDATE chat_sessions SET last_access = ? WHERE key = ? RETURNING {', '.join(ENTRY_FIELDS)}",
+                (last_access, key),
+            ).fetchone()
+            self._db.commit()
+        return dict(zip(ENTRY_FIELDS, row)) if row else None
+
+    def create(self, key: str, entry: dict):
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO chat_sessions (key, {', '.join(ENTRY_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, *[entry.get(field) for field in ENTRY_FIELDS]),
+            )
+            self._db.commit()
+
+    def update(self, key: str, **fields):
+        unknown = set(fields) - set(ENTRY_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown session fields {', '.join(sorted(unknown))}")
+        with self._lock:
+            self._db.execute(
+                f"UPDATE chat_sessions SET {', '.join(f'{field} = ?' for field in fields)} WHERE key = ?",
+                (*fields.values(), key),
+            )
+            self._db.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._db.execute("DELETE FROM chat_sessions WHERE key = ?", (key,))
+            self._db.commit()
+
+    def remove_older_than(self, last_access: float) -> list[str]:
+        with self._lock:
+            removed = [
+                row[0]
+                for row in self._db.execute(
+                    "DELETE FROM chat_sessions WHERE last_access < ? RETURNING key",
+                    (last_access,),
+                ).fetchall()
+            ]
+            self._db.commit()
+        return removed
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM chat_sessions").fetchone()[0]
+
+
+def _to_json(entry: dict) -> dict:
+    if entry.get("chat") is None:
+        return entry
+    return {**entry, "chat": base64.b64encode(entry["chat"]).decode("ascii")}
+
+
+def _from_json(entry: dict) -> dict:
+    if entry.get("chat") is None:
+        return entry
+    return {**entry, "chat": base64.b64decode(entry["chat"])}
+
+
+class HTTPSessionStore(SessionStore):
+    """
+    Keeps the sessions in a session store service that all nodes can reach, see `session_store_service`.
+    Requests are authenticated with the token that the service was started with.
+    """
+
+    shared = True
+
+    def __init__(
+        self,
+        base_url: str,
+        token: str,
+        client: httpx.Client = None,
+        timeout_seconds: float = 10,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout_seconds = timeout_seconds
+        self._headers = {"Authorization": f"Bearer {token}"}
+        self._client = client
+
+    def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        client = self._client or HttpClients.get().client()
+        return client.request(
+            method,
+            f"{self.base_url}/sessions{path}",
+            headers=self._headers,
+            timeout=self.timeout_seconds,
+            **kwargs,
+        )
+
+    def get(self, key: str) -> dict:
+        response = self._request("GET", f"/{key}")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return _from_json(response.json())
+
+    def access(self, key: str, last_access: float) -> dict:
+        response = self._request(
+            "POST", f"/{key}/access", json={"last_access": last_access}
+        )
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return _from_json(response.json())
+
+    def create(self, key: str, entry: dict):
+        self._request("PUT", f"/{key}", json=_to_json(entry)).raise_for_status()
+
+    def update(self, key: str, **fields):
+        self._request("PATCH", f"/{key}", json=_to_json(fields)).raise_for_status()
+
+    def delete(self, key: str):
+        self._request("DELETE", f"/{key}").raise_for_status()
+
+    def remove_older_than(self, last_access: float) -> list[str]:
+        response = self._request("POST", "/expired", json={"last_access": last_access})
+        response.raise_for_status()
+        return response.json()["removed"]
+
+    def __len__(self) -> int:
+        response = self._request("GET", "")
+        response.raise_for_status()
+        return response.json()["count"]
+
+
+class SessionEntry(BaseModel):
+    created_at: Optional[float] = None
+    last_access: Optional[float] = None
+    user: Optional[str] = None
+    version: Optional[str] = None
+    chat: Optional[str] = None
+
+
+class LastAccess(BaseModel):
+    last_access: float
+
+
+def session_store_service(store: SessionStore, token: str) -> FastAPI:
+    """
+    The HTTP service that HTTPSessionStore talks to, which keeps the sessions in another store,
+    e.g. a SQLiteSessionStore on a host that all nodes can reach. Chat sessions contain the
+    conversations of all users, so every request has to send the shared `token` as a bearer token.
+    """
+    if not token:
+        raise ValueError(
+            "The session store service needs a token to authenticate requests"
+        )
+    expected = f"Bearer {token}".encode("utf-8")
+
+    def authenticated(authorization: str = Header(default="")):
+        if not hmac.compare_digest(authorization.encode("utf-8"), expected):
+            raise HTTPException(status_code=401, detail="Invalid session store token")
+
+    service = FastAPI(dependencies=[Depends(authenticated)])
+
+    @service.get("/sessions")
+    def count():
+        return {"count": len(store)}
+
+    @service.post("/sessions/expired")
+    def remove_expired(expiry: LastAccess):
+        return {"removed": store.remove_older_than(expiry.last_access)}
+
+    @service.get("/sessions/{key}")
+    def get(key: str):
+        entry = store.get(key)
+        if entry is None:
+            raise HTTPException(status_code=404, detail=f"Unknown session {key}")
+        return _to_json(entry)
+
+    @service.post("/sessions/{key}/access")
+    def access(key: str, access: LastAccess):
+        entry = store.access(key, access.last_access)
+        if entry is None:
+            raise HTTPException(status_code=404, detail=f"Unknown session {key}")
+        return _to_json(entry)
+
+    @service.put("/sessions/{key}")
+    def create(key: str, entry: SessionEntry):
+        store.create(key, _from_json(entry.model_dump()))
+        return {}
+
+    @service.patch("/sessions/{key}")
+    def update(key: str, entry: SessionEntry):
+        store.update(key, **_from_json(entry.model_dump(exclude_unset=True)))
+        return {}
+
+    @service.delete("/sessions/{key}")
+    def delete(key: str):
+        store.delete(key)
+        return {}
+
+    return service
+
+
+def create_session_store(url: str = None, token: str = None) -> SessionStore:
+    """
+    The store for the given `chat_session_store` setting: empty for the in-memory store,
+    sqlite:<path> for a SQLite file, or the http(s) URL of a session store service,
+    which needs the service's `token`.
+    """
+    if not url:
+        return InMemorySessionStore()
+    if url.startswith("sqlite:"):
+        path = url.removeprefix("sqlite:")
+        return SQLiteSessionStore(path[2:] if path.startswith("//") else path)
+    if url.startswith(("http://", "https://")):
+        if not token:
+            raise ValueError(
+                "A chat session store service needs a token, set chat_session_store_token"
+            )
+        return HTTPSessionStore(url, token)
+    raise ValueError(
+        f"Unsupported chat session store {url}, use sqlite:<path> or an http(s) URL"
+    )
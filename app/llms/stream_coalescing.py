@@ -0,0 +1,67 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+
+from llms.streams import END_OF_STREAM, next_chunk
+
+
+class StreamCoalescing:
+    """
+    Combines the small chunks that models stream (often only a few characters each) into fewer, larger ones,
+    so that every event sent to the client carries more of the answer. A combined chunk is sent once its first
+    part is `window_seconds` old or it is `max_chars` long. The first chunk of an answer is always passed on
+    right away, so the time to the first token does not change.
+    """
+
+    def __init__(self, window_seconds: float, max_chars: int = 1024):
+        self.window_seconds = window_seconds
+        self.max_chars = max_chars
+
+    async def coalesce(self, chunks):
+        """
+        Coalesces a stream of chat client chunks, i.e. dicts with the "content" of each chunk.
+        """
+        loop = asyncio.get_running_loop()
+        parts, size, deadline = [], 0, None
+        pending_chunk = None
+        try:
+            first_chunk = await next_chunk(chunks)
+            if first_chunk is END_OF_STREAM:
+                return
+            yield first_chunk
+
+            while True:
+                if pending_chunk is None:
+                    pending_chunk = asyncio.ensure_future(next_chunk(chunks))
+                if parts:
+                    await asyncio.wait(
+                        {pending_chunk}, timeout=max(deadline - loop.time(), 0)
+                    )
+                    if not pending_chunk.done():
+                        yield {"content": "".join(parts)}
+                        parts, size, deadline = [], 0, None
+                        continue
+
+                try:
+                    chunk = await pending_chunk
+                except Exception:
+                    # What arrived before the model failed is still part of the answer
+                    if parts:
+                        yield {"content": "".join(parts)}
+                    raise
+                pending_chunk = None
+                if chunk is END_OF_STREAM:
+                    break
+                parts.append(chunk["content"])
+                size += len(chunk["content"])
+                deadline = deadline or loop.time() + self.window_seconds
+                if size >= self.max_chars:
+                    yield {"content": "".join(parts)}
+                    parts, size, deadline = [], 0, None
+
+            if parts:
+                yield {"content": "".join(parts)}
+        finally:
+            if pending_chunk is not None and not pending_chunk.done():
+                pending_chunk.cancel()
+                await asyncio.wait({pending_chunk})
+            await chunks.aclose()
@@ -0,0 +1,15 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+
+# Returned by next_chunk when a stream is exhausted
+END_OF_STREAM = object()
+
+
+async def next_chunk(stream):
+    """
+    Awaits the next chunk of an async stream, or returns END_OF_STREAM instead of raising StopAsyncIteration,
+    so that it can be awaited as a task, e.g. to race several streams or to wait for a chunk with a timeout.
+    """
+    try:
+        return await stream.__anext__()
+    except StopAsyncIteration:
+        return END_OF_STREAM
@@ -0,0 +1,29 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from functools import lru_cache
+
+from logger import HaivenLogger
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    import tiktoken
+
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as error:
+        # The encoding is downloaded on first use, which fails without internet access
+        HaivenLogger.get().error(
+            f"Could not load the tokenizer, estimating tokens from characters: {error}"
+        )
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens of a text with the tokenizer of OpenAI's current models, which is close enough
+    for other models to estimate usage and budgets.
+    """
+    encoding = _encoding()
+    if encoding is None:
+        return len(text) // 4
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,85 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import threading
+from collections import OrderedDict
+
+
+class UsageTotals:
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self._time_to_first_token_seconds = 0.0
+        self._timed_requests = 0
+        self._generation_seconds = 0.0
+
+    def add(self, usage: dict):
+        self.requests += 1
+        self.prompt_tokens += usage["prompt_tokens"]
+        self.completion_tokens += usage["completion_tokens"]
+        self.cached_tokens += usage["cache_read_input_tokens"]
+        if usage["time_to_first_token_seconds"] is not None:
+            self._timed_requests += 1
+            self._time_to_first_token_seconds += usage["time_to_first_token_seconds"]
+            self._generation_seconds += (
+                usage["duration_seconds"] - usage["time_to_first_token_seconds"]
+            )
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "average_time_to_first_token_seconds": (
+                round(self._time_to_first_token_seconds / self._timed_requests, 3)
+                if self._timed_requests
+                else None
+            ),
+            "tokens_per_second": (
+                round(self.completion_tokens / self._generation_seconds, 1)
+                if self._generation_seconds
+                else None
+            ),
+        }
+
+
+class UsageAccounting:
+    """
+    Adds up the model usage of requests in memory, per chat session, (hashed) user and prompt id.
+    Each of them keeps the `max_entries` most recently used keys, e.g. sessions expire anyway.
+    """
+
+    DIMENSIONS = ["session", "user", "prompt"]
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._totals = {dimension: OrderedDict() for dimension in self.DIMENSIONS}
+        self._lock = threading.Lock()
+
+    def record(
+        self, usage: dict, session: str = None, user: str = None, prompt_id: str = None
+    ):
+        keys = {"session": session, "user": user, "prompt": prompt_id}
+        with self._lock:
+            for dimension, key in keys.items():
+                if key is None:
+                    continue
+                totals = self._totals[dimension]
+                if key not in totals:
+                    totals[key] = UsageTotals()
+                totals.move_to_end(key)
+                totals[key].add(usage)
+                if len(totals) > self.max_entries:
+                    totals.popitem(last=False)
+
+    def totals(self, dimension: str, key: str) -> dict:
+        with self._lock:
+            totals = self._totals[dimension].get(key)
+            return totals.to_dict() if totals else UsageTotals().to_dict()
+
+    def all_totals(self, dimension: str) -> dict:
+        with self._lock:
+            return {
+                key: totals.to_dict() for key, totals in self._totals[dimension].items()
+            }
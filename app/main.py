@@ -3,8 +3,8 @@ import os
 
 import uvicorn
 from dotenv import load_dotenv
-from app import App
 from logger import HaivenLogger
+from startup_profiler import StartupProfiler
 
 
 def backwards_compat_env_vars():
@@ -30,8 +30,16 @@ def create_server():
     DEFAULT_CONFIG_PATH = "config.yaml"
 
     HaivenLogger.get().logger.info("Starting Haiven...")
-    app = App(DEFAULT_CONFIG_PATH)
-    return app.launch_via_fastapi_wrapper()
+    profiler = StartupProfiler()
+    with profiler.phase("imports"):
+        from app import App
+
+    app = App(DEFAULT_CONFIG_PATH, profiler)
+    with profiler.phase("prompt testing ui"):
+        server = app.launch_via_fastapi_wrapper()
+
+    profiler.log()
+    return server
 
 
 def main():
@@ -3,9 +3,9 @@ import os
 import yaml
 from typing import List
 
-import frontmatter
 from langchain.prompts import PromptTemplate
 from knowledge.markdown import KnowledgeBaseMarkdown
+from knowledge.pack_files import PackFileReader
 
 
 class PromptList:
@@ -15,6 +15,7 @@ class PromptList:
         knowledge_base: KnowledgeBaseMarkdown,
         variables=[],
         root_dir="teams",
+        pack_file_reader: PackFileReader = None,
     ):
         data_sources = {
             "diagrams": {
@@ -33,20 +34,20 @@ class PromptList:
         }
 
         self.interaction_pattern_name = data_sources[interaction_type]["title"]
-
-        directory = data_sources[interaction_type]["dir"]
-        prompt_files = sorted(
-            [f for f in os.listdir(directory) if f.endswith(".md") and f != "README.md"]
-        )
-        self.prompts = [
-            frontmatter.load(os.path.join(directory, filename))
-            for filename in prompt_files
-        ]
+        self.directory = data_sources[interaction_type]["dir"]
 
         self.knowledge_base = knowledge_base
         self.extra_variables = variables
+        self.pack_file_reader = pack_file_reader or PackFileReader.default()
 
-        for prompt in self.prompts:
+        self.prompts, self.prompt_flows = self._load_prompts()
+
+    def _load_prompts(self):
+        prompts = self.pack_file_reader.load_all(
+            self.pack_file_reader.list_markdown_files(self.directory)
+        )
+
+        for prompt in prompts:
             if "title" not in prompt.metadata:
                 prompt.metadata["title"] = "Unnamed use case"
             if "system" not in prompt.metadata:
@@ -60,15 +61,27 @@ class PromptList:
             if "show" not in prompt.metadata:
                 prompt.metadata["show"] = True
 
-        self.prompt_flows = self.load_prompt_flows(
-            os.path.join(directory, "prompt_flows.yaml")
+        prompt_flows = self.load_prompt_flows(
+            os.path.join(self.directory, "prompt_flows.yaml")
         )
+        return prompts, prompt_flows
+
+    def reload(self):
+        """
+        Re-reads all prompt files and swaps them in at once, so that requests
+        in flight keep working on a consistent list while the files are parsed.
+        """
+        self.prompts, self.prompt_flows = self._load_prompts()
+
+    def is_loaded_from(self, path: str) -> bool:
+        return os.path.abspath(os.path.dirname(path)) == os.path.abspath(self.directory)
 
     def load_prompt_flows(self, prompt_flows_path):
-        if prompt_flows_path and os.path.exists(prompt_flows_path):
+        if prompt_flows_path and self.pack_file_reader.exists(prompt_flows_path):
             try:
-                with open(prompt_flows_path, "r") as file:
-                    return yaml.safe_load(file)
+                return yaml.safe_load(
+                    self.pack_file_reader.read_text(prompt_flows_path)
+                )
             except FileNotFoundError:
                 print(
                     f"Warning: No file {prompt_flows_path} found, moving on without flows."
@@ -305,6 +318,9 @@ class PromptList:
             prompts_with_follow_ups.append(prompt_data)
         return prompts_with_follow_ups
 
+    def uses_semantic_cache(self, identifier):
+        return self.get(identifier).metadata.get("semantic_cache", False) is True
+
     def produces_json_output(self, identifier):
         prompt = self.get(identifier)
         return (
@@ -1,26 +1,37 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 from knowledge.markdown import KnowledgeBaseMarkdown
+from knowledge.pack_files import PackFileReader
 from prompts.prompts import PromptList
 
 
 class PromptsFactory:
-    def __init__(self, prompts_parent_dir: str):
+    def __init__(
+        self, prompts_parent_dir: str, pack_file_reader: PackFileReader = None
+    ):
         self.prompts_parent_dir = prompts_parent_dir
+        self.pack_file_reader = pack_file_reader
 
     def create_all_prompts_for_user_choice(
         self, knowledge_base_markdown: KnowledgeBaseMarkdown
     ):
         return [
             PromptList(
-                "chat", knowledge_base_markdown, root_dir=self.prompts_parent_dir
+                "chat",
+                knowledge_base_markdown,
+                root_dir=self.prompts_parent_dir,
+                pack_file_reader=self.pack_file_reader,
             ),
             PromptList(
                 "brainstorming",
                 knowledge_base_markdown,
                 root_dir=self.prompts_parent_dir,
+                pack_file_reader=self.pack_file_reader,
             ),
             PromptList(
-                "diagrams", knowledge_base_markdown, root_dir=self.prompts_parent_dir
+                "diagrams",
+                knowledge_base_markdown,
+                root_dir=self.prompts_parent_dir,
+                pack_file_reader=self.pack_file_reader,
             ),
         ]
 
@@ -28,12 +39,18 @@ class PromptsFactory:
         self, knowledge_base_markdown: KnowledgeBaseMarkdown
     ):
         return PromptList(
-            "brainstorming", knowledge_base_markdown, root_dir=self.prompts_parent_dir
+            "brainstorming",
+            knowledge_base_markdown,
+            root_dir=self.prompts_parent_dir,
+            pack_file_reader=self.pack_file_reader,
         )
 
     def create_chat_prompt_list(self, knowledge_base_markdown: KnowledgeBaseMarkdown):
         return PromptList(
-            "chat", knowledge_base_markdown, root_dir=self.prompts_parent_dir
+            "chat",
+            knowledge_base_markdown,
+            root_dir=self.prompts_parent_dir,
+            pack_file_reader=self.pack_file_reader,
         )
 
     def create_diagrams_prompt_list(
@@ -44,6 +61,7 @@ class PromptsFactory:
             knowledge_base,
             variables=variables,
             root_dir=self.prompts_parent_dir,
+            pack_file_reader=self.pack_file_reader,
         )
 
     def create_guided_prompt_list(self, knowledge_base: KnowledgeBaseMarkdown):
@@ -64,4 +82,5 @@ class PromptsFactory:
                 "input",
             ],
             root_dir=self.prompts_parent_dir,
+            pack_file_reader=self.pack_file_reader,
         )
@@ -1,11 +1,13 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 import json
 
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse
 from fastapi.templating import Jinja2Templates
 
 from api.boba_api import BobaApi
 from config_service import ConfigService
+from knowledge.pack import KnowledgePackError
+from knowledge.registry import KnowledgePackRegistry
 from llms.chats import ChatManager
 from logger import HaivenLogger
 from fastapi import FastAPI
@@ -31,11 +33,13 @@ class Server:
         chat_manager: ChatManager,
         config_service: ConfigService,
         boba_api: BobaApi = None,
+        knowledge_packs: KnowledgePackRegistry = None,
     ):
         self.url = HaivenUrl()
         self.chat_manager = chat_manager
         self.config_service = config_service
         self.boba_api = boba_api
+        self.knowledge_packs = knowledge_packs
         # Initialize Jinja2Templates with autoescape=True for XSS protection
         self.templates = Jinja2Templates(directory="./resources/html_templates")
         self.templates.env.autoescape = True
@@ -132,6 +136,24 @@ class Server:
                 )
             return await call_next(request)
 
+        if self.knowledge_packs is not None:
+
+            @app.middleware("http")
+            async def select_knowledge_pack(request: Request, call_next):
+                user = request.session.get("user") or {}
+                try:
+                    knowledge_pack_id = self.knowledge_packs.select(
+                        request.headers.get(KnowledgePackRegistry.HEADER),
+                        user.get("groups"),
+                    )
+                except KnowledgePackError as error:
+                    return JSONResponse({"detail": str(error)}, status_code=404)
+                except PermissionError as error:
+                    return JSONResponse({"detail": str(error)}, status_code=403)
+
+                with self.knowledge_packs.selected(knowledge_pack_id):
+                    return await call_next(request)
+
         async def check_authentication(request: Request, call_next):
             allowlist = [
                 "/",
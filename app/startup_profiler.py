@@ -0,0 +1,58 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import sys
+import time
+from contextlib import contextmanager
+
+from logger import HaivenLogger
+
+
+class StartupPhase:
+    def __init__(self, name: str, seconds: float, imported_modules: int):
+        self.name = name
+        self.seconds = seconds
+        self.imported_modules = imported_modules
+
+
+class StartupProfiler:
+    """
+    Measures how long each phase of the server startup takes, and how many modules were
+    imported during it, so that slow imports and initialization steps are easy to spot.
+    """
+
+    def __init__(self):
+        self.phases: list[StartupPhase] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        modules_before = len(sys.modules)
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append(
+                StartupPhase(
+                    name,
+                    time.perf_counter() - started_at,
+                    len(sys.modules) - modules_before,
+                )
+            )
+
+    def total_seconds(self) -> float:
+        return sum(phase.seconds for phase in self.phases)
+
+    def report(self) -> str:
+        phases = ", ".join(
+            f"{phase.name} {phase.seconds:.2f}s ({phase.imported_modules} modules imported)"
+            for phase in self.phases
+        )
+        return f"Startup took {self.total_seconds():.2f}s: {phases}"
+
+    def log(self):
+        HaivenLogger.get().info(
+            self.report(),
+            extra={
+                "STARTUP_PROFILE": {
+                    phase.name: round(phase.seconds, 3) for phase in self.phases
+                }
+            },
+        )
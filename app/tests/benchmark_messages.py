@@ -0,0 +1,73 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+"""
+Microbenchmark of streaming a long answer into a message, comparing the previous pydantic message
+that was extended with `content += chunk` to the current one that collects chunks with `append`.
+
+Run from the app folder: python -m tests.benchmark_messages
+"""
+
+import json
+import timeit
+
+from pydantic import BaseModel
+
+from llms.clients import HaivenAIMessage
+
+
+class PydanticMessage(BaseModel):
+    content: str
+
+
+def card_output_chunks(cards: int, chunk_size: int = 4) -> list[str]:
+    # Models stream a few characters per chunk
+    output = json.dumps(
+        [
+            {
+                "id": index,
+                "title": f"Scenario {index}",
+                "summary": "A description of what could happen in this scenario. " * 5,
+            }
+            for index in range(cards)
+        ]
+    )
+    return [output[i : i + chunk_size] for i in range(0, len(output), chunk_size)]
+
+
+def stream_into_pydantic_message(chunks: list[str]) -> str:
+    message = PydanticMessage(content="")
+    for chunk in chunks:
+        message.content += chunk
+    return message.content
+
+
+def stream_into_message(chunks: list[str]) -> str:
+    message = HaivenAIMessage(content="")
+    for chunk in chunks:
+        message.append(chunk)
+    message.finalize()
+    return message.content
+
+
+def main():
+    for cards in [10, 100, 1000]:
+        chunks = card_output_chunks(cards)
+        assert stream_into_message(chunks) == stream_into_pydantic_message(chunks)
+        results = {
+            name: min(timeit.repeat(lambda: fn(chunks), number=3, repeat=3)) / 3
+            for name, fn in [
+                ("content +=", stream_into_pydantic_message),
+                ("append", stream_into_message),
+            ]
+        }
+        size = sum(len(chunk) for chunk in chunks)
+        print(
+            f"{cards} cards ({size} characters in {len(chunks)} chunks): "
+            + ", ".join(
+                f"{name} {seconds * 1000:.2f}ms" for name, seconds in results.items()
+            )
+            + f", {results['content +='] / results['append']:.1f}x faster"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,30 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import gc
 import json
 import unittest
 from unittest.mock import MagicMock, patch, ANY
 from fastapi.testclient import TestClient
 from fastapi import FastAPI
-from api.api_basics import ApiBasics
+from api.api_basics import ApiBasics, cancel_on_disconnect
 from api.api_multi_step import ApiMultiStep
 from api.api_scenarios import ApiScenarios
 from api.api_creative_matrix import ApiCreativeMatrix
+from llms.card_state import CardState
+from llms.chats import JSONChat
+from llms.clients import HaivenAIMessage, HaivenHumanMessage
+from llms.first_step import FirstStep
+from llms.model_config import ModelConfig
+from llms.rate_limiter import ModelRateLimiters
 from prompts.prompts_factory import PromptsFactory
 from tests.utils import get_test_data_path
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.requests import ClientDisconnect
+
+
+async def stream_chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
 
 
 class TestApi(unittest.TestCase):
@@ -173,7 +187,9 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_streaming_chat,
     ):
-        mock_streaming_chat.run.return_value = "some response from the model"
+        mock_streaming_chat.arun.return_value = stream_chunks(
+            "some response from the model"
+        )
         mock_chat_manager.streaming_chat.return_value = (
             "some_key",
             mock_streaming_chat,
@@ -219,7 +235,7 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_json_chat,
     ):
-        mock_json_chat.run.return_value = "some response from the model"
+        mock_json_chat.arun.return_value = stream_chunks("some response from the model")
         mock_chat_manager.json_chat.return_value = (
             "some_key",
             mock_json_chat,
@@ -262,6 +278,193 @@ class TestApi(unittest.TestCase):
             warnings=ANY,
         )
 
+    @patch("llms.chats.JSONChat")
+    @patch("llms.chats.ChatManager")
+    @patch("prompts.prompts.PromptList")
+    def test_post_prompt_fails_fast_when_model_rate_limit_is_reached(
+        self,
+        mock_prompt_list,
+        mock_chat_manager,
+        mock_json_chat,
+    ):
+        mock_json_chat.arun.side_effect = lambda prompt, **kwargs: stream_chunks(
+            "response"
+        )
+        mock_chat_manager.json_chat.return_value = ("some_key", mock_json_chat)
+        mock_prompt_list.render_prompt.return_value = "some prompt", "template"
+        mock_prompt_list.produces_json_output.return_value = True
+        model_config = ModelConfig(
+            "azure-gpt4",
+            "azure",
+            "GPT-4 on Azure",
+            config={},
+            limits={"requests_per_minute": "1", "max_wait_seconds": "0"},
+        )
+        ApiBasics(
+            self.app,
+            chat_manager=mock_chat_manager,
+            model_config=model_config,
+            prompts_guided=mock_prompt_list,
+            knowledge_manager=MagicMock(),
+            prompts_chat=MagicMock(),
+            image_service=MagicMock(),
+            config_service=MagicMock(),
+            disclaimer_and_guidelines=MagicMock(),
+            inspirations_manager=MagicMock(),
+            rate_limiters=ModelRateLimiters(),
+        )
+        request = {"userinput": "some user input", "promptid": "guided-requirements"}
+
+        first_response = self.client.post("/api/prompt", json=request)
+        second_response = self.client.post("/api/prompt", json=request)
+
+        assert first_response.status_code == 200
+        assert second_response.status_code == 429
+        assert second_response.headers["Retry-After"] == "60"
+        limits_response = self.client.get("/api/models/limits")
+        assert limits_response.json() == {"azure-gpt4": {"active": 0, "queue_depth": 0}}
+
+    def test_releases_the_model_when_the_answer_is_never_streamed(self):
+        mock_chat_manager = MagicMock()
+        mock_chat_manager.json_chat.side_effect = lambda **kwargs: (
+            "some_key",
+            JSONChat(chat_client=MagicMock()),
+        )
+        model_config = ModelConfig(
+            "azure-gpt4",
+            "azure",
+            "GPT-4 on Azure",
+            config={},
+            limits={"max_concurrent": "1", "max_wait_seconds": "0"},
+        )
+        rate_limiters = ModelRateLimiters()
+        api = ApiBasics(
+            self.app,
+            chat_manager=mock_chat_manager,
+            model_config=model_config,
+            prompts_guided=MagicMock(),
+            knowledge_manager=MagicMock(),
+            prompts_chat=MagicMock(),
+            image_service=MagicMock(),
+            config_service=MagicMock(),
+            disclaimer_and_guidelines=MagicMock(),
+            inspirations_manager=MagicMock(),
+            rate_limiters=rate_limiters,
+        )
+        limiter = rate_limiters.get(model_config)
+
+        async def send_fails(message):
+            raise OSError("Client disconnected")
+
+        async def respond():
+            # The client is gone before the body is iterated
+            disconnected = await api.stream_json_chat("some prompt", "some-category")
+            with self.assertRaises(ClientDisconnect):
+                await disconnected(
+                    {"type": "http", "asgi": {"spec_version": "2.4"}}, None, send_fails
+                )
+            assert limiter.active() == 0
+
+            # The response is dropped without ever being sent
+            dropped = await api.stream_json_chat("some prompt", "some-category")
+            assert limiter.active() == 1
+            del dropped
+            gc.collect()
+            assert limiter.active() == 0
+
+        asyncio.run(respond())
+
+    def test_reserves_the_tokens_of_the_whole_conversation_until_the_usage_is_known(
+        self,
+    ):
+        chat_client = MagicMock()
+        chat_client.astream.side_effect = lambda messages: stream_chunks(
+            {"content": "[]"}
+        )
+        chat_client.last_usage = {
+            "model": "azure/gpt4",
+            "prompt_tokens": 300,
+            "completion_tokens": 100,
+        }
+        json_chat = JSONChat(chat_client=chat_client, system_message="")
+        json_chat.memory += [
+            HaivenHumanMessage(content="Give me scenarios " * 100),
+            HaivenAIMessage(content="[]" * 1000),
+        ]
+        mock_chat_manager = MagicMock()
+        mock_chat_manager.json_chat.return_value = ("some_key", json_chat)
+        mock_chat_manager.record_usage.return_value = {}
+        model_config = ModelConfig(
+            "azure-gpt4",
+            "azure",
+            "GPT-4 on Azure",
+            config={"azure_deployment": "gpt4"},
+            limits={"tokens_per_minute": "1000", "max_wait_seconds": "0"},
+        )
+        rate_limiters = ModelRateLimiters()
+        api = ApiBasics(
+            self.app,
+            chat_manager=mock_chat_manager,
+            model_config=model_config,
+            prompts_guided=MagicMock(),
+            knowledge_manager=MagicMock(),
+            prompts_chat=MagicMock(),
+            image_service=MagicMock(),
+            config_service=MagicMock(),
+            disclaimer_and_guidelines=MagicMock(),
+            inspirations_manager=MagicMock(),
+            rate_limiters=rate_limiters,
+        )
+        limiter = rate_limiters.get(model_config)
+
+        async def respond():
+            response = await api.stream_json_chat("More scenarios", "some-category")
+            async for _ in response.body_iterator:
+                pass
+
+        with patch.object(limiter, "acquire", wraps=limiter.acquire) as acquire:
+            asyncio.run(respond())
+
+        # 1800 + 2000 characters of conversation and the new prompt
+        assert acquire.call_args.kwargs["estimated_tokens"] == 953
+        # The 400 tokens of the usage replace the estimate
+        assert limiter.try_acquire(estimated_tokens=550) is not None
+        assert limiter.try_acquire(estimated_tokens=100) is None
+
+    def test_cancels_the_model_when_the_client_disconnects(self):
+        model_cancelled = asyncio.Event()
+
+        async def model_thinking():
+            try:
+                await asyncio.sleep(60)
+                yield {"content": "[]"}
+            except asyncio.CancelledError:
+                model_cancelled.set()
+                raise
+
+        mock_chat_client = MagicMock()
+        mock_chat_client.astream.return_value = model_thinking()
+        json_chat = JSONChat(chat_client=mock_chat_client)
+        request = MagicMock()
+
+        async def is_disconnected():
+            return True
+
+        request.is_disconnected = is_disconnected
+
+        async def respond():
+            return [
+                chunk
+                async for chunk in cancel_on_disconnect(
+                    request, json_chat.arun("Give me scenarios"), poll_seconds=0.01
+                )
+            ]
+
+        assert asyncio.run(respond()) == []
+        assert model_cancelled.is_set()
+        # The question without an answer is not kept in the conversation
+        assert len(json_chat.memory) == 1
+
     @patch("llms.chats.JSONChat")
     @patch("llms.chats.ChatManager")
     @patch("prompts.prompts.PromptList")
@@ -271,7 +474,7 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_json_chat,
     ):
-        mock_json_chat.run.return_value = "some response from the model"
+        mock_json_chat.arun.return_value = stream_chunks("some response from the model")
         mock_chat_manager.json_chat.return_value = (
             "some_key",
             mock_json_chat,
@@ -307,6 +510,48 @@ class TestApi(unittest.TestCase):
             warnings=ANY,
         )
 
+    @patch("llms.chats.JSONChat")
+    @patch("llms.chats.ChatManager")
+    @patch("prompts.prompts.PromptList")
+    def test_scenarios_in_two_phases(
+        self,
+        mock_prompt_list,
+        mock_chat_manager,
+        mock_json_chat,
+    ):
+        mock_json_chat.arun.side_effect = lambda *args, **kwargs: stream_chunks(
+            "some response from the model"
+        )
+        mock_chat_manager.json_chat.return_value = ("some_key", mock_json_chat)
+        mock_chat_manager.json_chat_branch.return_value = mock_json_chat
+        mock_prompt_list.render_prompt.return_value = "some prompt", "template"
+        ApiScenarios(self.app, mock_chat_manager, "some_model_key", mock_prompt_list)
+
+        titles = self.client.get("/api/make-scenario?input=someinput&detail=titles")
+        details = self.client.get(
+            "/api/make-scenario/details?chatSessionId=some_key&title=Cities went green"
+        )
+
+        assert titles.status_code == 200
+        assert titles.headers["X-Chat-ID"] == "some_key"
+        assert (
+            mock_prompt_list.render_prompt.call_args_list[0].kwargs["prompt_choice"]
+            == "guided-scenarios-titles"
+        )
+        assert details.status_code == 200
+        assert details.content.decode("utf-8") == "some response from the model"
+        mock_prompt_list.render_prompt.assert_called_with(
+            active_knowledge_context=ANY,
+            prompt_choice="guided-scenario-details",
+            user_input=ANY,
+            additional_vars={"title": "Cities went green"},
+            warnings=ANY,
+        )
+        mock_chat_manager.json_chat_branch.assert_called_once_with(
+            model_config="some_model_key", session_id="some_key", options=ANY
+        )
+        mock_chat_manager.json_chat.assert_called_once()
+
     @patch("llms.chats.StreamingChat")
     @patch("llms.chats.ChatManager")
     @patch("prompts.prompts.PromptList")
@@ -316,7 +561,9 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_streaming_chat,
     ):
-        mock_streaming_chat.run.return_value = "some response from the model"
+        mock_streaming_chat.arun.return_value = stream_chunks(
+            "some response from the model"
+        )
 
         mock_chat_manager.streaming_chat.return_value = (
             "some_key",
@@ -345,7 +592,7 @@ class TestApi(unittest.TestCase):
         streamed_content = response.content.decode("utf-8")
         assert streamed_content == "some response from the model"
 
-        args, kwargs = mock_streaming_chat.run.call_args
+        args, kwargs = mock_streaming_chat.arun.call_args
         actual_composed_prompt = args[0]
         assert body_dict["userinput"] in actual_composed_prompt
         assert body_dict["previous_framing"] in actual_composed_prompt
@@ -364,7 +611,9 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_streaming_chat,
     ):
-        mock_streaming_chat.run.return_value = "some response from the model"
+        mock_streaming_chat.arun.return_value = stream_chunks(
+            "some response from the model"
+        )
 
         mock_chat_manager.streaming_chat.return_value = (
             "some_key",
@@ -396,7 +645,7 @@ class TestApi(unittest.TestCase):
         streamed_content = response.content.decode("utf-8")
         assert streamed_content == "some response from the model"
 
-        args, kwargs = mock_streaming_chat.run.call_args
+        args, kwargs = mock_streaming_chat.arun.call_args
         actual_composed_prompt = args[0]
         assert body_dict["userinput"] in actual_composed_prompt
         assert some_context in actual_composed_prompt
@@ -406,6 +655,169 @@ class TestApi(unittest.TestCase):
         assert kwargs["options"].category == "explore"
         assert kwargs["session_id"] == ""
 
+    @patch("llms.chats.ChatManager")
+    @patch("prompts.prompts.PromptList")
+    def test_explore_and_follow_up_refer_to_the_first_step(
+        self, mock_prompt_list, mock_chat_manager
+    ):
+        first_step_chat = JSONChat(MagicMock(), event_stream_standard=False)
+        first_step_chat.first_step = FirstStep(
+            "first-step-prompt-1234", "some original prompt", "some context"
+        )
+        first_step_chat.memory += [
+            HaivenHumanMessage(content="rendered first step"),
+            HaivenAIMessage(content='[{"title": "first card"}]'),
+        ]
+        mock_chat_manager.get_session.return_value = first_step_chat
+        follow_up_chat = MagicMock()
+        follow_up_chat.arun.side_effect = lambda *args, **kwargs: stream_chunks(
+            "some response from the model"
+        )
+        mock_chat_manager.streaming_chat.return_value = ("some_key", follow_up_chat)
+        mock_prompt_list.get.return_value.metadata = {
+            "title": "First step of multiple",
+            "output_framing": "this is what I got from the first step",
+        }
+        mock_prompt_list.get_rendered_context.return_value = "some domain description"
+        mock_prompt_list.render_prompt.side_effect = lambda user_input, **kwargs: (
+            user_input,
+            "template",
+        )
+        ApiMultiStep(self.app, mock_chat_manager, "some_model_key", mock_prompt_list)
+
+        for _ in range(2):
+            explore = self.client.post(
+                "/api/prompt/explore",
+                json={
+                    "userinput": "some user question",
+                    "item": "first card",
+                    "first_step_id": "first-step-key",
+                    "chatSessionId": "some-explore-session",
+                },
+            )
+            explore_prompt = follow_up_chat.arun.call_args.args[0]
+        follow_up = self.client.post(
+            "/api/prompt/follow-up",
+            json={
+                "promptid": "follow-up-prompt-2345",
+                "first_step_id": "first-step-key",
+            },
+        )
+        follow_up_prompt = follow_up_chat.arun.call_args.args[0]
+
+        assert explore.status_code == 200 and follow_up.status_code == 200
+        for expected in [
+            "some domain description",
+            "some original prompt",
+            "First step of multiple",
+            "some user question",
+        ]:
+            assert expected in explore_prompt
+        # The context is only rendered once for all requests that refer to the first step
+        mock_prompt_list.get_rendered_context.assert_called_once_with(
+            "some context", "first-step-prompt-1234"
+        )
+        assert "some original prompt" in follow_up_prompt
+        assert '[{"title": "first card"}]' in follow_up_prompt
+        mock_chat_manager.get_session.assert_called_with("first-step-key")
+
+    @patch("llms.chats.ChatManager")
+    @patch("prompts.prompts.PromptList")
+    def test_follow_up_refers_to_the_cards_as_they_are_now(
+        self, mock_prompt_list, mock_chat_manager
+    ):
+        first_step_chat = JSONChat(MagicMock(), event_stream_standard=False)
+        first_step_chat.first_step = FirstStep("first-step-prompt-1234", "some input")
+        first_step_chat.memory += [
+            HaivenHumanMessage(content="rendered first step"),
+            HaivenAIMessage(content='[{"id": 1, "title": "first card"}]'),
+            HaivenHumanMessage(content="make it shorter"),
+            HaivenAIMessage(content='[{"id": 1, "title": "card"}]'),
+        ]
+        mock_chat_manager.get_session.return_value = first_step_chat
+        follow_up_chat = MagicMock()
+        follow_up_chat.arun.side_effect = lambda *args, **kwargs: stream_chunks(
+            "some response from the model"
+        )
+        mock_chat_manager.streaming_chat.return_value = ("some_key", follow_up_chat)
+        mock_prompt_list.get.return_value.metadata = {
+            "title": "First step of multiple",
+            "output_framing": "this is what I got from the first step",
+        }
+        mock_prompt_list.render_prompt.side_effect = lambda user_input, **kwargs: (
+            user_input,
+            "template",
+        )
+        ApiMultiStep(self.app, mock_chat_manager, "some_model_key", mock_prompt_list)
+        follow_up_request = {
+            "promptid": "follow-up-prompt-2345",
+            "first_step_id": "first-step-key",
+        }
+
+        self.client.post("/api/prompt/follow-up", json=follow_up_request)
+        after_iteration = follow_up_chat.arun.call_args.args[0]
+        first_step_chat.card_state = CardState([{"id": 1, "title": "card"}])
+        first_step_chat.card_state.apply_patch({"id": 1, "summary": "patched"})
+        self.client.post("/api/prompt/follow-up", json=follow_up_request)
+        after_patch = follow_up_chat.arun.call_args.args[0]
+
+        assert '[{"id": 1, "title": "card"}]' in after_iteration
+        assert "first card" not in after_iteration
+        assert '[{"id": 1, "title": "card", "summary": "patched"}]' in after_patch
+
+    @patch("llms.chats.ChatManager")
+    @patch("prompts.prompts.PromptList")
+    def test_new_explore_chat_forks_the_first_step(
+        self, mock_prompt_list, mock_chat_manager
+    ):
+        first_step_chat = JSONChat(MagicMock(), event_stream_standard=False)
+        first_step_chat.first_step = FirstStep(
+            "first-step-prompt-1234", "some original prompt", "some context"
+        )
+        mock_chat_manager.get_session.return_value = first_step_chat
+        explore_chat = MagicMock()
+        explore_chat.arun.side_effect = lambda *args, **kwargs: stream_chunks(
+            "some response from the model"
+        )
+        mock_chat_manager.streaming_chat_fork.return_value = (
+            "explore-key",
+            explore_chat,
+        )
+        ApiMultiStep(self.app, mock_chat_manager, "some_model_key", mock_prompt_list)
+
+        response = self.client.post(
+            "/api/prompt/explore",
+            json={
+                "userinput": "some user question",
+                "item": "first card",
+                "first_step_id": "first-step-key",
+            },
+        )
+
+        assert response.status_code == 200
+        assert response.headers["X-Chat-ID"] == "explore-key"
+        _, kwargs = mock_chat_manager.streaming_chat_fork.call_args
+        assert kwargs["parent_session_id"] == "first-step-key"
+        assert kwargs["options"].category == "explore"
+        mock_chat_manager.streaming_chat.assert_not_called()
+        # The context and the first step are in the shared conversation, not repeated in the prompt
+        prompt = explore_chat.arun.call_args.args[0]
+        assert "first card" in prompt and "some user question" in prompt
+        assert "some original prompt" not in prompt
+        mock_prompt_list.get_rendered_context.assert_not_called()
+
+    @patch("llms.chats.ChatManager")
+    def test_explore_fails_for_an_unknown_first_step(self, mock_chat_manager):
+        mock_chat_manager.get_session.side_effect = ValueError("session expired")
+        ApiMultiStep(self.app, mock_chat_manager, "some_model_key", MagicMock())
+
+        response = self.client.post(
+            "/api/prompt/explore",
+            json={"userinput": "some user question", "first_step_id": "expired"},
+        )
+
+        assert response.status_code == 404
+
     @patch("llms.chats.ChatManager")
     @patch("llms.chats.StreamingChat")
     def test_post_multi_step(
@@ -413,7 +825,9 @@ class TestApi(unittest.TestCase):
         mock_streaming_chat,
         mock_chat_manager,
     ):
-        mock_streaming_chat.run.return_value = "some response from the model"
+        mock_streaming_chat.arun.return_value = stream_chunks(
+            "some response from the model"
+        )
         mock_chat_manager.streaming_chat.return_value = (
             "some_session_key",
             mock_streaming_chat,
@@ -449,8 +863,8 @@ class TestApi(unittest.TestCase):
         streamed_content = response.content.decode("utf-8")
         assert streamed_content == "some response from the model"
 
-        assert mock_streaming_chat.run.call_count == 1
-        args, kwargs = mock_streaming_chat.run.call_args
+        assert mock_streaming_chat.arun.call_count == 1
+        args, kwargs = mock_streaming_chat.arun.call_args
         prompt_argument = args[0]
         assert "this is what I got from the first step" in prompt_argument
         assert "some title" in prompt_argument
@@ -460,6 +874,125 @@ class TestApi(unittest.TestCase):
         args, kwargs = mock_chat_manager.streaming_chat.call_args
         assert kwargs["session_id"] is None
 
+    @patch("llms.chats.ChatManager")
+    def test_iterate_with_deltas(self, mock_chat_manager):
+        async def model_answer(messages):
+            for chunk in ['[{"id": 1, "summ', 'ary": "in France"}', "]"]:
+                yield {"content": chunk}
+
+        chat_client = MagicMock()
+        chat_client.astream.side_effect = model_answer
+        chat_client.last_usage = None
+        chat_session = JSONChat(chat_client, event_stream_standard=False)
+        mock_chat_manager.get_session.return_value = chat_session
+        mock_chat_manager.json_chat.return_value = ("some_key", chat_session)
+        ApiBasics(
+            self.app,
+            chat_manager=mock_chat_manager,
+            model_config=MagicMock(),
+            prompts_guided=MagicMock(),
+            knowledge_manager=MagicMock(),
+            prompts_chat=MagicMock(),
+            image_service=MagicMock(),
+            config_service=MagicMock(),
+            disclaimer_and_guidelines=MagicMock(),
+            inspirations_manager=MagicMock(),
+        )
+
+        response = self.client.post(
+            "/api/prompt/iterate",
+            json={
+                "userinput": "add a summary",
+                "chatSessionId": "some_key",
+                "delta": True,
+                "scenarios": json.dumps(
+                    [{"id": 1, "title": "Paris"}, {"id": 2, "title": "London"}]
+                ),
+            },
+        )
+        state = self.client.get("/api/prompt/iterate/state?chatSessionId=some_key")
+
+        assert response.status_code == 200
+        assert [
+            json.loads(event)
+            for event in response.content.decode("utf-8").split("\n\n")
+            if event
+        ] == [
+            {
+                "type": "patch",
+                "id": 1,
+                "version": 1,
+                "data": {"summary": "in France"},
+            }
+        ]
+        prompt = chat_session.memory[1].content
+        assert "add a summary" in prompt and '"title": "London"' in prompt
+        assert state.json() == {
+            "version": 1,
+            "cards": [
+                {
+                    "version": 1,
+                    "data": {"id": 1, "title": "Paris", "summary": "in France"},
+                },
+                {"version": 0, "data": {"id": 2, "title": "London"}},
+            ],
+        }
+
+    @patch("llms.chats.ChatManager")
+    @patch("prompts.prompts.PromptList")
+    def test_post_follow_up_batch(self, mock_prompt_list, mock_chat_manager):
+        mock_prompt_list.get.return_value.metadata = {"output_framing": "I got:"}
+        mock_prompt_list.render_prompt.side_effect = (
+            lambda prompt_choice, user_input, **kwargs: (
+                f"{prompt_choice}: {user_input}",
+                "template",
+            )
+        )
+        chats = {}
+
+        def streaming_chat(model_config, session_id=None, options=None):
+            chat = MagicMock()
+            chat.arun.side_effect = lambda prompt, **kwargs: stream_chunks(
+                f"answer to {prompt.split(':')[0]}"
+            )
+            chats[f"session-{len(chats)}"] = chat
+            return f"session-{len(chats) - 1}", chat
+
+        mock_chat_manager.streaming_chat.side_effect = streaming_chat
+        ApiMultiStep(self.app, mock_chat_manager, "some_model_key", mock_prompt_list)
+
+        response = self.client.post(
+            "/api/prompt/follow-ups",
+            json={
+                "userinput": "some original requirement",
+                "promptids": ["risks", "stories"],
+                "scenarios": [{"title": "some title", "content": "some content"}],
+                "previous_promptid": "first-step-prompt-1234",
+            },
+        )
+
+        assert response.status_code == 200
+        events = [
+            json.loads(event)
+            for event in response.content.decode("utf-8").split("\n\n")
+            if event
+        ]
+        assert events[:2] == [
+            {"promptid": "risks", "chatSessionId": "session-0"},
+            {"promptid": "stories", "chatSessionId": "session-1"},
+        ]
+        for prompt_id in ["risks", "stories"]:
+            assert [
+                event for event in events[2:] if event["promptid"] == prompt_id
+            ] == [
+                {"promptid": prompt_id, "data": f"answer to {prompt_id}"},
+                {"promptid": prompt_id, "done": True},
+            ]
+        for chat in chats.values():
+            prompt = chat.arun.call_args.args[0]
+            assert "some title" in prompt and "I got:" in prompt
+        mock_prompt_list.get.assert_called_once_with("first-step-prompt-1234")
+
     @patch("llms.chats.JSONChat")
     @patch("llms.chats.ChatManager")
     @patch("prompts.prompts.PromptList")
@@ -469,7 +1002,7 @@ class TestApi(unittest.TestCase):
         mock_chat_manager,
         mock_json_chat,
     ):
-        mock_json_chat.run.return_value = "some response from the model"
+        mock_json_chat.arun.return_value = stream_chunks("some response from the model")
         mock_chat_manager.json_chat.return_value = (
             "some_key",
             mock_json_chat,
@@ -507,6 +1040,48 @@ class TestApi(unittest.TestCase):
             warnings=ANY,
         )
 
+    @patch("llms.chats.ChatManager")
+    @patch("prompts.prompts.PromptList")
+    def test_creative_matrix_fanned_out_per_cell(
+        self, mock_prompt_list, mock_chat_manager
+    ):
+        mock_prompt_list.render_prompt.side_effect = lambda additional_vars, **kwargs: (
+            f"{additional_vars['rows']} x {additional_vars['columns']}",
+            "template",
+        )
+        mock_chat_manager.json_chat.return_value = ("some_key", MagicMock())
+
+        async def acomplete(prompt, on_usage=None, use_cache=False):
+            if prompt == "For B x For D":
+                raise ValueError("model unavailable")
+            return f'```json\n[{{"row": "{prompt}"}}]\n```'
+
+        mock_chat_manager.json_chat_branch.return_value.acomplete.side_effect = (
+            acomplete
+        )
+        ApiCreativeMatrix(
+            self.app, mock_chat_manager, "some_model_key", mock_prompt_list
+        )
+
+        response = self.client.get(
+            "/api/creative-matrix?rows=For A, For B&columns=For C, For D&prompt=gardening&fan_out=cell"
+        )
+
+        assert response.status_code == 200
+        assert response.headers["X-Chat-ID"] == "some_key"
+        events = [
+            json.loads(event)
+            for event in response.content.decode("utf-8").split("\n\n")
+            if event
+        ]
+        assert sorted(events, key=lambda event: (event["row"], event["column"])) == [
+            {"row": "For A", "column": "For C", "data": [{"row": "For A x For C"}]},
+            {"row": "For A", "column": "For D", "data": [{"row": "For A x For D"}]},
+            {"row": "For B", "column": "For C", "data": [{"row": "For B x For C"}]},
+            {"row": "For B", "column": "For D", "error": "model unavailable"},
+        ]
+        assert mock_chat_manager.json_chat_branch.call_count == 4
+
     def test_get_inspirations(self):
         mock_inspirations = [{"title": "Test Title"}]
         mock_inspirations_manager = MagicMock()
@@ -0,0 +1,49 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from llms.card_state import CardState
+
+
+def cards():
+    return CardState(
+        [
+            {"id": 1, "title": "Paris"},
+            {"id": 2, "title": "London"},
+            {"title": "Card without an id"},
+        ]
+    )
+
+
+def test_merges_changed_properties_into_a_card():
+    state = cards()
+
+    patch = state.apply_patch({"id": 1, "title": "Paris", "summary": "in France"})
+
+    assert patch == {
+        "type": "patch",
+        "id": 1,
+        "version": 1,
+        "data": {"summary": "in France"},
+    }
+    assert state.cards["1"] == {"id": 1, "title": "Paris", "summary": "in France"}
+    assert state.version == 1
+    assert state.versions == {"1": 1, "2": 0}
+
+
+def test_ignores_patches_that_change_nothing_or_no_known_card():
+    state = cards()
+
+    assert state.apply_patch({"id": 1, "title": "Paris"}) is None
+    assert state.apply_patch({"id": 3, "title": "Rome"}) is None
+    assert state.apply_patch({"title": "Rome"}) is None
+    assert state.apply_patch(["not", "a", "card"]) is None
+    assert state.version == 0
+
+
+def test_matches_ids_regardless_of_their_type():
+    state = cards()
+
+    state.apply_patch({"id": "2", "summary": "in the UK"})
+
+    assert state.to_dict()["cards"][1] == {
+        "version": 1,
+        "data": {"id": 2, "title": "London", "summary": "in the UK"},
+    }
@@ -0,0 +1,64 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+from llms.chat_memory import ChatMemory
+from llms.clients import HaivenAIMessage, HaivenHumanMessage, HaivenSystemMessage
+
+
+def conversation():
+    return ChatMemory(
+        [
+            HaivenSystemMessage(content="You are a helpful assistant"),
+            HaivenHumanMessage(content="Give me scenarios"),
+            HaivenAIMessage(content="Cities went green"),
+        ]
+    )
+
+
+def test_behaves_like_a_list():
+    memory = conversation()
+    memory += [HaivenHumanMessage(content="More")]
+
+    assert len(memory) == 4
+    assert memory[-1].content == "More"
+    assert memory[1:3] == [
+        HaivenHumanMessage(content="Give me scenarios"),
+        HaivenAIMessage(content="Cities went green"),
+    ]
+    assert memory.pop() == HaivenHumanMessage(content="More")
+    assert memory == conversation()
+
+
+def test_fork_shares_the_messages_so_far():
+    memory = conversation()
+
+    fork = memory.fork()
+    fork.append(HaivenHumanMessage(content="Tell me more"))
+    memory.append(HaivenHumanMessage(content="Something else"))
+
+    assert [message.content for message in fork[3:]] == ["Tell me more"]
+    assert [message.content for message in memory[3:]] == ["Something else"]
+    assert all(fork[index] is memory[index] for index in range(3))
+    assert fork.segments()[0] is memory.segments()[0]
+
+
+def test_forks_of_forks_only_share_their_common_messages():
+    memory = conversation()
+    fork = memory.fork()
+    fork.append(HaivenHumanMessage(content="Tell me more"))
+
+    fork_of_fork = fork.fork()
+
+    assert len(fork_of_fork) == 4
+    assert fork_of_fork.segments()[0] is memory.segments()[0]
+    assert len(memory) == 3
+
+
+def test_removing_a_shared_message_does_not_change_other_forks():
+    memory = conversation()
+    fork = memory.fork()
+
+    fork.pop()
+    fork.append(HaivenAIMessage(content="Cities went blue"))
+
+    assert memory[-1].content == "Cities went green"
+    assert fork[-1].content == "Cities went blue"
+    assert fork[:2] == memory[:2]
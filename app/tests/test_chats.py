@@ -1,11 +1,35 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import json
 import os
 import unittest
 
-from llms.chats import ServerChatSessionMemory, StreamingChat
+from llms.chats import (
+    ChatManager,
+    ChatOptions,
+    JSONChat,
+    ServerChatSessionMemory,
+    StreamingChat,
+)
 from unittest.mock import MagicMock, patch
 
-from llms.clients import HaivenAIMessage, HaivenHumanMessage, HaivenSystemMessage
+from llms.clients import (
+    ChatClient,
+    HaivenAIMessage,
+    HaivenHumanMessage,
+    HaivenSystemMessage,
+    MockResult,
+)
+from llms.model_config import ModelConfig
+
+
+async def stream_chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
 
 
 class TestChats(unittest.TestCase):
@@ -35,6 +59,307 @@ class TestChats(unittest.TestCase):
         assert isinstance(streaming_chat.memory[1], HaivenHumanMessage)
         assert isinstance(streaming_chat.memory[2], HaivenAIMessage)
 
+    @patch("knowledge_manager.KnowledgeManager")
+    @patch("logger.HaivenLogger.get")
+    def test_streaming_chat_async(self, mock_logger, mock_knowledge_manager):
+        mock_chat_client = MagicMock()
+        mock_chat_client.astream.return_value = stream_chunks(
+            {"content": "Pa"}, {"content": "ris"}
+        )
+        streaming_chat = StreamingChat(
+            chat_client=mock_chat_client, knowledge_manager=mock_knowledge_manager
+        )
+
+        answer = asyncio.run(
+            collect(streaming_chat.arun("What is the capital of France?"))
+        )
+
+        assert answer == ["Pa", "ris"]
+        assert len(streaming_chat.memory) == 3
+        assert isinstance(streaming_chat.memory[1], HaivenHumanMessage)
+        assert streaming_chat.memory[2].content == "Paris"
+
+    def test_json_chat_async(self):
+        mock_chat_client = MagicMock()
+        mock_chat_client.astream.return_value = stream_chunks(
+            {"content": '[{"title": '}, {"content": '"Paris"}]'}
+        )
+        mock_chat_client.last_usage = {"prompt_tokens": 12, "completion_tokens": 6}
+        json_chat = JSONChat(chat_client=mock_chat_client, event_stream_standard=False)
+        on_usage = MagicMock(return_value={"requests": 1})
+
+        events = asyncio.run(
+            collect(json_chat.arun("Give me a city as JSON", on_usage=on_usage))
+        )
+
+        assert events == [
+            json.dumps({"data": '[{"title": '}) + "\n\n",
+            json.dumps({"data": '"Paris"}]'}) + "\n\n",
+            json.dumps(
+                {
+                    "usage": {
+                        "prompt_tokens": 12,
+                        "completion_tokens": 6,
+                        "session_totals": {"requests": 1},
+                    }
+                }
+            )
+            + "\n\n",
+        ]
+        on_usage.assert_called_once_with(mock_chat_client.last_usage)
+        assert json_chat.memory[-1].content == '[{"title": "Paris"}]'
+
+    def test_json_chat_async_yields_errors(self):
+        async def failing_stream():
+            raise ValueError("model unavailable")
+            yield
+
+        mock_chat_client = MagicMock()
+        mock_chat_client.astream.return_value = failing_stream()
+        mock_chat_client.last_usage = None
+        json_chat = JSONChat(chat_client=mock_chat_client, event_stream_standard=False)
+
+        events = asyncio.run(collect(json_chat.arun("Give me a city as JSON")))
+
+        assert events == [json.dumps({"data": "[ERROR]: model unavailable"}) + "\n\n"]
+
+    def test_streaming_chat_keeps_partial_answer_when_interrupted(self):
+        model_stream_closed = asyncio.Event()
+
+        async def slow_stream():
+            try:
+                yield {"content": "Pa"}
+                await asyncio.sleep(60)
+                yield {"content": "ris"}
+            finally:
+                model_stream_closed.set()
+
+        mock_chat_client = MagicMock()
+        mock_chat_client.astream.return_value = slow_stream()
+        streaming_chat = StreamingChat(
+            chat_client=mock_chat_client, knowledge_manager=None
+        )
+
+        async def read_first_chunk_and_disconnect():
+            answer = streaming_chat.arun("What is the capital of France?")
+            first_chunk = await answer.__anext__()
+            await answer.aclose()
+            return first_chunk
+
+        assert asyncio.run(read_first_chunk_and_disconnect()) == "Pa"
+        assert model_stream_closed.is_set()
+        assert isinstance(streaming_chat.memory[-2], HaivenHumanMessage)
+        assert streaming_chat.memory[-1] == HaivenAIMessage(content="Pa")
+
+    def test_json_chat_completes_whole_answers(self):
+        mock_chat_client = MagicMock()
+        mock_chat_client.astream.return_value = stream_chunks(
+            {"content": '[{"title": '}, {"content": '"Paris"}]'}
+        )
+        mock_chat_client.last_usage = {"completion_tokens": 5}
+        on_usage = MagicMock()
+        json_chat = JSONChat(chat_client=mock_chat_client)
+
+        answer = asyncio.run(json_chat.acomplete("Give me a city", on_usage=on_usage))
+
+        assert answer == '[{"title": "Paris"}]'
+        assert json_chat.memory[-1] == HaivenAIMessage(content=answer)
+        on_usage.assert_called_once_with({"completion_tokens": 5})
+
+    @patch("llms.clients.llmAcompletion")
+    def test_chat_client_streams_async(self, mock_acompletion):
+        async def acompletion(**kwargs):
+            return stream_chunks(
+                *[
+                    MockResult.model_validate(
+                        {"choices": [{"delta": {"content": content}}]}
+                    )
+                    for content in ["Pa", "ris"]
+                ]
+            )
+
+        mock_acompletion.side_effect = acompletion
+        chat_client = ChatClient(
+            ModelConfig("azure-gpt4", "azure", "GPT-4 on Azure", config={})
+        )
+
+        chunks = asyncio.run(
+            collect(chat_client.astream([HaivenHumanMessage(content="Capital?")]))
+        )
+
+        assert chunks == [{"content": "Pa"}, {"content": "ris"}]
+        assert mock_acompletion.call_args.kwargs["stream"] is True
+        assert mock_acompletion.call_args.kwargs["messages"] == [
+            {"content": "Capital?", "role": "user"}
+        ]
+
+    def test_chat_client_marks_stable_prefixes_as_cacheable(self):
+        chat_client = ChatClient(
+            ModelConfig(
+                "anthropic-claude",
+                "anthropic",
+                "Claude",
+                config={"model_id": "claude-3-5-sonnet"},
+            )
+        )
+
+        json_messages = chat_client._to_json_messages(
+            [
+                HaivenSystemMessage(content="You are a helpful assistant"),
+                HaivenHumanMessage(content="Prompt with knowledge snippets"),
+                HaivenAIMessage(content="First answer"),
+                HaivenHumanMessage(content="Second question"),
+                HaivenAIMessage(content="Second answer"),
+                HaivenHumanMessage(content="Newest question"),
+            ]
+        )
+
+        cacheable = [
+            isinstance(message["content"], list)
+            and message["content"][0]["cache_control"] == {"type": "ephemeral"}
+            for message in json_messages
+        ]
+        assert cacheable == [True, True, False, False, True, False]
+        assert (
+            json_messages[1]["content"][0]["text"] == "Prompt with knowledge snippets"
+        )
+        assert json_messages[5] == {"content": "Newest question", "role": "user"}
+
+    def test_chat_client_does_not_mark_prefixes_for_other_providers(self):
+        chat_client = ChatClient(
+            ModelConfig("azure-gpt4", "azure", "GPT-4 on Azure", config={})
+        )
+        messages = [
+            HaivenSystemMessage(content="You are a helpful assistant"),
+            HaivenHumanMessage(content="Prompt with knowledge snippets"),
+        ]
+
+        assert chat_client._to_json_messages(messages) == [
+            message.to_json() for message in messages
+        ]
+
+    @patch("logger.HaivenLogger.get")
+    @patch("llms.clients.llmAcompletion")
+    def test_chat_client_records_cache_token_usage(self, mock_acompletion, mock_logger):
+        usage = MagicMock(
+            prompt_tokens=2000,
+            completion_tokens=20,
+            cache_read_input_tokens=1800,
+            cache_creation_input_tokens=0,
+        )
+
+        async def results():
+            yield MockResult.model_validate(
+                {"choices": [{"delta": {"content": "Paris"}}]}
+            )
+            yield MagicMock(choices=[], usage=usage)
+
+        async def acompletion(**kwargs):
+            return results()
+
+        mock_acompletion.side_effect = acompletion
+        chat_client = ChatClient(
+            ModelConfig(
+                "anthropic-claude",
+                "anthropic",
+                "Claude",
+                config={"model_id": "claude-3-5-sonnet"},
+            )
+        )
+
+        chunks = asyncio.run(
+            collect(chat_client.astream([HaivenHumanMessage(content="Capital?")]))
+        )
+
+        assert chunks == [{"content": "Paris"}]
+        assert mock_acompletion.call_args.kwargs["stream_options"] == {
+            "include_usage": True
+        }
+        assert chat_client.last_usage["cache_read_input_tokens"] == 1800
+        assert chat_client.last_usage["prompt_tokens"] == 2000
+        mock_logger.return_value.analytics.assert_called_with(
+            "Model usage", chat_client.last_usage
+        )
+
+    def test_json_chat_branch_continues_a_session_without_changing_it(self):
+        session_memory = ServerChatSessionMemory()
+        chat_manager = ChatManager(MagicMock(), session_memory, MagicMock(), None)
+        session_chat = JSONChat(chat_client=MagicMock(), event_stream_standard=False)
+        session_chat.memory += [
+            HaivenHumanMessage(content="Give me scenario titles"),
+            HaivenAIMessage(content='[{"title": "Cities went green"}]'),
+        ]
+        session_key = session_memory.add_new_entry("scenarios", "user")
+        session_memory.store_chat(session_key, session_chat)
+        model_config = ModelConfig("azure-gpt4", "azure", "GPT-4", config={})
+
+        branches = [
+            chat_manager.json_chat_branch(model_config, session_key) for _ in range(2)
+        ]
+        for branch in branches:
+            branch.chat_client.astream.return_value = stream_chunks(
+                {"content": '{"title": "Cities went green"}'}
+            )
+            branch.chat_client.last_usage = None
+            asyncio.run(collect(branch.arun("Describe the scenario")))
+
+        assert len(session_chat.memory) == 3
+        for branch in branches:
+            assert branch.memory[:3] == session_chat.memory
+            assert branch.memory[3] == HaivenHumanMessage(
+                content="Describe the scenario"
+            )
+            assert branch.memory[4].content == '{"title": "Cities went green"}'
+
+    def test_streaming_chat_fork_shares_the_conversation_of_its_parent(self):
+        session_memory = ServerChatSessionMemory()
+        chat_manager = ChatManager(MagicMock(), session_memory, MagicMock(), None)
+        parent_chat = JSONChat(chat_client=MagicMock(), event_stream_standard=False)
+        parent_chat.memory += [
+            HaivenHumanMessage(content="Give me scenario titles"),
+            HaivenAIMessage(content='[{"title": "Cities went green"}]'),
+        ]
+        parent_key = session_memory.add_new_entry("scenarios", "user")
+        session_memory.store_chat(parent_key, parent_chat)
+        model_config = ModelConfig("azure-gpt4", "azure", "GPT-4", config={})
+
+        forks = [
+            chat_manager.streaming_chat_fork(
+                model_config, parent_key, ChatOptions(category="explore")
+            )
+            for _ in range(2)
+        ]
+        for index, (_, fork) in enumerate(forks):
+            fork.memory.append(HaivenHumanMessage(content=f"Question {index}"))
+        parent_chat.memory.append(HaivenHumanMessage(content="Iterate"))
+
+        assert [key for key, _ in forks] == list(session_memory.store.entries)[1:]
+        for index, (_, fork) in enumerate(forks):
+            assert isinstance(fork, StreamingChat)
+            assert fork.memory[:3] == parent_chat.memory[:3]
+            assert fork.memory[1] is parent_chat.memory[1]
+            assert fork.memory[3:] == [HaivenHumanMessage(content=f"Question {index}")]
+        assert parent_chat.memory[3] == HaivenHumanMessage(content="Iterate")
+
+        # The three shared messages are counted once, plus one own message per chat
+        assert session_memory.memory_usage()["messages"] == 6
+
+    def test_clearing_old_entries_only_counts_memory_when_it_removed_some(self):
+        session_memory = ServerChatSessionMemory()
+        old_key = session_memory.add_new_entry("chat", "user")
+        session_memory.add_new_entry("chat", "user")
+
+        with patch.object(
+            session_memory, "memory_usage", wraps=session_memory.memory_usage
+        ) as memory_usage:
+            session_memory.clear_old_entries()
+            assert memory_usage.call_count == 0
+
+            session_memory.store.entries[old_key]["last_access"] -= 60 * 60
+            session_memory.clear_old_entries()
+            assert memory_usage.call_count == 1
+        assert old_key not in session_memory.store.entries
+
     def test_dump_as_text(self):
         # Arrange
         category = "category"
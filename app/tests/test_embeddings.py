@@ -4,6 +4,7 @@ from unittest import mock
 import pytest
 from embeddings.client import EmbeddingsClient
 from embeddings.model import EmbeddingModel
+from llms.http_clients import HttpClients
 
 
 class TestEmbeddings:
@@ -207,7 +208,9 @@ class TestEmbeddings:
             separators=["\n\n", "\n", " ", ""],
         )
         openai_embeddings_mock.assert_called_with(
-            model=openai_model, api_key=openai_api_key
+            model=openai_model,
+            api_key=openai_api_key,
+            http_client=HttpClients.get().client(),
         )
         from_documents_mock.assert_called_with(
             text_splitter_mock().create_documents(), openai_embeddings_mock()
@@ -269,6 +272,7 @@ class TestEmbeddings:
             azure_endpoint=azure_endpoint,
             azure_deployment=azure_deployment_name,
             api_version=azure_api_version,
+            http_client=HttpClients.get().client(),
         )
         from_documents_mock.assert_called_with(
             text_splitter_mock().create_documents(), azure_openai_embeddings_mock()
@@ -0,0 +1,65 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import httpx
+
+from embeddings.model import EmbeddingModel
+from llms.http_clients import HttpClients, provider_endpoints
+from llms.model_config import ModelConfig
+
+
+def test_provider_endpoints_are_deduplicated_per_host():
+    models = [
+        ModelConfig(
+            "azure-gpt35",
+            "Azure",
+            "GPT-3.5",
+            config={"azure_endpoint": "https://team.openai.azure.com/"},
+        ),
+        ModelConfig(
+            "azure-gpt4",
+            "Azure",
+            "GPT-4",
+            config={"azure_endpoint": "https://team.openai.azure.com/openai"},
+        ),
+        ModelConfig(
+            "ollama", "ollama", "Ollama", config={"model": "llama3", "base_url": ""}
+        ),
+        ModelConfig("anthropic", "anthropic", "Claude", config={"model_id": "x"}),
+        EmbeddingModel("ada", "openai", "Ada", config={"model": "ada"}),
+    ]
+
+    assert provider_endpoints(models) == [
+        "https://team.openai.azure.com",
+        "https://api.anthropic.com",
+        "https://api.openai.com",
+    ]
+
+
+def test_clients_are_shared_and_use_the_configured_pool():
+    http_clients = HttpClients.configure(
+        max_connections=10, max_keepalive_connections=5
+    )
+
+    assert HttpClients.get() is http_clients
+    assert http_clients.client() is http_clients.client()
+    assert http_clients.limits.max_connections == 10
+    assert http_clients.limits.max_keepalive_connections == 5
+
+
+def test_warm_up_connects_to_each_endpoint_and_ignores_failures():
+    requests = []
+
+    def handler(request: httpx.Request):
+        requests.append((request.method, str(request.url)))
+        if request.url.host == "down.example.com":
+            raise httpx.ConnectError("down")
+        return httpx.Response(404)
+
+    http_clients = HttpClients()
+    http_clients._client = httpx.Client(transport=httpx.MockTransport(handler))
+
+    http_clients.warm_up(["https://down.example.com", "https://api.example.com"]).join()
+
+    assert requests == [
+        ("HEAD", "https://down.example.com"),
+        ("HEAD", "https://api.example.com"),
+    ]
@@ -0,0 +1,177 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import json
+from unittest.mock import MagicMock
+
+import pytest
+
+from llms.card_state import CardState
+from llms.chats import JSONChat
+from llms.json_stream import JSONArrayParser
+
+CARDS = '```json\n[{"title": "Cities, greener", "tags": ["a", "b"]}, {"title": "Say \\"hi\\""}]\n```'
+
+
+def feed_in_chunks(parser, text, size):
+    objects = []
+    for start in range(0, len(text), size):
+        objects += parser.feed(text[start : start + size])
+    return objects
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1000])
+def test_returns_each_object_once_it_is_complete(chunk_size):
+    parser = JSONArrayParser()
+
+    objects = feed_in_chunks(parser, CARDS, chunk_size)
+
+    assert objects == [
+        (0, {"title": "Cities, greener", "tags": ["a", "b"]}),
+        (1, {"title": 'Say "hi"'}),
+    ]
+    assert parser.close() is None
+    assert not parser.truncated
+
+
+def test_returns_an_object_as_soon_as_it_closes():
+    parser = JSONArrayParser()
+
+    assert parser.feed('[{"title": "one"}') == [(0, {"title": "one"})]
+    assert parser.feed(', {"title": "tw') == []
+    assert parser.feed('o"}]') == [(1, {"title": "two"})]
+
+
+def test_treats_a_single_object_as_the_only_element():
+    parser = JSONArrayParser()
+
+    assert parser.feed('Here it is: {"title": "one"} and more {"x": 1}') == [
+        (0, {"title": "one"})
+    ]
+
+
+@pytest.mark.parametrize(
+    "truncated_output, repaired",
+    [
+        (
+            '[{"title": "one", "summary": "The cit',
+            {"title": "one", "summary": "The cit"},
+        ),
+        ('[{"title": "one", "summ', {"title": "one"}),
+        ('[{"title": "one", "summary":', {"title": "one"}),
+        ('[{"title": "one", "tags": ["a", "b', {"title": "one", "tags": ["a", "b"]}),
+        ('[{"title": "one", "likely": tr', {"title": "one"}),
+    ],
+)
+def test_repairs_a_truncated_last_object(truncated_output, repaired):
+    parser = JSONArrayParser()
+
+    assert parser.feed(truncated_output) == []
+    assert parser.close() == (0, repaired)
+    assert parser.truncated
+
+
+@pytest.mark.parametrize(
+    "truncated_output, complete_members",
+    [
+        ('[{"id": 1, "summary": "The cit', {"id": 1}),
+        ('[{"id": 1, "title": "one", "summary": "The cit', {"id": 1, "title": "one"}),
+        ('[{"id": 1, "tags": ["a", "b', {"id": 1}),
+        ('[{"summary": "The cit', None),
+        ('[{"id": 1, "tags": ["a", "b"], "likely": tr', {"id": 1, "tags": ["a", "b"]}),
+    ],
+)
+def test_repairs_a_truncated_last_object_from_its_complete_members(
+    truncated_output, complete_members
+):
+    parser = JSONArrayParser()
+    parser.feed(truncated_output)
+
+    repaired = parser.close(complete_members_only=True)
+
+    assert repaired == (None if complete_members is None else (0, complete_members))
+
+
+def test_json_chat_streams_object_events():
+    # The answer ends in the middle of an escaped quote of the second card
+    truncated_cards = CARDS[: CARDS.index("hi") - 1]
+
+    async def model_output():
+        for start in range(0, len(truncated_cards), 4):
+            yield {"content": truncated_cards[start : start + 4]}
+
+    chat_client = MagicMock()
+    chat_client.astream.return_value = model_output()
+    chat_client.last_usage = None
+    json_chat = JSONChat(chat_client=chat_client, event_stream_standard=False)
+
+    async def collect():
+        return [
+            json.loads(event)
+            async for event in json_chat.arun("Give me cards", object_events=True)
+        ]
+
+    assert asyncio.run(collect()) == [
+        {
+            "type": "object",
+            "index": 0,
+            "data": {"title": "Cities, greener", "tags": ["a", "b"]},
+        },
+        {"type": "object", "index": 1, "data": {"title": "Say "}, "repaired": True},
+    ]
+    assert json_chat.memory[-1].content == truncated_cards
+
+
+def test_json_chat_numbers_objects_completed_by_the_same_chunk():
+    async def model_output():
+        yield {"content": '[{"title": "one"}, {"title": "two"}, {"title": '}
+        yield {"content": '"three"}]'}
+
+    chat_client = MagicMock()
+    chat_client.astream.return_value = model_output()
+    chat_client.last_usage = None
+    json_chat = JSONChat(chat_client=chat_client, event_stream_standard=False)
+
+    async def collect():
+        return [
+            json.loads(event)
+            async for event in json_chat.arun("Give me cards", object_events=True)
+        ]
+
+    assert [
+        (event["index"], event["data"]["title"]) for event in asyncio.run(collect())
+    ] == [
+        (0, "one"),
+        (1, "two"),
+        (2, "three"),
+    ]
+
+
+def test_json_chat_only_applies_complete_members_of_a_truncated_change():
+    async def model_output():
+        yield {"content": '[{"id": 1, "summary": "in France"}, '}
+        yield {"content": '{"id": 2, "title": "Greater London", "summary": "in the U'}
+
+    chat_client = MagicMock()
+    chat_client.astream.return_value = model_output()
+    chat_client.last_usage = None
+    json_chat = JSONChat(chat_client=chat_client, event_stream_standard=False)
+    card_state = CardState([{"id": 1, "title": "Paris"}, {"id": 2, "title": "London"}])
+
+    async def collect():
+        return [
+            json.loads(event)
+            async for event in json_chat.arun(
+                "Add a summary", on_object=card_state.apply_patch
+            )
+        ]
+
+    events = asyncio.run(collect())
+
+    assert events[-1] == {
+        "type": "patch",
+        "id": 2,
+        "version": 1,
+        "data": {"title": "Greater London"},
+        "repaired": True,
+    }
+    assert card_state.cards["2"] == {"id": 2, "title": "Greater London"}
@@ -0,0 +1,164 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import hashlib
+import json
+import os
+from unittest.mock import MagicMock
+
+import frontmatter
+import pytest
+
+from embeddings.model import EmbeddingModel
+from knowledge.bundle import (
+    BUNDLE_FORMAT_VERSION,
+    BUNDLE_HEADER,
+    BUNDLE_MAGIC,
+    BundlePackFileReader,
+    KnowledgePackBundle,
+)
+from knowledge.pack import KnowledgePackError
+from knowledge_manager import KnowledgeManager
+from prompts.prompts import PromptList
+from tests.utils import get_test_data_path
+
+
+def compile_bundle(kp_root, output_path):
+    # Writes the same format as `haiven-cli compile-pack`
+    manifest = {
+        "format_version": BUNDLE_FORMAT_VERSION,
+        "created_at": "2024-01-01T00:00:00+00:00",
+        "directories": [],
+        "files": {},
+        "texts": {},
+        "indexes": {},
+    }
+    index_folders = []
+    for root, folders, files in os.walk(kp_root):
+        relative_root = os.path.relpath(root, kp_root).replace(os.sep, "/")
+        prefix = "" if relative_root == "." else relative_root + "/"
+        for folder in sorted(folders):
+            if folder.endswith(".kb"):
+                index_folders.append(prefix + folder)
+            else:
+                manifest["directories"].append(prefix + folder)
+        folders[:] = [folder for folder in folders if not folder.endswith(".kb")]
+        for file in files:
+            path = os.path.join(root, file)
+            if file.endswith(".md") and file != "README.md":
+                post = frontmatter.load(path)
+                manifest["files"][prefix + file] = {
+                    "metadata": post.metadata,
+                    "content": post.content,
+                }
+            elif file.endswith(".yaml"):
+                with open(path) as text_file:
+                    manifest["texts"][prefix + file] = text_file.read()
+
+    segments = b""
+    for section, file_name in [("vectors", "index.faiss"), ("chunks", "index.pkl")]:
+        for index_folder in index_folders:
+            with open(os.path.join(kp_root, index_folder, file_name), "rb") as file:
+                content = file.read()
+            manifest["indexes"].setdefault(index_folder, {})[section] = {
+                "offset": len(segments),
+                "length": len(content),
+                "sha256": hashlib.sha256(content).hexdigest(),
+            }
+            segments += content
+
+    manifest_bytes = json.dumps(manifest).encode("utf-8")
+    with open(output_path, "wb") as file:
+        file.write(
+            BUNDLE_HEADER.pack(
+                BUNDLE_MAGIC,
+                BUNDLE_FORMAT_VERSION,
+                len(manifest_bytes),
+                hashlib.sha256(manifest_bytes).digest(),
+            )
+        )
+        file.write(manifest_bytes)
+        file.write(segments)
+
+
+class TestKnowledgePackBundle:
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_path):
+        self.bundle_path = str(tmp_path / "pack.bundle")
+        compile_bundle(get_test_data_path() + "/test_knowledge_pack", self.bundle_path)
+
+        # Only the (empty) folder is deployed, everything else comes from the bundle
+        self.pack_path = str(tmp_path / "pack")
+        os.mkdir(self.pack_path)
+
+        self.config_service = MagicMock()
+        self.config_service.load_knowledge_pack_path.return_value = self.pack_path
+        self.config_service.load_embedding_model.return_value = EmbeddingModel(
+            id="ollama-embeddings",
+            name="Ollama Embeddings",
+            provider="ollama",
+            config={"model": "ollama-embeddings", "api_key": "api_key"},
+        )
+
+    def _create_reader(self):
+        return BundlePackFileReader(
+            KnowledgePackBundle(self.bundle_path, self.pack_path)
+        )
+
+    def test_knowledge_manager_loads_knowledge_from_bundle(self):
+        knowledge_manager = KnowledgeManager(
+            config_service=self.config_service, pack_file_reader=self._create_reader()
+        )
+
+        assert sorted(
+            context.name
+            for context in knowledge_manager.knowledge_pack_definition.contexts
+        ) == ["context_a", "context_b"]
+        assert knowledge_manager.knowledge_base_markdown.get_context_keys(
+            "context_a"
+        ) == ["architecture", "business", "frontend_coding_patterns"]
+
+        documents = knowledge_manager.knowledge_base_documents
+        document = documents.get_document("ingenuity-wikipedia")
+        assert document is not None
+        assert document.retriever.index.ntotal > 0
+
+    def test_prompt_list_loads_prompts_and_flows_from_bundle(self):
+        reader = self._create_reader()
+        knowledge_manager = KnowledgeManager(
+            config_service=self.config_service, pack_file_reader=reader
+        )
+
+        prompt_list = PromptList(
+            "chat",
+            knowledge_manager.knowledge_base_markdown,
+            root_dir=self.pack_path,
+            pack_file_reader=reader,
+        )
+
+        assert prompt_list.get("uuid-1").metadata["title"] == "Test1"
+        assert len(prompt_list.prompt_flows) > 0
+
+    def test_reads_files_outside_of_knowledge_pack_from_disk(self, tmp_path):
+        other_file = tmp_path / "other.md"
+        other_file.write_text("---\nidentifier: other\n---\nOther")
+
+        posts = self._create_reader().load_all([str(other_file)])
+
+        assert posts[0].metadata["identifier"] == "other"
+
+    def test_fails_for_corrupted_manifest(self):
+        with open(self.bundle_path, "r+b") as file:
+            file.seek(BUNDLE_HEADER.size + 5)
+            file.write(b"#")
+
+        with pytest.raises(KnowledgePackError):
+            KnowledgePackBundle(self.bundle_path, self.pack_path)
+
+    def test_fails_for_corrupted_segment(self):
+        with open(self.bundle_path, "r+b") as file:
+            file.seek(-1, os.SEEK_END)
+            file.write(b"#")
+        bundle = KnowledgePackBundle(self.bundle_path, self.pack_path)
+
+        with pytest.raises(KnowledgePackError):
+            for index_path in bundle.manifest["indexes"]:
+                bundle.read_index(index_path)
@@ -0,0 +1,251 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+import shutil
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+from embeddings.model import EmbeddingModel
+from knowledge.documents import KnowledgeBaseDocuments
+from knowledge.pack import KnowledgePackError, KnowledgePackSource
+from knowledge.pack_files import PackFileReader
+from knowledge.registry import (
+    DEFAULT_KNOWLEDGE_PACK_ID,
+    KnowledgePackRegistry,
+    LoadedKnowledgePack,
+    selected_knowledge_pack_id,
+)
+from server import Server
+from tests.utils import get_test_data_path
+
+
+def create_knowledge_pack(name):
+    knowledge_manager = MagicMock()
+    knowledge_manager.name = name
+    return LoadedKnowledgePack(
+        knowledge_manager=knowledge_manager,
+        prompts_chat=MagicMock(),
+        prompts_guided=MagicMock(),
+        disclaimer_and_guidelines=MagicMock(),
+    )
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestKnowledgePackRegistry:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.default_knowledge_pack = create_knowledge_pack("default")
+        self.sources = [
+            KnowledgePackSource(id="team-a", path="/kp/team-a", groups=["team-a"]),
+            KnowledgePackSource(id="team-b", path="/kp/team-b", groups=["team-b"]),
+            KnowledgePackSource(id="shared", path="/kp/shared"),
+        ]
+        self.load_knowledge_pack = MagicMock(
+            side_effect=lambda source: create_knowledge_pack(source.id)
+        )
+        self.clock = FakeClock()
+
+    def _create_registry(self, **kwargs):
+        return KnowledgePackRegistry(
+            self.default_knowledge_pack,
+            self.sources,
+            self.load_knowledge_pack,
+            clock=self.clock,
+            **kwargs,
+        )
+
+    def test_loads_knowledge_packs_on_first_use_only(self):
+        registry = self._create_registry()
+
+        assert registry.loaded_knowledge_pack_ids() == [DEFAULT_KNOWLEDGE_PACK_ID]
+        assert registry.get() is self.default_knowledge_pack
+
+        team_a = registry.get("team-a")
+        assert team_a.knowledge_manager.name == "team-a"
+        assert registry.get("team-a") is team_a
+        assert self.load_knowledge_pack.call_count == 1
+        assert registry.loaded_knowledge_pack_ids() == [
+            DEFAULT_KNOWLEDGE_PACK_ID,
+            "team-a",
+        ]
+
+    def test_default_id_is_reserved(self):
+        self.sources.append(KnowledgePackSource(id="default", path="/kp/other"))
+
+        with pytest.raises(KnowledgePackError):
+            self._create_registry()
+
+    def test_unloads_idle_knowledge_packs(self):
+        registry = self._create_registry(idle_seconds=60)
+        registry.get("team-a")
+        self.clock.now = 30
+        registry.get("team-b")
+
+        self.clock.now = 80
+        assert registry.unload_unused() == ["team-a"]
+        assert registry.loaded_knowledge_pack_ids() == [
+            DEFAULT_KNOWLEDGE_PACK_ID,
+            "team-b",
+        ]
+
+        # Unloaded knowledge packs are loaded again when they are used
+        registry.get("team-a")
+        assert self.load_knowledge_pack.call_count == 3
+
+    def test_unloads_idle_knowledge_packs_when_any_knowledge_pack_is_used(self):
+        registry = self._create_registry(idle_seconds=60)
+        registry.get("team-a")
+
+        self.clock.now = 80
+        registry.get()
+
+        assert registry.loaded_knowledge_pack_ids() == [DEFAULT_KNOWLEDGE_PACK_ID]
+
+    def test_unloads_idle_knowledge_packs_in_the_background(self):
+        registry = self._create_registry(idle_seconds=60)
+        registry.get("team-a")
+        self.clock.now = 80
+
+        registry.start(interval_seconds=0.01)
+        try:
+            for _ in range(100):
+                if registry.loaded_knowledge_pack_ids() == [DEFAULT_KNOWLEDGE_PACK_ID]:
+                    break
+                time.sleep(0.01)
+        finally:
+            registry.stop()
+
+        assert registry.loaded_knowledge_pack_ids() == [DEFAULT_KNOWLEDGE_PACK_ID]
+
+    def test_unloads_least_recently_used_knowledge_packs_over_the_limit(self):
+        registry = self._create_registry(max_loaded=2)
+        registry.get("team-a")
+        self.clock.now = 1
+        registry.get("team-b")
+        self.clock.now = 2
+        registry.get("team-a")
+        self.clock.now = 3
+
+        registry.get("shared")
+
+        assert sorted(registry.loaded_knowledge_pack_ids()) == [
+            DEFAULT_KNOWLEDGE_PACK_ID,
+            "shared",
+            "team-a",
+        ]
+
+    def test_selects_requested_knowledge_pack_for_users_in_its_groups(self):
+        registry = self._create_registry()
+
+        assert registry.select("team-a", ["team-a"]) == "team-a"
+        assert registry.select("shared", []) == "shared"
+        assert registry.select("default", []) == DEFAULT_KNOWLEDGE_PACK_ID
+        with pytest.raises(PermissionError):
+            registry.select("team-a", ["team-b"])
+        with pytest.raises(KnowledgePackError):
+            registry.select("unknown", ["team-a"])
+
+    def test_selects_knowledge_pack_of_the_users_group_by_default(self):
+        registry = self._create_registry()
+
+        assert registry.select(None, ["team-b"]) == "team-b"
+        assert registry.select(None, ["other"]) == DEFAULT_KNOWLEDGE_PACK_ID
+        assert registry.select(None, None) == DEFAULT_KNOWLEDGE_PACK_ID
+
+    def test_current_knowledge_pack_forwards_to_the_selected_one(self):
+        registry = self._create_registry()
+        current = registry.current_knowledge_pack()
+
+        assert current.knowledge_manager.name == "default"
+        with registry.selected("team-b"):
+            assert current.knowledge_manager.name == "team-b"
+            assert selected_knowledge_pack_id() == "team-b"
+        assert current.knowledge_manager.name == "default"
+        assert selected_knowledge_pack_id() == DEFAULT_KNOWLEDGE_PACK_ID
+
+    def test_server_selects_knowledge_pack_for_each_request(self, monkeypatch):
+        monkeypatch.setenv("AUTH_SWITCHED_OFF", "true")
+        registry = self._create_registry()
+        current = registry.current_knowledge_pack()
+
+        app = FastAPI()
+        Server(MagicMock(), MagicMock(), knowledge_packs=registry).user_endpoints(app)
+
+        @app.get("/api/knowledge-pack")
+        def knowledge_pack():
+            return {"name": current.knowledge_manager.name}
+
+        @app.get("/api/knowledge-pack/stream")
+        def knowledge_pack_stream():
+            def stream():
+                yield current.knowledge_manager.name
+
+            return StreamingResponse(stream())
+
+        client = TestClient(app)
+
+        assert client.get("/api/knowledge-pack").json() == {"name": "default"}
+        assert client.get(
+            "/api/knowledge-pack", headers={KnowledgePackRegistry.HEADER: "shared"}
+        ).json() == {"name": "shared"}
+        assert (
+            client.get(
+                "/api/knowledge-pack/stream",
+                headers={KnowledgePackRegistry.HEADER: "shared"},
+            ).text
+            == "shared"
+        )
+        assert (
+            client.get(
+                "/api/knowledge-pack", headers={KnowledgePackRegistry.HEADER: "team-a"}
+            ).status_code
+            == 403
+        )
+        assert (
+            client.get(
+                "/api/knowledge-pack", headers={KnowledgePackRegistry.HEADER: "unknown"}
+            ).status_code
+            == 404
+        )
+
+
+class TestSharedEmbeddingsIndexes:
+    def test_knowledge_packs_share_indexes_but_not_document_stores(self, tmp_path):
+        # Two knowledge packs with the same index files, e.g. two teams that use the same documents
+        pack_a = str(tmp_path / "pack_a")
+        pack_b = str(tmp_path / "pack_b")
+        shutil.copytree(get_test_data_path() + "/test_knowledge_pack", pack_a)
+        os.symlink(pack_a, pack_b)
+        config_service = MagicMock()
+        config_service.load_embedding_model.return_value = EmbeddingModel(
+            id="ollama-embeddings",
+            name="Ollama Embeddings",
+            provider="ollama",
+            config={"model": "ollama-embeddings", "api_key": "api_key"},
+        )
+
+        documents_a = KnowledgeBaseDocuments(
+            config_service, pack_file_reader=PackFileReader()
+        )
+        documents_a.load_documents_for_base(os.path.join(pack_a, "embeddings"))
+        documents_b = KnowledgeBaseDocuments(
+            config_service, pack_file_reader=PackFileReader()
+        )
+
+        assert documents_b.get_documents() == []
+
+        documents_b.load_documents_for_base(os.path.join(pack_b, "embeddings"))
+        document_a = documents_a.get_documents()[0]
+        document_b = documents_b.get_document(document_a.key)
+        assert document_b.retriever is document_a.retriever
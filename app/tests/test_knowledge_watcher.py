@@ -0,0 +1,114 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+import shutil
+from unittest.mock import MagicMock
+
+import pytest
+
+from embeddings.model import EmbeddingModel
+from knowledge.watcher import KnowledgePackReloader, KnowledgePackWatcher
+from knowledge_manager import KnowledgeManager
+from prompts.prompts import PromptList
+from tests.utils import get_test_data_path
+
+
+def _write(path, content):
+    with open(path, "w") as file:
+        file.write(content)
+
+
+class TestKnowledgePackWatcher:
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_path):
+        self.pack_path = str(tmp_path / "pack")
+        shutil.copytree(get_test_data_path() + "/test_knowledge_pack", self.pack_path)
+
+        config_service = MagicMock()
+        config_service.load_knowledge_pack_path.return_value = self.pack_path
+        config_service.load_embedding_model.return_value = EmbeddingModel(
+            id="ollama-embeddings",
+            name="Ollama Embeddings",
+            provider="ollama",
+            config={"model": "ollama-embeddings", "api_key": "api_key"},
+        )
+        self.knowledge_manager = KnowledgeManager(config_service=config_service)
+        self.prompt_list = PromptList(
+            "chat",
+            self.knowledge_manager.knowledge_base_markdown,
+            root_dir=self.pack_path,
+        )
+        self.reloader = KnowledgePackReloader(
+            self.knowledge_manager, [self.prompt_list]
+        )
+
+    def test_reports_changes_only_once_files_are_stable(self):
+        on_change = MagicMock()
+        watcher = KnowledgePackWatcher(self.pack_path, on_change)
+        changed_file = self.pack_path + "/contexts/context_a/architecture.md"
+
+        assert watcher.check_for_changes() == []
+
+        _write(changed_file, "---\nkey: architecture\n---\nNew architecture")
+        assert watcher.check_for_changes() == []
+        assert watcher.check_for_changes() == [changed_file]
+        assert watcher.check_for_changes() == []
+
+    def test_reports_removed_files(self):
+        watcher = KnowledgePackWatcher(self.pack_path, MagicMock())
+        removed_file = self.pack_path + "/prompts/chat/uuid-2-coding.md"
+
+        os.remove(removed_file)
+        watcher.check_for_changes()
+
+        assert watcher.check_for_changes() == [removed_file]
+
+    def test_reloads_changed_context_markdown(self):
+        _write(
+            self.pack_path + "/contexts/context_a/architecture.md",
+            "---\nkey: architecture\n---\nNew architecture",
+        )
+
+        self.reloader.on_change(
+            [self.pack_path + "/contexts/context_a/architecture.md"]
+        )
+
+        knowledge = (
+            self.knowledge_manager.knowledge_base_markdown.get_knowledge_content_dict(
+                "context_a"
+            )
+        )
+        assert knowledge["architecture"] == "New architecture"
+
+    def test_reloads_prompts_when_a_prompt_is_added(self):
+        assert self.prompt_list.get("uuid-new") is None
+        new_prompt = self.pack_path + "/prompts/chat/uuid-new.md"
+        _write(new_prompt, "---\nidentifier: uuid-new\ntitle: New\n---\nNew prompt")
+
+        self.reloader.on_change([new_prompt])
+
+        assert self.prompt_list.get("uuid-new").metadata["title"] == "New"
+
+    def test_reloads_and_removes_documents(self):
+        documents = self.knowledge_manager.knowledge_base_documents
+        document_path = self.pack_path + "/embeddings/ingenuity_wikipedia.md"
+        previous_document = documents.get_document("ingenuity-wikipedia")
+
+        self.reloader.on_change(
+            [self.pack_path + "/embeddings/ingenuity_wikipedia.kb/index.faiss"]
+        )
+        reloaded_document = documents.get_document("ingenuity-wikipedia")
+        assert reloaded_document is not None
+        assert reloaded_document is not previous_document
+
+        os.remove(document_path)
+        self.reloader.on_change([document_path])
+        assert documents.get_document("ingenuity-wikipedia") is None
+
+    def test_keeps_previous_version_when_reload_fails(self):
+        documents = self.knowledge_manager.knowledge_base_documents
+        document_path = self.pack_path + "/embeddings/ingenuity_wikipedia.md"
+        shutil.rmtree(self.pack_path + "/embeddings/ingenuity_wikipedia.kb")
+
+        self.reloader.on_change([document_path])
+
+        assert documents.get_document("ingenuity-wikipedia") is not None
@@ -0,0 +1,171 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from llms.chats import StreamingChat
+from llms.clients import (
+    ChatClient,
+    HaivenAIMessage,
+    HaivenHumanMessage,
+    HaivenSystemMessage,
+    MockResult,
+)
+from llms.memory_manager import MemoryManager
+from llms.model_config import ModelConfig
+from llms.rate_limiter import ModelRateLimiter
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def model_result(content):
+    return MockResult.model_validate({"choices": [{"delta": {"content": content}}]})
+
+
+def conversation(turns):
+    memory = [
+        HaivenSystemMessage(content="You are a helpful assistant"),
+        HaivenHumanMessage(content="Write user stories for a login page"),
+    ]
+    for turn in range(turns):
+        memory.append(HaivenAIMessage(content=f"answer {turn} " + "story " * 20))
+        memory.append(HaivenHumanMessage(content=f"question {turn + 1}"))
+    return memory
+
+
+class TestMemoryManager:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        model_config = ModelConfig("azure-gpt4", "azure", "GPT-4", config={})
+        self.memory_manager = MemoryManager(
+            ChatClient(model_config),
+            max_tokens=80,
+            keep_recent_messages=2,
+            count_tokens=count_words,
+        )
+
+    def test_sends_the_whole_conversation_while_it_fits_the_budget(self):
+        memory = conversation(turns=1)
+
+        assert self.memory_manager.messages_for_model(memory) == memory
+        assert not self.memory_manager.needs_compaction(memory)
+
+    def test_leaves_out_the_oldest_turns_until_they_are_summarised(self):
+        memory = conversation(turns=4)
+
+        sent = self.memory_manager.messages_for_model(memory)
+
+        assert sent[:2] == memory[:2]
+        assert sent[-1] == memory[-1]
+        assert sum(count_words(message.content) for message in sent) <= 80
+        assert self.memory_manager.needs_compaction(memory)
+
+    @patch("llms.clients.llmCompletion")
+    def test_replaces_older_turns_with_a_summary(self, mock_completion):
+        mock_completion.return_value = [model_result("The user wants login stories")]
+        memory = conversation(turns=4)
+
+        self.memory_manager.compact(memory)
+        sent = self.memory_manager.messages_for_model(memory)
+
+        summary_request = mock_completion.call_args.kwargs["messages"][0]["content"]
+        assert "answer 0" in summary_request and "answer 3" not in summary_request
+        assert (
+            sent
+            == memory[:2]
+            + [
+                HaivenSystemMessage(
+                    content="Summary of the conversation so far:\nThe user wants login stories"
+                )
+            ]
+            + memory[-2:]
+        )
+        assert not self.memory_manager.needs_compaction(memory)
+
+    @patch("llms.clients.llmCompletion")
+    def test_keeps_the_turns_when_summarising_fails(self, mock_completion):
+        mock_completion.side_effect = ConnectionError("model is down")
+        memory = conversation(turns=4)
+
+        self.memory_manager.compact(memory)
+
+        assert self.memory_manager.summary is None
+        assert self.memory_manager.summarized_count == 0
+
+    @patch("llms.clients.llmCompletion")
+    def test_summarises_within_the_models_rate_limit(self, mock_completion):
+        mock_completion.return_value = [model_result("The user wants login stories")]
+        rate_limiter = ModelRateLimiter(max_concurrent=1)
+        self.memory_manager.rate_limiter = rate_limiter
+        memory = conversation(turns=4)
+        usages = []
+
+        busy = rate_limiter.try_acquire()
+        self.memory_manager.compact(memory, on_usage=usages.append)
+        assert self.memory_manager.summary is None
+        busy.release()
+        self.memory_manager.compact(memory, on_usage=usages.append)
+
+        assert mock_completion.call_count == 1
+        assert self.memory_manager.summary == "The user wants login stories"
+        assert len(usages) == 1
+        assert rate_limiter.active() == 0
+
+
+class TestStreamingChatWithMemoryManager:
+    @patch("llms.clients.llmAcompletion")
+    def test_summarises_between_turns(self, mock_acompletion):
+        requests = []
+
+        async def acompletion(messages, **kwargs):
+            requests.append(messages)
+
+            async def results():
+                if "Summarise" in messages[-1]["content"]:
+                    yield model_result("SUMMARY")
+                else:
+                    yield model_result("answer " + "story " * 20)
+
+            return results()
+
+        mock_acompletion.side_effect = acompletion
+        chat_client = ChatClient(ModelConfig("azure-gpt4", "azure", "GPT-4", config={}))
+        rate_limiter = ModelRateLimiter(max_concurrent=1)
+        chat = StreamingChat(
+            chat_client,
+            None,
+            memory_manager=MemoryManager(
+                chat_client,
+                max_tokens=80,
+                keep_recent_messages=2,
+                count_tokens=count_words,
+                rate_limiter=rate_limiter,
+            ),
+        )
+        usages = []
+
+        async def chat_for(turns):
+            for turn in range(turns):
+                [
+                    chunk
+                    async for chunk in chat.arun(
+                        f"question {turn}", on_usage=usages.append
+                    )
+                ]
+                if chat.memory_manager.compacting():
+                    await chat.memory_manager._compaction
+
+        asyncio.run(chat_for(turns=4))
+
+        assert chat.memory_manager.summary == "SUMMARY"
+        # Each turn and each summary is counted
+        assert len(usages) == len(requests)
+        assert rate_limiter.active() == 0
+        assert len(chat.memory) == 9
+        assert any(
+            "Summary of the conversation so far:\nSUMMARY" in message["content"]
+            for message in requests[-1]
+        )
@@ -0,0 +1,50 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import pytest
+from langchain.schema import AIMessage, HumanMessage
+
+from llms.clients import HaivenAIMessage, HaivenHumanMessage, HaivenSystemMessage
+
+
+def test_appended_chunks_are_joined_when_the_content_is_read():
+    message = HaivenAIMessage(content="")
+    for chunk in ['[{"title": ', '"Paris"', "}]"]:
+        message.append(chunk)
+
+    assert message.content == '[{"title": "Paris"}]'
+    message.append(" ")
+    assert message.content_length() == 21
+    assert message.content == '[{"title": "Paris"}] '
+
+
+def test_content_can_be_replaced():
+    message = HaivenHumanMessage(content="rendered prompt")
+    message.append(" and more")
+
+    message.content = "what the user asked"
+
+    assert message.content == "what the user asked"
+
+
+def test_messages_are_compatible_with_the_model_apis():
+    message = HaivenAIMessage(content="Par")
+    message.append("is")
+
+    assert message.to_json() == {"content": "Paris", "role": "assistant"}
+    assert message.to_langchain() == AIMessage(content="Paris")
+    assert HaivenHumanMessage(content="Hi").to_langchain() == HumanMessage(content="Hi")
+    assert HaivenSystemMessage(content="Be brief").to_json()["role"] == "system"
+
+
+def test_messages_are_equal_by_type_and_content():
+    assert HaivenAIMessage(content="Paris") == HaivenAIMessage(content="Paris")
+    assert HaivenAIMessage(content="Paris") != HaivenHumanMessage(content="Paris")
+    assert str(HaivenAIMessage(content="Paris")) == "content='Paris'"
+
+
+def test_messages_have_no_attribute_dict():
+    message = HaivenAIMessage(content="Paris")
+
+    with pytest.raises(AttributeError):
+        message.title = "Capital"
+    with pytest.raises(TypeError):
+        HaivenAIMessage(content=None)
@@ -0,0 +1,210 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from llms.clients import HaivenHumanMessage, MockResult, RoutedChatClient
+from llms.model_config import ModelConfig
+from llms.model_router import ModelRouter
+from llms.rate_limiter import ModelRateLimiters
+
+
+def azure_model(id, tier="large", limits=None):
+    return ModelConfig(
+        id, "azure", id, config={"azure_deployment": id}, tier=tier, limits=limits
+    )
+
+
+async def model_results(*contents, delay_seconds=0, cancelled=None):
+    try:
+        await asyncio.sleep(delay_seconds)
+        for content in contents:
+            yield MockResult.model_validate(
+                {"choices": [{"delta": {"content": content}}]}
+            )
+    except asyncio.CancelledError:
+        cancelled.append(True)
+        raise
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+class TestModelRouter:
+    def test_prefers_the_configured_model_then_the_fastest_of_its_tier(self):
+        primary, slow, fast = (
+            azure_model("gpt4"),
+            azure_model("slow"),
+            azure_model("fast"),
+        )
+        router = ModelRouter([primary, slow, fast, azure_model("small", "small")])
+        router.record_first_token("slow", 2.0)
+        router.record_first_token("fast", 0.5)
+
+        assert [model.id for model in router.candidates(primary)] == [
+            "gpt4",
+            "fast",
+            "slow",
+        ]
+        untiered = azure_model("untiered", tier=None)
+        assert router.candidates(untiered) == [untiered]
+
+    def test_tries_degraded_models_last(self):
+        primary, backup = azure_model("gpt4"), azure_model("backup")
+        router = ModelRouter([primary, backup], min_samples=2)
+        router.record_error("gpt4")
+        router.record_error("gpt4")
+
+        assert [model.id for model in router.candidates(primary)] == [
+            "backup",
+            "gpt4",
+        ]
+
+    def test_hedges_after_the_percentile_of_recent_first_token_times(self):
+        primary = azure_model("gpt4")
+        router = ModelRouter([primary], hedging_percentile=90, min_samples=10)
+        for seconds in range(1, 10):
+            router.record_first_token("gpt4", seconds)
+
+        assert router.hedging_timeout(primary) is None
+        router.record_first_token("gpt4", 10)
+        assert router.hedging_timeout(primary) == 10
+
+
+class TestRoutedChatClient:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.primary = azure_model("gpt4")
+        self.backup = azure_model("backup")
+        self.messages = [HaivenHumanMessage(content="Hello")]
+
+    @patch("llms.clients.llmAcompletion")
+    def test_fails_over_when_the_model_fails_before_the_first_token(
+        self, mock_acompletion
+    ):
+        async def acompletion(model, **kwargs):
+            if model == "azure/gpt4":
+                raise ConnectionError("provider is down")
+            return model_results("Hi ", "there")
+
+        mock_acompletion.side_effect = acompletion
+        router = ModelRouter([self.primary, self.backup])
+        chat_client = RoutedChatClient(self.primary, router)
+
+        chunks = asyncio.run(collect(chat_client.astream(self.messages)))
+
+        assert chunks == [{"content": "Hi "}, {"content": "there"}]
+        assert chat_client.answered_by.id == "backup"
+        assert router.health("gpt4").error_rate() == 1
+        assert router.health("backup").sample_count() == 1
+
+    @patch("llms.clients.llmAcompletion")
+    def test_hedges_slow_requests_and_cancels_the_slower_one(self, mock_acompletion):
+        cancelled = []
+
+        async def acompletion(model, **kwargs):
+            if model == "azure/gpt4":
+                return model_results("Slow", delay_seconds=5, cancelled=cancelled)
+            return model_results("Fast")
+
+        mock_acompletion.side_effect = acompletion
+        router = ModelRouter(
+            [self.primary, self.backup], hedging_percentile=50, min_samples=1
+        )
+        router.record_first_token("gpt4", 0.01)
+        chat_client = RoutedChatClient(self.primary, router)
+
+        chunks = asyncio.run(collect(chat_client.astream(self.messages)))
+
+        assert chunks == [{"content": "Fast"}]
+        assert chat_client.answered_by.id == "backup"
+        assert cancelled == [True]
+
+    @patch("llms.clients.llmAcompletion")
+    def test_raises_when_all_models_fail(self, mock_acompletion):
+        async def acompletion(model, **kwargs):
+            raise ConnectionError(f"{model} is down")
+
+        mock_acompletion.side_effect = acompletion
+        chat_client = RoutedChatClient(
+            self.primary, ModelRouter([self.primary, self.backup])
+        )
+
+        with pytest.raises(ConnectionError):
+            asyncio.run(collect(chat_client.astream(self.messages)))
+
+    @patch("llms.clients.llmAcompletion")
+    def test_reserves_the_models_it_routes_to(self, mock_acompletion):
+        backup = azure_model("backup", limits={"max_concurrent": "1"})
+        rate_limiters = ModelRateLimiters()
+        backup_limiter = rate_limiters.get(backup)
+        active_while_streaming = []
+
+        async def acompletion(model, **kwargs):
+            if model == "azure/gpt4":
+                raise ConnectionError("provider is down")
+            active_while_streaming.append(backup_limiter.active())
+            return model_results("Hi")
+
+        mock_acompletion.side_effect = acompletion
+        chat_client = RoutedChatClient(
+            self.primary, ModelRouter([self.primary, backup]), rate_limiters
+        )
+
+        chunks = asyncio.run(collect(chat_client.astream(self.messages)))
+
+        assert chunks == [{"content": "Hi"}]
+        assert active_while_streaming == [1]
+        assert backup_limiter.active() == 0
+
+    @patch("llms.clients.llmAcompletion")
+    def test_does_not_hedge_into_models_without_a_free_turn(self, mock_acompletion):
+        backup = azure_model("backup", limits={"max_concurrent": "1"})
+        rate_limiters = ModelRateLimiters()
+        busy = rate_limiters.get(backup).try_acquire()
+        models = []
+
+        async def acompletion(model, **kwargs):
+            models.append(model)
+            return model_results("Slow", delay_seconds=0.05)
+
+        mock_acompletion.side_effect = acompletion
+        router = ModelRouter(
+            [self.primary, backup], hedging_percentile=50, min_samples=1
+        )
+        router.record_first_token("gpt4", 0.01)
+        chat_client = RoutedChatClient(self.primary, router, rate_limiters)
+
+        chunks = asyncio.run(collect(chat_client.astream(self.messages)))
+
+        assert chunks == [{"content": "Slow"}]
+        assert models == ["azure/gpt4"]
+        busy.release()
+
+    @patch("llms.clients.llmAcompletion")
+    def test_releases_the_models_that_failed_over(self, mock_acompletion):
+        limits = {"max_concurrent": "1"}
+        backup = azure_model("backup", limits=limits)
+        third = azure_model("third", limits=limits)
+        rate_limiters = ModelRateLimiters()
+
+        async def acompletion(model, **kwargs):
+            if model in ("azure/gpt4", "azure/backup"):
+                raise ConnectionError(f"{model} is down")
+            return model_results("Hi")
+
+        mock_acompletion.side_effect = acompletion
+        chat_client = RoutedChatClient(
+            self.primary, ModelRouter([self.primary, backup, third]), rate_limiters
+        )
+
+        chunks = asyncio.run(collect(chat_client.astream(self.messages)))
+
+        assert chunks == [{"content": "Hi"}]
+        assert chat_client.answered_by.id == "third"
+        assert rate_limiters.status() == {
+            "backup": {"active": 0, "queue_depth": 0},
+            "third": {"active": 0, "queue_depth": 0},
+        }
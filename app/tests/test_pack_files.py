@@ -0,0 +1,94 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import os
+from unittest.mock import MagicMock, patch
+
+import frontmatter
+import pytest
+
+from knowledge.pack_files import PackFileReader
+
+
+class TestPackFileReader:
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_path):
+        self.directory = tmp_path / "prompts"
+        self.directory.mkdir()
+        for identifier in ["b", "a", "c"]:
+            self._write(
+                f"{identifier}.md", f"---\nidentifier: {identifier}\n---\nPrompt"
+            )
+        self._write("README.md", "# Readme")
+        self.cache_dir = str(tmp_path / "cache")
+
+    def _write(self, filename, content):
+        with open(self.directory / filename, "w") as file:
+            file.write(content)
+
+    def test_lists_sorted_markdown_files_without_readme(self):
+        paths = PackFileReader().list_markdown_files(str(self.directory))
+
+        assert [os.path.basename(path) for path in paths] == ["a.md", "b.md", "c.md"]
+
+    def test_load_all_keeps_order_of_paths(self):
+        reader = PackFileReader()
+
+        posts = reader.load_all(reader.list_markdown_files(str(self.directory)))
+
+        assert [post.metadata["identifier"] for post in posts] == ["a", "b", "c"]
+        assert posts[0].content == "Prompt"
+
+    def test_only_parses_changed_files_again(self):
+        reader = PackFileReader()
+        paths = reader.list_markdown_files(str(self.directory))
+        reader.load_all(paths)
+
+        self._write("b.md", "---\nidentifier: b-changed\n---\nChanged prompt")
+        with patch(
+            "knowledge.pack_files.frontmatter.load", wraps=frontmatter.load
+        ) as mock_load:
+            posts = reader.load_all(paths)
+
+        mock_load.assert_called_once_with(str(self.directory / "b.md"))
+        assert posts[1].metadata["identifier"] == "b-changed"
+
+    def test_returns_copies_that_can_be_modified(self):
+        reader = PackFileReader()
+        path = str(self.directory / "a.md")
+
+        reader.load(path).metadata["title"] = "Modified"
+
+        assert "title" not in reader.load(path).metadata
+
+    def test_reuses_disk_cache_across_instances(self):
+        paths = PackFileReader().list_markdown_files(str(self.directory))
+        PackFileReader(cache_dir=self.cache_dir).load_all(paths)
+
+        with patch("knowledge.pack_files.frontmatter.load") as mock_load:
+            posts = PackFileReader(cache_dir=self.cache_dir).load_all(paths)
+
+        mock_load.assert_not_called()
+        assert [post.metadata["identifier"] for post in posts] == ["a", "b", "c"]
+
+    def test_loads_indexes_again_only_when_their_files_change(self, tmp_path):
+        kb_path = tmp_path / "documents.kb"
+        kb_path.mkdir()
+        for file_name in ["index.faiss", "index.pkl"]:
+            (kb_path / file_name).write_bytes(b"index")
+        embeddings_client = MagicMock()
+        reader = PackFileReader()
+
+        with (
+            patch.object(
+                PackFileReader, "_read_index", side_effect=lambda *args: MagicMock()
+            ) as read_index,
+            patch("builtins.open") as open_file,
+        ):
+            first = reader.load_index(str(kb_path), embeddings_client)
+            assert reader.load_index(str(kb_path), embeddings_client) is first
+
+            (kb_path / "index.pkl").unlink()
+            os.mknod(kb_path / "index.pkl")
+            assert reader.load_index(str(kb_path), embeddings_client) is not first
+
+        assert read_index.call_count == 2
+        open_file.assert_not_called()
@@ -31,13 +31,24 @@ class TestPromptsFactory:
         assert diagrams_prompt in prompts
         prompt_list_mock.assert_has_calls(
             [
-                call("chat", knowledge_base_markdown, root_dir=prompts_parent_dir),
+                call(
+                    "chat",
+                    knowledge_base_markdown,
+                    root_dir=prompts_parent_dir,
+                    pack_file_reader=None,
+                ),
                 call(
                     "brainstorming",
                     knowledge_base_markdown,
                     root_dir=prompts_parent_dir,
+                    pack_file_reader=None,
+                ),
+                call(
+                    "diagrams",
+                    knowledge_base_markdown,
+                    root_dir=prompts_parent_dir,
+                    pack_file_reader=None,
                 ),
-                call("diagrams", knowledge_base_markdown, root_dir=prompts_parent_dir),
             ]
         )
 
@@ -54,7 +65,10 @@ class TestPromptsFactory:
 
         assert brainstorming_prompt == prompt
         assert prompt_list_mock.call_args == call(
-            "brainstorming", knowledge_base_markdown, root_dir=prompts_parent_dir
+            "brainstorming",
+            knowledge_base_markdown,
+            root_dir=prompts_parent_dir,
+            pack_file_reader=None,
         )
 
     @patch("prompts.prompts_factory.PromptList")
@@ -70,7 +84,10 @@ class TestPromptsFactory:
 
         assert chat_prompt == prompt
         assert prompt_list_mock.call_args == call(
-            "chat", knowledge_base_markdown, root_dir=prompts_parent_dir
+            "chat",
+            knowledge_base_markdown,
+            root_dir=prompts_parent_dir,
+            pack_file_reader=None,
         )
 
     @patch("prompts.prompts_factory.PromptList")
@@ -91,4 +108,5 @@ class TestPromptsFactory:
             knowledge_base_documents,
             variables=variables,
             root_dir=prompts_parent_dir,
+            pack_file_reader=None,
         )
@@ -0,0 +1,156 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import threading
+import time
+
+import pytest
+
+from llms.model_config import ModelConfig
+from llms.rate_limiter import ModelRateLimiter, ModelRateLimiters, RateLimitExceeded
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestModelRateLimiter:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.clock = FakeClock()
+
+    def test_fails_fast_with_503_when_all_streams_are_busy(self):
+        limiter = ModelRateLimiter(
+            max_concurrent=1, max_wait_seconds=0, clock=self.clock
+        )
+
+        async def scenario():
+            reservation = await limiter.acquire()
+            with pytest.raises(RateLimitExceeded) as error:
+                await limiter.acquire()
+            reservation.release()
+            await limiter.acquire()
+            return error.value
+
+        error = asyncio.run(scenario())
+
+        assert error.status_code == 503
+        assert limiter.active() == 1
+        assert limiter.queue_depth() == 0
+
+    def test_fails_fast_with_429_until_the_request_rate_allows_another_request(self):
+        limiter = ModelRateLimiter(
+            requests_per_minute=1, max_wait_seconds=10, clock=self.clock
+        )
+
+        async def scenario():
+            await limiter.acquire()
+            with pytest.raises(RateLimitExceeded) as error:
+                await limiter.acquire()
+            self.clock.now += 60
+            await limiter.acquire()
+            return error.value
+
+        error = asyncio.run(scenario())
+
+        assert error.status_code == 429
+        assert error.retry_after_seconds == 60
+
+    def test_counts_estimated_tokens_against_the_token_rate(self):
+        limiter = ModelRateLimiter(
+            tokens_per_minute=1000, max_wait_seconds=10, clock=self.clock
+        )
+
+        async def scenario():
+            await limiter.acquire(estimated_tokens=900)
+            with pytest.raises(RateLimitExceeded) as error:
+                await limiter.acquire(estimated_tokens=500)
+            return error.value
+
+        assert asyncio.run(scenario()).retry_after_seconds == 24
+
+    def test_gives_queued_requests_their_turn_in_arrival_order(self):
+        limiter = ModelRateLimiter(max_concurrent=1, max_wait_seconds=5)
+        turns = []
+
+        async def request(name):
+            reservation = await limiter.acquire()
+            turns.append(name)
+            await asyncio.sleep(0)
+            reservation.release()
+
+        async def scenario():
+            first = await limiter.acquire()
+            waiting = [asyncio.create_task(request(name)) for name in "abc"]
+            await asyncio.sleep(0)
+            queue_depth = limiter.queue_depth()
+            first.release()
+            await asyncio.gather(*waiting)
+            return queue_depth
+
+        assert asyncio.run(scenario()) == 3
+        assert turns == ["a", "b", "c"]
+        assert limiter.active() == 0
+        assert limiter.queue_depth() == 0
+
+    def test_corrects_the_estimated_tokens_with_the_actual_usage(self):
+        limiter = ModelRateLimiter(tokens_per_minute=1000, clock=self.clock)
+
+        underestimated = limiter.try_acquire(estimated_tokens=100)
+        underestimated.settle({"prompt_tokens": 500, "completion_tokens": 300})
+        underestimated.settle({"prompt_tokens": 500, "completion_tokens": 300})
+        assert limiter.try_acquire(estimated_tokens=300) is None
+
+        unused = limiter.try_acquire(estimated_tokens=200)
+        unused.settle(None)
+        assert limiter.try_acquire(estimated_tokens=200) is not None
+
+    def test_wakes_up_waiting_requests_when_another_thread_releases(self):
+        limiter = ModelRateLimiter(max_concurrent=1, max_wait_seconds=5)
+
+        async def scenario():
+            reservation = await limiter.acquire()
+            # Like a summary that finishes in a worker thread
+            threading.Timer(0.05, reservation.release).start()
+            started_at = time.monotonic()
+            await limiter.acquire()
+            return time.monotonic() - started_at
+
+        assert asyncio.run(scenario()) < 0.5
+        assert limiter.active() == 1
+
+    def test_takes_a_turn_without_waiting_only_if_one_is_free(self):
+        limiter = ModelRateLimiter(
+            max_concurrent=1, tokens_per_minute=1000, clock=self.clock
+        )
+
+        reservation = limiter.try_acquire(estimated_tokens=900)
+        assert limiter.try_acquire() is None
+        reservation.release()
+        assert limiter.try_acquire(estimated_tokens=500) is None
+        assert limiter.try_acquire(estimated_tokens=100) is not None
+        assert limiter.active() == 1
+        assert limiter.queue_depth() == 0
+
+
+class TestModelRateLimiters:
+    def test_only_limits_models_with_configured_limits(self):
+        limiters = ModelRateLimiters()
+        unlimited = ModelConfig(
+            "ollama", "ollama", "Ollama", config={"model": "llama3"}
+        )
+        limited = ModelConfig(
+            "azure-gpt4",
+            "azure",
+            "GPT-4 on Azure",
+            config={},
+            limits={"max_concurrent": "2", "tokens_per_minute": ""},
+        )
+
+        assert limiters.get(unlimited) is None
+        assert limiters.get(limited) is limiters.get(limited)
+        assert limiters.get(limited).max_concurrent == 2
+        assert limiters.status() == {"azure-gpt4": {"active": 0, "queue_depth": 0}}
@@ -0,0 +1,171 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from llms.chats import JSONChat
+from llms.clients import (
+    CachedChatClient,
+    ChatClient,
+    HaivenHumanMessage,
+    MockResult,
+)
+from llms.model_config import ModelConfig
+from llms.response_cache import ResponseCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def model_results(*contents):
+    async def results():
+        for content in contents:
+            yield MockResult.model_validate(
+                {"choices": [{"delta": {"content": content}}]}
+            )
+
+    return results()
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+class TestResponseCache:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.clock = FakeClock()
+
+    def test_key_depends_on_model_messages_and_params(self):
+        messages = [{"role": "user", "content": "Hello"}]
+        key = ResponseCache.key("azure/gpt-4", messages, {"temperature": 0})
+
+        assert key == ResponseCache.key("azure/gpt-4", messages, {"temperature": 0})
+        assert key != ResponseCache.key("azure/gpt-35", messages, {"temperature": 0})
+        assert key != ResponseCache.key(
+            "azure/gpt-4", [{"role": "user", "content": "Hi"}], {"temperature": 0}
+        )
+        assert key != ResponseCache.key("azure/gpt-4", messages, {"temperature": 1})
+
+    def test_evicts_least_recently_used_entries(self):
+        cache = ResponseCache(ttl_seconds=60, max_entries=2, clock=self.clock)
+        cache.put("a", ["A"])
+        cache.put("b", ["B"])
+        cache.get("a")
+
+        cache.put("c", ["C"])
+
+        assert cache.get("a") == ["A"]
+        assert cache.get("b") is None
+        assert cache.get("c") == ["C"]
+
+    def test_expires_entries_after_ttl(self):
+        cache = ResponseCache(ttl_seconds=60, clock=self.clock)
+        cache.put("a", ["A"])
+
+        self.clock.now += 61
+
+        assert cache.get("a") is None
+
+    def test_keeps_entries_in_sqlite_across_instances(self, tmp_path):
+        sqlite_path = str(tmp_path / "responses.db")
+        cache = ResponseCache(
+            ttl_seconds=60, max_entries=2, sqlite_path=sqlite_path, clock=self.clock
+        )
+        cache.put("a", ["A", "a"])
+        self.clock.now += 1
+        cache.put("b", ["B"])
+        self.clock.now += 1
+        cache.put("c", ["C"])
+
+        restarted = ResponseCache(
+            ttl_seconds=60, max_entries=2, sqlite_path=sqlite_path, clock=self.clock
+        )
+
+        assert restarted.get("a") is None
+        assert restarted.get("b") == ["B"]
+        assert restarted.get("c") == ["C"]
+        self.clock.now += 60
+        assert restarted.get("b") is None
+
+
+class TestCachedChatClient:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.cache = ResponseCache(ttl_seconds=60)
+        self.model_config = ModelConfig(
+            "azure-gpt4", "azure", "GPT-4 on Azure", config={}
+        )
+
+    @patch("llms.clients.llmAcompletion")
+    def test_replays_cached_response_with_the_same_framing(self, mock_acompletion):
+        async def acompletion(**kwargs):
+            return model_results('[{"title": ', '"Paris"}]')
+
+        mock_acompletion.side_effect = acompletion
+
+        def generate():
+            json_chat = JSONChat(
+                CachedChatClient(self.model_config, self.cache),
+                event_stream_standard=False,
+            )
+            return asyncio.run(collect(json_chat.arun("Give me a city as JSON")))
+
+        first_events = generate()
+        second_events = generate()
+
+        # Only the model's response reports usage, the replay did not use the model
+        assert second_events == first_events[:-1]
+        assert first_events[-1].startswith('{"usage": ')
+        assert mock_acompletion.call_count == 1
+
+    @patch("llms.clients.llmAcompletion")
+    def test_does_not_cache_failed_responses(self, mock_acompletion):
+        async def failing_results():
+            yield MockResult.model_validate({"choices": [{"delta": {"content": "Pa"}}]})
+            raise ConnectionError("connection lost")
+
+        async def acompletion(**kwargs):
+            return failing_results()
+
+        mock_acompletion.side_effect = acompletion
+        chat_client = CachedChatClient(self.model_config, self.cache)
+        messages = [HaivenHumanMessage(content="Capital of France?")]
+
+        with pytest.raises(ConnectionError):
+            asyncio.run(collect(chat_client.astream(messages)))
+
+        assert self.cache.get(chat_client._cache_key(messages)) is None
+
+    @patch("llms.clients.llmAcompletion")
+    def test_only_caches_the_calls_that_ask_for_it(self, mock_acompletion):
+        async def acompletion(**kwargs):
+            return model_results('[{"title": "Paris"}]')
+
+        mock_acompletion.side_effect = acompletion
+
+        def new_session():
+            json_chat = JSONChat(
+                ChatClient(self.model_config), event_stream_standard=False
+            )
+            json_chat.cached_chat_client = CachedChatClient(
+                self.model_config, self.cache
+            )
+            return json_chat
+
+        async def two_turns():
+            json_chat = new_session()
+            await json_chat.acomplete("Give me a city as JSON", use_cache=True)
+            await collect(json_chat.arun("Make it a bigger city"))
+
+        asyncio.run(two_turns())
+        asyncio.run(two_turns())
+
+        # The second session only gets its first answer from the cache
+        assert mock_acompletion.call_count == 3
@@ -0,0 +1,204 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from llms.clients import (
+    HaivenAIMessage,
+    HaivenHumanMessage,
+    HaivenSystemMessage,
+    MockResult,
+    SemanticCachedChatClient,
+)
+from llms.model_config import ModelConfig
+from llms.semantic_cache import SemanticResponseCache
+
+EMBEDDINGS = {
+    "How do I write a user story?": [1.0, 0.0, 0.0],
+    "How should I write a user story?": [0.99, 0.1, 0.0],
+    "What is a threat model?": [0.0, 1.0, 0.0],
+}
+
+
+def embed(text):
+    return EMBEDDINGS[text]
+
+
+def word_counts(text):
+    # Like an embeddings model, similar for texts that mostly consist of the same words
+    words = text.lower().split()
+    return [words.count(word) for word in sorted(set(TEMPLATE.lower().split()))] + [
+        words.count("story"),
+        words.count("threat"),
+    ]
+
+
+TEMPLATE = (
+    "You are a member of a software delivery team. Read the input below carefully, think about "
+    "the users, the stakeholders and the constraints of the team, and answer in a structured way "
+    "with a short summary, a list of considerations, and the next steps. Input: {input}"
+)
+
+
+def model_results(*contents):
+    async def results():
+        for content in contents:
+            yield MockResult.model_validate(
+                {"choices": [{"delta": {"content": content}}]}
+            )
+
+    return results()
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+class TestSemanticResponseCache:
+    def test_returns_response_for_similar_request_in_the_same_scope(self):
+        cache = SemanticResponseCache(embed, threshold=0.95)
+        cache.put(
+            ("gpt-4", "user-stories", None),
+            cache.embed("How do I write a user story?"),
+            ["Like ", "this"],
+        )
+
+        similar = cache.embed("How should I write a user story?")
+        assert cache.get(("gpt-4", "user-stories", None), similar) == ["Like ", "this"]
+        assert cache.get(("gpt-4", "user-stories", "context_a"), similar) is None
+        assert cache.get(("gpt-35", "user-stories", None), similar) is None
+
+    def test_returns_nothing_below_the_threshold(self):
+        cache = SemanticResponseCache(embed, threshold=0.95)
+        cache.put(("scope",), cache.embed("How do I write a user story?"), ["Story"])
+
+        assert cache.get(("scope",), cache.embed("What is a threat model?")) is None
+
+    def test_keeps_the_most_recent_entries_per_scope(self):
+        cache = SemanticResponseCache(embed, threshold=0.95, max_entries_per_scope=1)
+        cache.put(("scope",), cache.embed("How do I write a user story?"), ["Story"])
+        cache.put(("scope",), cache.embed("What is a threat model?"), ["Threats"])
+
+        assert (
+            cache.get(("scope",), cache.embed("How do I write a user story?")) is None
+        )
+        assert cache.get(("scope",), cache.embed("What is a threat model?")) == [
+            "Threats"
+        ]
+
+    def test_expires_responses_after_their_time_to_live(self):
+        now = [1000.0]
+        cache = SemanticResponseCache(
+            embed, threshold=0.95, ttl_seconds=60, clock=lambda: now[0]
+        )
+        cache.put(("scope",), cache.embed("How do I write a user story?"), ["Story"])
+        now[0] += 30
+        cache.put(("scope",), cache.embed("What is a threat model?"), ["Threats"])
+
+        now[0] += 45
+        assert (
+            cache.get(("scope",), cache.embed("How do I write a user story?")) is None
+        )
+        assert cache.get(("scope",), cache.embed("What is a threat model?")) == [
+            "Threats"
+        ]
+
+        now[0] += 30
+        assert cache.get(("scope",), cache.embed("What is a threat model?")) is None
+        cache.put(("scope",), cache.embed("What is a threat model?"), ["New threats"])
+        assert cache.get(("scope",), cache.embed("What is a threat model?")) == [
+            "New threats"
+        ]
+
+
+class TestSemanticCachedChatClient:
+    @pytest.fixture(autouse=True)
+    def setup(self):
+        self.cache = SemanticResponseCache(embed, threshold=0.95)
+        self.model_config = ModelConfig(
+            "azure-gpt4", "azure", "GPT-4 on Azure", config={}
+        )
+
+    def _chat_client(self):
+        return SemanticCachedChatClient(
+            self.model_config, self.cache, ("user-stories", None)
+        )
+
+    @patch("llms.clients.llmAcompletion")
+    def test_answers_similar_first_messages_from_the_cache(self, mock_acompletion):
+        async def acompletion(**kwargs):
+            return model_results("Like ", "this")
+
+        mock_acompletion.side_effect = acompletion
+        system = HaivenSystemMessage(content="You are a helpful assistant")
+
+        first = asyncio.run(
+            collect(
+                self._chat_client().astream(
+                    [system, HaivenHumanMessage(content="How do I write a user story?")]
+                )
+            )
+        )
+        similar = asyncio.run(
+            collect(
+                self._chat_client().astream(
+                    [
+                        system,
+                        HaivenHumanMessage(content="How should I write a user story?"),
+                    ]
+                )
+            )
+        )
+
+        assert similar == first == [{"content": "Like "}, {"content": "this"}]
+        assert mock_acompletion.call_count == 1
+
+    @patch("llms.clients.llmAcompletion")
+    def test_always_sends_follow_up_messages_to_the_model(self, mock_acompletion):
+        async def acompletion(**kwargs):
+            return model_results("Answer")
+
+        mock_acompletion.side_effect = acompletion
+        conversation = [
+            HaivenSystemMessage(content="You are a helpful assistant"),
+            HaivenHumanMessage(content="How do I write a user story?"),
+            HaivenAIMessage(content="Like this"),
+            HaivenHumanMessage(content="How do I write a user story?"),
+        ]
+
+        asyncio.run(collect(self._chat_client().astream(conversation)))
+        asyncio.run(collect(self._chat_client().astream(conversation)))
+
+        assert mock_acompletion.call_count == 2
+
+    @patch("llms.clients.llmAcompletion")
+    def test_compares_the_user_input_instead_of_the_rendered_prompt(
+        self, mock_acompletion
+    ):
+        async def acompletion(**kwargs):
+            return model_results("Answer")
+
+        mock_acompletion.side_effect = acompletion
+        cache = SemanticResponseCache(word_counts, threshold=0.95)
+        system = HaivenSystemMessage(content="You are a helpful assistant")
+
+        def ask(user_input):
+            prompt = HaivenHumanMessage(content=TEMPLATE.format(input=user_input))
+            chat_client = SemanticCachedChatClient(
+                self.model_config, cache, ("guided-input", None), user_input
+            )
+            asyncio.run(collect(chat_client.astream([system, prompt])))
+
+        story, threat = (
+            cache.embed(TEMPLATE.format(input=user_input))
+            for user_input in ["story", "threat"]
+        )
+        # The rendered prompts alone would be similar enough to share an answer
+        assert story @ threat > 0.95
+
+        ask("story")
+        ask("threat")
+        ask("story")
+
+        assert mock_acompletion.call_count == 2
@@ -0,0 +1,215 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+from fastapi.testclient import TestClient
+
+from llms.card_state import CardState
+from llms.chats import ChatManager, ChatOptions, JSONChat, ServerChatSessionMemory
+from llms.clients import HaivenAIMessage, HaivenHumanMessage
+from llms.first_step import FirstStep
+from llms.model_config import ModelConfig
+from llms.session_store import (
+    HTTPSessionStore,
+    InMemorySessionStore,
+    SQLiteSessionStore,
+    create_session_store,
+    session_store_service,
+)
+
+
+async def stream_chunks(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def sqlite_stores(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    return SQLiteSessionStore(path), SQLiteSessionStore(path)
+
+
+def http_stores(tmp_path):
+    # A local stand-in for the session store service that all nodes would talk to
+    service = TestClient(session_store_service(InMemorySessionStore(), "secret"))
+    return (
+        HTTPSessionStore("http://sessions", "secret", client=service),
+        HTTPSessionStore("http://sessions", "secret", client=service),
+    )
+
+
+def chat_manager(store) -> ChatManager:
+    config_service = MagicMock()
+    config_service.get_model.return_value = ModelConfig(
+        "azure-gpt4", "azure", "GPT-4", config={}
+    )
+    config_service.load_conversation_token_budget.return_value = None
+    config_service.load_stream_coalescing_options.return_value = None
+    llm_chat_factory = MagicMock()
+    llm_chat_factory.new_chat_client.side_effect = lambda *args, **kwargs: MagicMock(
+        last_usage=None
+    )
+    return ChatManager(
+        config_service, ServerChatSessionMemory(store), llm_chat_factory, None
+    )
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def answer(chat, question, model_answer):
+    chat.chat_client.astream.return_value = stream_chunks({"content": model_answer})
+    if isinstance(chat, JSONChat):
+        return asyncio.run(chat.acomplete(question))
+    return asyncio.run(collect(chat.arun(question)))
+
+
+@pytest.mark.parametrize("stores", [sqlite_stores, http_stores])
+def test_workers_share_chat_sessions(stores, tmp_path):
+    store_a, store_b = stores(tmp_path)
+    worker_a, worker_b = chat_manager(store_a), chat_manager(store_b)
+    model_config = ModelConfig("azure-gpt4", "azure", "GPT-4", config={})
+
+    key, chat = worker_a.json_chat(
+        model_config, options=ChatOptions(category="scenarios")
+    )
+    chat.first_step = FirstStep("scenarios", "Cities", "some context")
+    chat.card_state = CardState([{"id": 1, "title": "Cities went green"}])
+    answer(chat, "Give me scenarios", '[{"id": 1, "title": "Cities went green"}]')
+
+    restored = worker_b.get_session(key)
+
+    assert isinstance(restored, JSONChat)
+    assert list(restored.memory) == list(chat.memory)
+    assert restored.options.category == "scenarios"
+    assert restored.first_step.user_input == "Cities"
+    assert restored.card_state.to_dict() == chat.card_state.to_dict()
+
+    answer(restored, "Make them greener", "Even greener")
+    continued = worker_a.get_session(key)
+
+    assert continued is not chat
+    assert continued.memory[-2:] == [
+        HaivenHumanMessage(content="Make them greener"),
+        HaivenAIMessage(content="Even greener"),
+    ]
+    # Unchanged sessions are not restored again
+    assert worker_a.get_session(key) is continued
+
+
+def test_interrupted_turns_are_stored_off_the_event_loop(tmp_path):
+    store_a, store_b = http_stores(tmp_path)
+    worker_a, worker_b = chat_manager(store_a), chat_manager(store_b)
+    model_config = ModelConfig("azure-gpt4", "azure", "GPT-4", config={})
+    key, chat = worker_a.json_chat(
+        model_config, options=ChatOptions(category="scenarios")
+    )
+
+    async def model_answering():
+        yield {"content": '[{"title": "Cities'}
+        await asyncio.sleep(60)
+
+    chat.chat_client.astream.return_value = model_answering()
+    store_chat, stored_on = chat.on_turn_finished, []
+
+    def on_turn_finished():
+        stored_on.append(threading.get_ident())
+        store_chat()
+
+    chat.on_turn_finished = on_turn_finished
+
+    async def disconnect_mid_stream():
+        stream = chat.arun("Give me scenarios")
+        await anext(stream)
+        await stream.aclose()
+        return threading.get_ident()
+
+    event_loop_thread = asyncio.run(disconnect_mid_stream())
+
+    assert len(stored_on) == 1
+    assert stored_on[0] != event_loop_thread
+    assert worker_b.get_session(key).memory[-1].content == '[{"title": "Cities'
+
+
+def test_sessions_survive_restarts(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    key, chat = chat_manager(SQLiteSessionStore(path)).streaming_chat(
+        ModelConfig("azure-gpt4", "azure", "GPT-4", config={}),
+        options=ChatOptions(category="chat", in_chunks=True),
+    )
+    answer(chat, "What is the capital of France?", "Paris")
+
+    restarted = chat_manager(SQLiteSessionStore(path)).get_session(key)
+
+    assert restarted.stream_in_chunks
+    assert restarted.memory[-1] == HaivenAIMessage(content="Paris")
+
+
+@pytest.mark.parametrize("stores", [sqlite_stores, http_stores])
+def test_old_sessions_are_removed(stores, tmp_path):
+    store, _ = stores(tmp_path)
+    for key, last_access in [("old", time.time() - 3600), ("recent", time.time())]:
+        store.create(key, {"created_at": last_access, "last_access": last_access})
+
+    assert store.remove_older_than(time.time() - 1800) == ["old"]
+    assert store.get("old") is None
+    assert len(store) == 1
+
+
+@pytest.mark.parametrize("stores", [sqlite_stores, http_stores])
+def test_accessing_a_session_returns_it_with_its_new_last_access(stores, tmp_path):
+    store, _ = stores(tmp_path)
+    store.create("key", {"created_at": 1.0, "last_access": 1.0, "user": "user"})
+
+    entry = store.access("key", 2.0)
+
+    assert entry["last_access"] == 2.0 and entry["user"] == "user"
+    assert store.get("key")["last_access"] == 2.0
+    assert store.access("unknown", 2.0) is None
+
+
+def test_old_sessions_are_removed_in_the_background():
+    session_memory = ServerChatSessionMemory()
+    key = session_memory.add_new_entry("chat", "user")
+    session_memory.store.entries[key]["last_access"] -= 60 * 60
+
+    session_memory.start(interval_seconds=0.01)
+    try:
+        deadline = time.time() + 5
+        while key in session_memory.store.entries and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        session_memory.stop()
+
+    assert key not in session_memory.store.entries
+
+
+def test_session_store_service_requires_its_token():
+    service = TestClient(session_store_service(InMemorySessionStore(), "secret"))
+
+    assert service.get("/sessions").status_code == 401
+    assert (
+        service.get("/sessions", headers={"Authorization": "Bearer wrong"}).status_code
+        == 401
+    )
+    assert (
+        HTTPSessionStore("http://sessions", "secret", client=service).get("unknown")
+        is None
+    )
+    with pytest.raises(ValueError):
+        session_store_service(InMemorySessionStore(), None)
+
+
+def test_create_session_store():
+    assert isinstance(create_session_store(None), InMemorySessionStore)
+    assert isinstance(create_session_store("sqlite://:memory:"), SQLiteSessionStore)
+    assert create_session_store("http://sessions:8080/", "secret").base_url == (
+        "http://sessions:8080"
+    )
+    with pytest.raises(ValueError):
+        create_session_store("http://sessions:8080/")
+    with pytest.raises(ValueError):
+        create_session_store("redis://sessions")
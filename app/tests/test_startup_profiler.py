@@ -0,0 +1,33 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import sys
+import types
+
+from startup_profiler import StartupProfiler
+
+
+class TestStartupProfiler:
+    def test_records_phases_in_order_with_imported_modules(self):
+        profiler = StartupProfiler()
+
+        with profiler.phase("imports"):
+            sys.modules["startup_profiler_test_module"] = types.ModuleType("test")
+        with profiler.phase("config"):
+            pass
+        del sys.modules["startup_profiler_test_module"]
+
+        assert [phase.name for phase in profiler.phases] == ["imports", "config"]
+        assert profiler.phases[0].imported_modules == 1
+        assert profiler.phases[1].imported_modules == 0
+        assert profiler.total_seconds() >= 0
+
+    def test_records_phase_that_failed(self):
+        profiler = StartupProfiler()
+
+        try:
+            with profiler.phase("knowledge pack"):
+                raise FileNotFoundError()
+        except FileNotFoundError:
+            pass
+
+        assert profiler.report().startswith("Startup took")
+        assert "knowledge pack" in profiler.report()
@@ -0,0 +1,85 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from unittest.mock import MagicMock
+
+import pytest
+
+from llms.chats import StreamingChat
+from llms.stream_coalescing import StreamCoalescing
+
+
+async def model_chunks(*contents, pause_seconds=0, fail=False):
+    for content in contents:
+        yield {"content": content}
+        await asyncio.sleep(pause_seconds)
+    if fail:
+        raise ConnectionError("model is down")
+
+
+async def collect(stream):
+    return [chunk["content"] async for chunk in stream]
+
+
+def test_sends_the_first_chunk_right_away_and_combines_the_rest():
+    coalescing = StreamCoalescing(window_seconds=10, max_chars=4)
+
+    chunks = asyncio.run(
+        collect(coalescing.coalesce(model_chunks("Pa", "r", "is", " is", " big", ".")))
+    )
+
+    assert chunks == ["Pa", "ris is", " big", "."]
+
+
+def test_sends_combined_chunks_once_the_window_has_passed():
+    coalescing = StreamCoalescing(window_seconds=0.05, max_chars=1024)
+
+    async def stalled_model():
+        yield {"content": "a"}
+        yield {"content": "b"}
+        await asyncio.sleep(0.5)
+        yield {"content": "c"}
+
+    async def stalled_arrivals():
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        return [
+            (chunk["content"], loop.time() - started_at)
+            async for chunk in coalescing.coalesce(stalled_model())
+        ]
+
+    arrivals = asyncio.run(stalled_arrivals())
+    assert [content for content, _ in arrivals] == ["a", "b", "c"]
+    # "b" is sent when its window passed, not only once the model continues
+    assert arrivals[1][1] < 0.4
+
+
+def test_sends_what_arrived_before_the_model_failed():
+    coalescing = StreamCoalescing(window_seconds=10)
+    received = []
+
+    async def consume():
+        async for chunk in coalescing.coalesce(
+            model_chunks("Pa", "ri", "s", fail=True)
+        ):
+            received.append(chunk["content"])
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(consume())
+    assert received == ["Pa", "ris"]
+
+
+def test_streaming_chat_sends_coalesced_chunks():
+    chat_client = MagicMock()
+    chat_client.astream.return_value = model_chunks("Pa", "r", "is")
+    chat_client.last_usage = None
+    chat = StreamingChat(
+        chat_client,
+        None,
+        stream_coalescing=StreamCoalescing(window_seconds=10),
+    )
+
+    async def answer():
+        return [chunk async for chunk in chat.arun("What is the capital of France?")]
+
+    assert asyncio.run(answer()) == ["Pa", "ris"]
+    assert chat.memory[-1].content == "Paris"
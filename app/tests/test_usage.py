@@ -0,0 +1,117 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import asyncio
+from unittest.mock import MagicMock, patch
+
+from llms.chats import ChatManager
+from llms.clients import ChatClient, HaivenHumanMessage, MockResult
+from llms.model_config import ModelConfig
+from llms.usage import UsageAccounting
+
+
+def usage(prompt_tokens, completion_tokens, first_token_seconds, duration_seconds):
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cache_read_input_tokens": 0,
+        "time_to_first_token_seconds": first_token_seconds,
+        "duration_seconds": duration_seconds,
+    }
+
+
+async def model_results(*contents):
+    for content in contents:
+        yield MockResult.model_validate({"choices": [{"delta": {"content": content}}]})
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+def test_adds_up_usage_per_session_user_and_prompt():
+    accounting = UsageAccounting()
+    accounting.record(usage(100, 20, 0.5, 2.5), "session-1", "user-a", "threats")
+    accounting.record(usage(300, 40, 1.5, 3.5), "session-2", "user-a", "threats")
+
+    assert accounting.totals("session", "session-1")["prompt_tokens"] == 100
+    assert accounting.totals("user", "user-a") == {
+        "requests": 2,
+        "prompt_tokens": 400,
+        "completion_tokens": 60,
+        "cached_tokens": 0,
+        "average_time_to_first_token_seconds": 1.0,
+        "tokens_per_second": 15.0,
+    }
+    assert list(accounting.all_totals("prompt")) == ["threats"]
+
+
+def test_keeps_the_most_recently_used_keys():
+    accounting = UsageAccounting(max_entries=1)
+    accounting.record(usage(100, 20, 0.5, 2.5), session="session-1")
+    accounting.record(usage(100, 20, 0.5, 2.5), session="session-2")
+
+    assert accounting.totals("session", "session-1")["requests"] == 0
+    assert accounting.totals("session", "session-2")["requests"] == 1
+
+
+@patch("llms.clients.count_tokens", side_effect=lambda text: len(text.split()))
+@patch("llms.clients.llmAcompletion")
+def test_chat_client_estimates_usage_the_provider_does_not_report(mock_acompletion, _):
+    async def acompletion(**kwargs):
+        return model_results("Hello ", "there ", "again")
+
+    mock_acompletion.side_effect = acompletion
+    chat_client = ChatClient(
+        ModelConfig("ollama", "ollama", "Ollama", config={"model": "llama3"})
+    )
+
+    asyncio.run(collect(chat_client.astream([HaivenHumanMessage(content="Say hi")])))
+
+    assert chat_client.last_usage["prompt_tokens"] == 2
+    assert chat_client.last_usage["completion_tokens"] == 3
+    assert chat_client.last_usage["estimated"] is True
+    assert chat_client.last_usage["time_to_first_token_seconds"] >= 0
+
+
+@patch("llms.clients.llmAcompletion")
+def test_chat_client_asks_azure_for_the_stream_usage_only_when_configured(
+    mock_acompletion,
+):
+    async def acompletion(**kwargs):
+        return model_results("Hi")
+
+    mock_acompletion.side_effect = acompletion
+    config = {"azure_deployment": "gpt-4o"}
+    default_client = ChatClient(
+        ModelConfig("azure-gpt4o", "azure", "GPT-4o", config=config)
+    )
+    configured_client = ChatClient(
+        ModelConfig.from_dict(
+            {
+                "id": "azure-gpt4o",
+                "provider": "azure",
+                "name": "GPT-4o",
+                "config": config,
+                "stream_usage": "true",
+            }
+        )
+    )
+
+    asyncio.run(collect(default_client.astream([HaivenHumanMessage(content="Hi")])))
+    assert "stream_options" not in mock_acompletion.call_args.kwargs
+    assert default_client.last_usage["estimated"] is True
+
+    asyncio.run(collect(configured_client.astream([HaivenHumanMessage(content="Hi")])))
+    assert mock_acompletion.call_args.kwargs["stream_options"] == {
+        "include_usage": True
+    }
+
+
+def test_chat_manager_returns_the_session_totals():
+    chat_manager = ChatManager(MagicMock(), MagicMock(), MagicMock(), MagicMock())
+
+    totals = chat_manager.record_usage(
+        usage(100, 20, 0.5, 2.5), session="session-1", prompt_id="threats"
+    )
+
+    assert totals["requests"] == 1
+    assert chat_manager.usage_accounting.totals("prompt", "threats")["requests"] == 1
@@ -9,6 +9,7 @@ from haiven_cli.services.file_service import FileService
 from haiven_cli.services.knowledge_service import KnowledgeService
 from haiven_cli.services.token_service import TokenService
 from haiven_cli.services.metadata_service import MetadataService
+from haiven_cli.services.pack_bundle_service import PackBundleService
 
 ENCODING = "cl100k_base"
 
@@ -121,6 +122,18 @@ def create_context(
     )
 
 
+@cli.command(no_args_is_help=True)
+def compile_pack(
+    kp_root: str = "",
+    output_path: str = "knowledge_pack.bundle",
+):
+    """Compile a knowledge pack into a single bundle file for faster startup."""
+    manifest = PackBundleService().compile(kp_root, output_path)
+    print(
+        f"Compiled {len(manifest['files'])} markdown files and {len(manifest['indexes'])} embeddings indexes into {output_path}"
+    )
+
+
 @cli.command(no_args_is_help=True)
 def init(
     config_path: str = "",
@@ -0,0 +1,162 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import datetime
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+
+import yaml
+
+BUNDLE_MAGIC = b"HAIVENKP"
+BUNDLE_FORMAT_VERSION = 1
+# magic, format version, manifest length, sha256 of the manifest
+BUNDLE_HEADER = struct.Struct("<8sIQ32s")
+
+IGNORED_FOLDERS = ["static", "__pycache__"]
+TEXT_FILE_EXTENSIONS = (".yaml", ".yml")
+FRONTMATTER_DELIMITER = re.compile(r"^-{3,}\s*$", re.MULTILINE)
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+class PackBundleService:
+    """
+    Compiles a knowledge pack folder into a single bundle file that Haiven can load on startup
+    instead of walking the folder and opening every file separately.
+
+    Layout of a bundle:
+    - header: magic bytes, format version, manifest length and manifest checksum
+    - manifest (JSON): all folders, parsed frontmatter and content of the markdown files,
+      other text files (e.g. prompt_flows.yaml), and the location and checksum of every embeddings index
+    - vector segments: all index.faiss files, concatenated
+    - chunk store: all index.pkl files, concatenated
+    """
+
+    def compile(self, kp_root: str, output_path: str) -> dict:
+        if not os.path.isdir(kp_root):
+            raise ValueError(f"knowledge pack root {kp_root} is not a directory")
+
+        directories, markdown_files, text_files, index_folders = self._collect(kp_root)
+
+        manifest = {
+            "format_version": BUNDLE_FORMAT_VERSION,
+            "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "directories": directories,
+            "files": {
+                relative_path: self._parse_markdown(
+                    os.path.join(kp_root, relative_path)
+                )
+                for relative_path in markdown_files
+            },
+            "texts": {
+                relative_path: self._read_text(os.path.join(kp_root, relative_path))
+                for relative_path in text_files
+            },
+            "indexes": {},
+        }
+
+        segments = []
+        offset = 0
+        for section, file_name in [("vectors", "index.faiss"), ("chunks", "index.pkl")]:
+            for relative_path in index_folders:
+                source = os.path.join(kp_root, relative_path, file_name)
+                length, checksum = self._checksum(source)
+                manifest["indexes"].setdefault(relative_path, {})[section] = {
+                    "offset": offset,
+                    "length": length,
+                    "sha256": checksum,
+                }
+                segments.append(source)
+                offset += length
+
+        self._write(output_path, manifest, segments)
+        return manifest
+
+    def _collect(self, kp_root: str):
+        directories = []
+        markdown_files = []
+        text_files = []
+        index_folders = []
+
+        for root, folders, files in os.walk(kp_root):
+            folders.sort()
+            relative_root = os.path.relpath(root, kp_root)
+            relative_root = "" if relative_root == "." else relative_root
+
+            kept_folders = []
+            for folder in folders:
+                if folder.startswith(".") or folder in IGNORED_FOLDERS:
+                    continue
+                relative_folder = _to_bundle_path(os.path.join(relative_root, folder))
+                if folder.endswith(".kb"):
+                    if os.path.exists(
+                        os.path.join(root, folder, "index.faiss")
+                    ) and os.path.exists(os.path.join(root, folder, "index.pkl")):
+                        index_folders.append(relative_folder)
+                    continue
+                directories.append(relative_folder)
+                kept_folders.append(folder)
+            folders[:] = kept_folders
+
+            for file in sorted(files):
+                relative_file = _to_bundle_path(os.path.join(relative_root, file))
+                if file.endswith(".md") and file != "README.md":
+                    markdown_files.append(relative_file)
+                elif file.endswith(TEXT_FILE_EXTENSIONS):
+                    text_files.append(relative_file)
+
+        return directories, markdown_files, text_files, index_folders
+
+    def _parse_markdown(self, path: str) -> dict:
+        # Same rules as python-frontmatter, which Haiven uses to read the loose files
+        text = self._read_text(path).strip()
+        metadata = {}
+        content = text
+        if text.startswith("---"):
+            parts = FRONTMATTER_DELIMITER.split(text, 2)
+            if len(parts) == 3:
+                metadata = yaml.safe_load(parts[1]) or {}
+                content = parts[2]
+
+        return {"metadata": metadata, "content": content.strip()}
+
+    def _read_text(self, path: str) -> str:
+        with open(path, "r", encoding="utf-8") as file:
+            return file.read()
+
+    def _checksum(self, path: str):
+        checksum = hashlib.sha256()
+        length = 0
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(READ_BLOCK_SIZE), b""):
+                checksum.update(block)
+                length += len(block)
+        return length, checksum.hexdigest()
+
+    def _write(self, output_path: str, manifest: dict, segments: list):
+        manifest_bytes = json.dumps(manifest, default=str).encode("utf-8")
+        header = BUNDLE_HEADER.pack(
+            BUNDLE_MAGIC,
+            BUNDLE_FORMAT_VERSION,
+            len(manifest_bytes),
+            hashlib.sha256(manifest_bytes).digest(),
+        )
+
+        output_dir = os.path.dirname(output_path)
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+
+        # Write next to the target first, so that a running Haiven never sees a half-written bundle
+        temporary_path = output_path + ".tmp"
+        with open(temporary_path, "wb") as output:
+            output.write(header)
+            output.write(manifest_bytes)
+            for segment in segments:
+                with open(segment, "rb") as source:
+                    shutil.copyfileobj(source, output, READ_BLOCK_SIZE)
+        os.replace(temporary_path, output_path)
+
+
+def _to_bundle_path(path: str) -> str:
+    return path.replace(os.sep, "/")
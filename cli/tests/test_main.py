@@ -1,6 +1,7 @@
 # © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
 from unittest.mock import patch, MagicMock, PropertyMock
 from haiven_cli.main import (
+    compile_pack,
     create_context,
     index_file,
     index_all_files,
@@ -194,3 +195,16 @@ class TestMain:
         file_service.write_business_context_file.assert_called_once_with(
             f"{parent_dir}/contexts/{context_name}/business_context.md"
         )
+
+    @patch("haiven_cli.main.PackBundleService")
+    def test_compile_pack(self, mock_pack_bundle_service):
+        kp_root = "kp_root"
+        output_path = "output_path"
+
+        pack_bundle_service = MagicMock()
+        pack_bundle_service.compile.return_value = {"files": {}, "indexes": {}}
+        mock_pack_bundle_service.return_value = pack_bundle_service
+
+        compile_pack(kp_root, output_path)
+
+        pack_bundle_service.compile.assert_called_once_with(kp_root, output_path)
@@ -0,0 +1,84 @@
+# © 2024 Thoughtworks, Inc. | Licensed under the Apache License, Version 2.0  | See LICENSE.md file for permissions.
+import hashlib
+import json
+import os
+
+import pytest
+
+from haiven_cli.services.pack_bundle_service import (
+    BUNDLE_HEADER,
+    BUNDLE_MAGIC,
+    PackBundleService,
+)
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mode = "wb" if isinstance(content, bytes) else "w"
+    with open(path, mode) as file:
+        file.write(content)
+
+
+def _read_bundle(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    magic, _, manifest_length, manifest_checksum = BUNDLE_HEADER.unpack_from(data)
+    manifest_bytes = data[BUNDLE_HEADER.size : BUNDLE_HEADER.size + manifest_length]
+    assert magic == BUNDLE_MAGIC
+    assert hashlib.sha256(manifest_bytes).digest() == manifest_checksum
+    return json.loads(manifest_bytes), data[BUNDLE_HEADER.size + manifest_length :]
+
+
+class TestPackBundleService:
+    @pytest.fixture(autouse=True)
+    def setup(self, tmp_path):
+        self.kp_root = str(tmp_path / "pack")
+        _write(
+            self.kp_root + "/prompts/chat/prompt.md",
+            "---\nidentifier: prompt\ntitle: A prompt\n---\n\nDo something\n",
+        )
+        _write(self.kp_root + "/prompts/chat/README.md", "# Readme")
+        _write(self.kp_root + "/prompts/chat/prompt_flows.yaml", "- name: flow\n")
+        _write(self.kp_root + "/contexts/context_a/architecture.md", "No frontmatter")
+        _write(self.kp_root + "/embeddings/doc.md", "---\nkey: doc\n---\n")
+        _write(self.kp_root + "/embeddings/doc.kb/index.faiss", b"vectors")
+        _write(self.kp_root + "/embeddings/doc.kb/index.pkl", b"chunks")
+        _write(self.kp_root + "/static/image.png", b"png")
+        self.output_path = str(tmp_path / "out" / "pack.bundle")
+
+    def test_compiles_markdown_files_into_manifest(self):
+        PackBundleService().compile(self.kp_root, self.output_path)
+
+        manifest, _ = _read_bundle(self.output_path)
+        assert sorted(manifest["files"]) == [
+            "contexts/context_a/architecture.md",
+            "embeddings/doc.md",
+            "prompts/chat/prompt.md",
+        ]
+        assert manifest["files"]["prompts/chat/prompt.md"] == {
+            "metadata": {"identifier": "prompt", "title": "A prompt"},
+            "content": "Do something",
+        }
+        assert manifest["files"]["contexts/context_a/architecture.md"] == {
+            "metadata": {},
+            "content": "No frontmatter",
+        }
+        assert manifest["texts"] == {"prompts/chat/prompt_flows.yaml": "- name: flow\n"}
+        assert "static" not in manifest["directories"]
+        assert "contexts/context_a" in manifest["directories"]
+
+    def test_concatenates_vectors_before_chunks_with_checksums(self):
+        PackBundleService().compile(self.kp_root, self.output_path)
+
+        manifest, data = _read_bundle(self.output_path)
+        index = manifest["indexes"]["embeddings/doc.kb"]
+        assert data == b"vectorschunks"
+        for section, expected in [("vectors", b"vectors"), ("chunks", b"chunks")]:
+            segment = index[section]
+            content = data[segment["offset"] : segment["offset"] + segment["length"]]
+            assert content == expected
+            assert segment["sha256"] == hashlib.sha256(expected).hexdigest()
+
+    def test_fails_for_missing_knowledge_pack(self, tmp_path):
+        with pytest.raises(ValueError):
+            PackBundleService().compile(str(tmp_path / "missing"), self.output_path)
@@ -37,6 +37,7 @@ const isAbortError = (error) => {
    onErrorHandle?: (error: {"message", "type"})
    onMessageHandle?: (text: string, response: Response)
    onFinish?: (text: string)
+   onUsage?: (usage: object) - token usage and timing of the request, sent in the last '{ "usage": {...} }' chunk
    json?: boolean; if true, will process '{ "data": "some partial token of a JSON string" }' chunks and pass on as JSON object
 */
 export const fetchSSE = async (uri, fetchOptions, options) => {
@@ -94,6 +95,10 @@ export const fetchSSE = async (uri, fetchOptions, options) => {
           const chunks = chunkable.split(SPLIT_DELIMITER);
           chunks.forEach((value) => {
             const data = JSON.parse(value);
+            if (data.usage !== undefined) {
+              options.onUsage?.(data.usage);
+              return;
+            }
             checkError(data.data);
             options.onMessageHandle?.(data, response);
           });